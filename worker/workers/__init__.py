@@ -1,10 +1,18 @@
 """
 Workers 模块
+
+各 Worker 在首次访问时才导入（导入单个 Worker 时不会加载其他 Worker 及其依赖）
 """
+from importlib import import_module
+
 from .base import BaseWorker
-from .mistake_analyzer import MistakeAnalyzerWorker
-from .daily_task_generator import DailyTaskGeneratorWorker
-from .accumulated_mistakes_analyzer import AccumulatedMistakesAnalyzerWorker
+
+# Worker 类名 -> 所在子包
+_WORKER_MODULES = {
+    'MistakeAnalyzerWorker': '.mistake_analyzer',
+    'DailyTaskGeneratorWorker': '.daily_task_generator',
+    'AccumulatedMistakesAnalyzerWorker': '.accumulated_mistakes_analyzer',
+}
 
 __all__ = [
     'BaseWorker',
@@ -13,3 +21,10 @@ __all__ = [
     'AccumulatedMistakesAnalyzerWorker'
 ]
 
+
+def __getattr__(name: str):
+    """按需导入 Worker 类"""
+    module_name = _WORKER_MODULES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(import_module(module_name, __name__), name)
@@ -0,0 +1,62 @@
+"""
+Redis 缓存（可选，各 Worker 共用）
+
+未配置 REDIS_URL 或未安装 redis 时，所有操作都是空操作，调用方直接回退到 Appwrite 查询
+"""
+import os
+from typing import Any, Optional
+
+import orjson
+from loguru import logger
+
+try:
+    import redis
+except ImportError:
+    # 可选依赖：未安装时禁用缓存
+    redis = None
+
+
+_client = None
+_initialized = False
+
+
+def get_redis():
+    """获取 Redis 客户端（延迟初始化），不可用时返回 None"""
+    global _client, _initialized
+    
+    if not _initialized:
+        _initialized = True
+        redis_url = os.environ.get('REDIS_URL')
+        if redis is not None and redis_url:
+            try:
+                _client = redis.Redis.from_url(redis_url)
+            except Exception as e:
+                logger.warning(f"初始化 Redis 缓存失败，将直接查询数据库: {e}")
+    
+    return _client
+
+
+def cache_get(key: str) -> Optional[Any]:
+    """读取缓存，未命中或缓存不可用时返回 None"""
+    client = get_redis()
+    if client is None:
+        return None
+    
+    try:
+        value = client.get(key)
+        return orjson.loads(value) if value is not None else None
+    except Exception as e:
+        logger.debug(f"读取缓存失败: {key}, 错误: {e}")
+        return None
+
+
+def cache_set(key: str, value: Any, ttl: int):
+    """写入缓存，失败时忽略"""
+    client = get_redis()
+    if client is None:
+        return
+    
+    try:
+        client.set(key, orjson.dumps(value), ex=ttl)
+    except Exception as e:
+        logger.debug(f"写入缓存失败: {key}, 错误: {e}")
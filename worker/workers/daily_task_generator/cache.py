@@ -0,0 +1,56 @@
+"""
+每日任务生成用到的 Redis 缓存（可选，基于 workers.cache）
+跨调度周期缓存变化不频繁的数据（活跃用户列表、题目文档）
+
+未配置 REDIS_URL 或未安装 redis 时，所有操作都是空操作，调用方直接回退到 Appwrite 查询
+"""
+from typing import Any, Dict, Iterable, List
+
+import orjson
+from loguru import logger
+
+from workers.cache import cache_get, cache_set, get_redis
+
+
+# 活跃用户列表：调度频率高于 5 分钟时可避免重复扫描 profiles
+ACTIVE_USERS_KEY = 'active_users:v1'
+ACTIVE_USERS_TTL = 300
+
+# 题目文档：题目内容很少变化
+QUESTION_KEY_PREFIX = 'question:'
+QUESTION_TTL = 3600
+
+
+def get_cached_questions(question_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """批量读取题目缓存，返回命中的 {question_id: question}"""
+    client = get_redis()
+    question_ids = list(question_ids)
+    if client is None or not question_ids:
+        return {}
+    
+    try:
+        values = client.mget([QUESTION_KEY_PREFIX + qid for qid in question_ids])
+    except Exception as e:
+        logger.debug(f"读取题目缓存失败: {e}")
+        return {}
+    
+    return {
+        qid: orjson.loads(value)
+        for qid, value in zip(question_ids, values)
+        if value is not None
+    }
+
+
+def set_cached_questions(questions: List[Dict[str, Any]]):
+    """批量写入题目缓存，失败时忽略"""
+    client = get_redis()
+    if client is None or not questions:
+        return
+    
+    try:
+        pipe = client.pipeline(transaction=False)
+        for question in questions:
+            pipe.set(QUESTION_KEY_PREFIX + question['$id'], orjson.dumps(question), ex=QUESTION_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.debug(f"写入题目缓存失败: {e}")
@@ -2,10 +2,39 @@
 优先级计算模块
 根据知识点的各项指标计算复习优先级
 """
+import sys
 from datetime import datetime, date
+from functools import lru_cache
 from typing import Dict, Any, List
 from loguru import logger
 
+try:
+    import ciso8601
+except ImportError:
+    # 可选依赖：未安装时回退到标准库解析
+    ciso8601 = None
+
+
+@lru_cache(maxsize=4096)
+def _fast_parse_iso(value: str) -> datetime:
+    """
+    解析 ISO 日期/时间字符串（带缓存）
+    
+    优先使用 ciso8601（如已安装），否则使用标准库。
+    Python 3.11+ 的 fromisoformat 已原生支持 'Z' 后缀，无需替换。
+    
+    Args:
+        value: ISO 格式的日期或日期时间字符串
+        
+    Returns:
+        datetime 对象
+    """
+    if ciso8601 is not None:
+        return ciso8601.parse_datetime(value)
+    if sys.version_info < (3, 11) and value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.fromisoformat(value)
+
 
 def calculate_priority(
     review_state: Dict[str, Any],
@@ -69,6 +98,35 @@ def calculate_priority(
     return priority
 
 
+def calculate_coarse_priority(
+    review_state: Dict[str, Any],
+    user_kp: Dict[str, Any],
+    today: date = None
+) -> float:
+    """
+    计算粗略优先级（不依赖错题和题目数据）
+    
+    用于在获取错题/题目前先对知识点排序，只为排名靠前的知识点获取完整数据。
+    省略了用户标记分，紧急度也不考虑近期错题，权重与 calculate_priority 一致。
+    
+    Args:
+        review_state: 知识点复习状态
+        user_kp: 用户知识点信息（包含 importance 字段）
+        today: 用户时区的"今天"日期
+        
+    Returns:
+        粗略优先级分数 (0-75)
+    """
+    if today is None:
+        today = date.today()
+    
+    return (
+        calculate_urgency_score(review_state, [], today) * 0.30 +
+        calculate_importance_score_from_kp(user_kp) * 0.25 +
+        calculate_forget_risk(review_state, today) * 0.20
+    )
+
+
 def calculate_importance_score_from_kp(user_kp: Dict[str, Any]) -> float:
     """
     从知识点记录直接读取 importance 字段计算分数
@@ -187,12 +245,7 @@ def calculate_urgency_score(
     
     # 解析日期（可能是 datetime 字符串或 date 字符串）
     try:
-        if 'T' in next_review_str:
-            # ISO datetime 格式
-            next_review = datetime.fromisoformat(next_review_str.replace('Z', '+00:00')).date()
-        else:
-            # Date 格式
-            next_review = datetime.fromisoformat(next_review_str).date()
+        next_review = _fast_parse_iso(next_review_str).date()
     except Exception as e:
         logger.error(f"解析日期失败: {next_review_str}, 错误: {e}")
         return 0.0
@@ -257,10 +310,7 @@ def calculate_forget_risk(review_state: Dict[str, Any], today: date = None) -> f
         return 0.0
     
     try:
-        if 'T' in last_review_str:
-            last_review = datetime.fromisoformat(last_review_str.replace('Z', '+00:00')).date()
-        else:
-            last_review = datetime.fromisoformat(last_review_str).date()
+        last_review = _fast_parse_iso(last_review_str).date()
     except Exception as e:
         logger.error(f"解析最后复习日期失败: {last_review_str}, 错误: {e}")
         return 0.0
@@ -344,8 +394,7 @@ def parse_created_at(created_at_str: str) -> date | None:
         return None
     
     try:
-        dt = datetime.fromisoformat(created_at_str.replace('Z', '+00:00'))
-        return dt.date()
+        return _fast_parse_iso(created_at_str).date()
     except Exception as e:
         logger.error(f"解析创建时间失败: {created_at_str}, 错误: {e}")
         return None
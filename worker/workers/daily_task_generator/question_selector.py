@@ -2,12 +2,153 @@
 题目选择模块
 根据知识点状态选择合适的原题和变式题
 """
-from typing import Dict, Any, List
+from functools import lru_cache
+from operator import itemgetter
+from typing import Dict, Any, List, Iterable, Optional
 from loguru import logger
 from appwrite.services.databases import Databases
 from appwrite.query import Query
 
+from .cache import get_cached_questions, set_cached_questions
+from .priority_calculator import _fast_parse_iso
 
+
+# Appwrite 数组过滤条件（如 Query.equal('$id', [...])）单次最多携带的值数量
+QUERY_ID_CHUNK_SIZE = 100
+
+# 不含变量的查询条件（模块加载时构建一次后复用）
+_Q_IS_PUBLIC = Query.equal('isPublic', True)
+_Q_ORDER_QUALITY_DESC = Query.order_desc('qualityScore')
+
+
+def fetch_questions_by_ids(
+    question_ids: List[str],
+    db: Databases
+) -> Dict[str, Dict[str, Any]]:
+    """
+    批量获取题目（避免逐题 get_document 的 N+1 查询）
+    
+    Args:
+        question_ids: 题目ID列表（可包含重复）
+        db: 数据库服务
+        
+    Returns:
+        {question_id: question} 字典，查询失败或不存在的题目不包含在内
+    """
+    unique_ids = list(dict.fromkeys(qid for qid in question_ids if qid))
+    questions_by_id = {}
+    
+    for i in range(0, len(unique_ids), QUERY_ID_CHUNK_SIZE):
+        chunk = unique_ids[i:i + QUERY_ID_CHUNK_SIZE]
+        try:
+            response = db.list_documents(
+                'main',
+                'questions',
+                queries=[
+                    Query.equal('$id', chunk),
+                    Query.limit(len(chunk))
+                ]
+            )
+        except Exception as e:
+            logger.warning(f"批量获取题目失败: {len(chunk)} 道, 错误: {e}")
+            continue
+        
+        for question in response['documents']:
+            questions_by_id[question['$id']] = question
+    
+    return questions_by_id
+
+
+@lru_cache(maxsize=4096)
+def _iso_to_epoch(value: str) -> float:
+    """
+    ISO 时间字符串转时间戳（用于排序键，数值比较比字符串逐字符比较更快）
+    
+    Args:
+        value: ISO 格式的时间字符串
+        
+    Returns:
+        Unix 时间戳，空值或解析失败返回 0
+    """
+    if not value:
+        return 0.0
+    try:
+        return _fast_parse_iso(value).timestamp()
+    except ValueError:
+        return 0.0
+
+
+class QuestionCache:
+    """
+    单次任务生成内的题目文档缓存
+    
+    同一用户的多个知识点常常引用同一道题，缓存后只需查询一次。
+    仅在单个用户的一次生成过程中使用，不存在数据过期问题。
+    未命中时先查 Redis 缓存（如已配置），再查询数据库。
+    """
+    
+    def __init__(self, db: Databases):
+        self.db = db
+        self._cache: Dict[str, Dict[str, Any]] = {}
+    
+    def get(self, question_id: str) -> Optional[Dict[str, Any]]:
+        """获取单道题目，不存在返回 None"""
+        return self.get_many([question_id]).get(question_id)
+    
+    def get_many(self, question_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        批量获取题目，只为未命中缓存的题目发起查询
+        
+        Returns:
+            {question_id: question} 字典，不存在的题目不包含在内
+        """
+        question_ids = [qid for qid in question_ids if qid]
+        missing = [qid for qid in question_ids if qid not in self._cache]
+        if missing:
+            self._cache.update(get_cached_questions(missing))
+            missing = [qid for qid in missing if qid not in self._cache]
+        if missing:
+            fetched = fetch_questions_by_ids(missing, self.db)
+            self._cache.update(fetched)
+            set_cached_questions(list(fetched.values()))
+        
+        return {qid: self._cache[qid] for qid in question_ids if qid in self._cache}
+    
+    def put_many(self, questions: Iterable[Dict[str, Any]]):
+        """写入已通过其他查询获取到的题目"""
+        for question in questions:
+            self._cache[question['$id']] = question
+
+
+def build_mistakes_index(mistakes: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    按题目ID建立错题索引（按 $createdAt 倒序插入）
+    
+    同一知识点的多个选题函数可共享该索引，避免各自重复排序错题列表。
+    同一道题有多条错题记录时，保留最近的一条。
+    
+    Args:
+        mistakes: 错题记录列表
+        
+    Returns:
+        {question_id: mistake} 有序字典，按错题创建时间从新到旧排列
+    """
+    sorted_mistakes = sorted(
+        mistakes,
+        key=lambda m: _iso_to_epoch(m.get('$createdAt', '')),
+        reverse=True
+    )
+    
+    mistakes_index = {}
+    for mistake in sorted_mistakes:
+        question_id = mistake.get('questionId')
+        if question_id and question_id not in mistakes_index:
+            mistakes_index[question_id] = mistake
+    
+    return mistakes_index
+
+
+@lru_cache(maxsize=None)
 def estimate_question_count(status: str, difficulty: str) -> int:
     """
     预估某知识点会推送多少题
@@ -40,6 +181,7 @@ def estimate_question_count(status: str, difficulty: str) -> int:
     return config.get(difficulty, {}).get(status, 2)
 
 
+@lru_cache(maxsize=None)
 def get_question_limits(difficulty: str) -> tuple[int, int]:
     """
     获取题量范围
@@ -64,7 +206,9 @@ def select_original_questions(
     count: int,
     db: Databases,
     exclude_question_ids: set = None,
-    knowledge_point_id: str = None
+    knowledge_point_id: str = None,
+    question_cache: QuestionCache = None,
+    mistakes_index: Dict[str, Dict[str, Any]] = None
 ) -> List[Dict[str, Any]]:
     """
     从错题中选择原题
@@ -78,6 +222,9 @@ def select_original_questions(
         db: 数据库服务
         exclude_question_ids: 需要排除的题目ID集合（避免重复）
         knowledge_point_id: 当前知识点ID（用于优先级排序）
+        question_cache: 题目缓存（可选），未提供时创建临时缓存
+        mistakes_index: 预建的错题索引（可选，见 build_mistakes_index），
+            提供时忽略 mistakes 参数，直接使用索引中的错题
         
     Returns:
         选中的题目列表（带 mistakeId）
@@ -88,59 +235,54 @@ def select_original_questions(
     if exclude_question_ids is None:
         exclude_question_ids = set()
     
-    # 按最近错误时间排序，选择最近的
-    sorted_mistakes = sorted(
-        mistakes,
-        key=lambda m: m.get('$createdAt', ''),
-        reverse=True
-    )
+    if question_cache is None:
+        question_cache = QuestionCache(db)
     
-    # 获取题目信息并计算优先级
+    # 按最近错误时间排序（调用方已提供索引时无需重新排序）
+    if mistakes_index is None:
+        mistakes_index = build_mistakes_index(mistakes)
+    
+    # 批量获取题目信息
+    question_ids = [
+        qid for qid in mistakes_index
+        if qid not in exclude_question_ids
+    ]
+    questions_by_id = question_cache.get_many(question_ids)
+    
+    # 计算优先级
     mistake_with_questions = []
-    for mistake in sorted_mistakes:
-        question_id = mistake.get('questionId')
-        if not question_id or question_id in exclude_question_ids:
-            continue
+    for question_id in question_ids:
+        mistake = mistakes_index[question_id]
         
-        try:
-            question = db.get_document('main', 'questions', question_id)
-            
-            # 计算优先级分数
-            priority_score = 0
-            if knowledge_point_id:
-                primary_kp_ids = question.get('primaryKnowledgePointIds', [])
-                is_primary = knowledge_point_id in primary_kp_ids if primary_kp_ids else False
-                priority_score = 100 if is_primary else 50
-            
-            mistake_with_questions.append({
-                'mistake': mistake,
-                'question': question,
-                'priority_score': priority_score
-            })
-        except Exception as e:
-            logger.warning(f"获取题目失败: {question_id}, 错误: {e}")
+        question = questions_by_id.get(question_id)
+        if question is None:
+            logger.warning(f"获取题目失败: {question_id}")
             continue
+        
+        # 计算优先级分数
+        priority_score = 0
+        if knowledge_point_id:
+            primary_kp_ids = question.get('primaryKnowledgePointIds', [])
+            is_primary = knowledge_point_id in primary_kp_ids if primary_kp_ids else False
+            priority_score = 100 if is_primary else 50
+        
+        # 排序键在构建时一次性计算：主要知识点题目在前，然后按时间排序
+        sort_key = (priority_score, _iso_to_epoch(mistake.get('$createdAt', '')))
+        mistake_with_questions.append((sort_key, mistake, question))
     
-    # 按优先级排序（主要知识点题目在前，然后按时间排序）
-    mistake_with_questions.sort(
-        key=lambda x: (x['priority_score'], x['mistake'].get('$createdAt', '')),
-        reverse=True
-    )
+    # 按优先级排序
+    mistake_with_questions.sort(key=itemgetter(0), reverse=True)
     
     # 选择前 count 个
-    selected = []
-    for item in mistake_with_questions[:count]:
-        selected.append({
-            **item['question'],
-            'mistakeId': item['mistake']['$id']
-        })
+    top = mistake_with_questions[:count]
+    selected = [
+        {**question, 'mistakeId': mistake['$id']}
+        for _, mistake, question in top
+    ]
     
     # 统计主要知识点题目数量
     if knowledge_point_id:
-        primary_count = sum(
-            1 for q in selected 
-            if knowledge_point_id in q.get('primaryKnowledgePointIds', [])
-        )
+        primary_count = sum(1 for sort_key, _, _ in top if sort_key[0] == 100)
         logger.debug(
             f"原题选择：知识点 {knowledge_point_id} 选择了 {len(selected)} 道题，"
             f"其中 {primary_count} 道为主要知识点题目"
@@ -154,7 +296,8 @@ def select_variant_questions(
     count: int,
     db: Databases,
     exclude_question_ids: set = None,
-    shortage_tracker: dict = None
+    shortage_tracker: dict = None,
+    question_cache: QuestionCache = None
 ) -> List[Dict[str, Any]]:
     """
     选择变式题
@@ -169,6 +312,7 @@ def select_variant_questions(
         db: 数据库服务
         exclude_question_ids: 需要排除的题目ID集合（避免跨知识点重复）
         shortage_tracker: 题目不足追踪器（可选）
+        question_cache: 题目缓存（可选）
         
     Returns:
         选中的变式题列表
@@ -179,6 +323,9 @@ def select_variant_questions(
     if exclude_question_ids is None:
         exclude_question_ids = set()
     
+    if question_cache is None:
+        question_cache = QuestionCache(db)
+    
     knowledge_point_id = kp_data['user_kp']['moduleId']
     status = kp_data['review_state']['status']
     
@@ -200,7 +347,8 @@ def select_variant_questions(
             kp_data['mistakes'],
             db,
             exclude_ids=exclude_question_ids,
-            shortage_tracker=shortage_tracker
+            shortage_tracker=shortage_tracker,
+            question_cache=question_cache
         )
         selected.extend(single_questions)
     
@@ -216,7 +364,8 @@ def select_variant_questions(
             kp_data['mistakes'],
             db,
             exclude_ids=all_exclude_ids,
-            shortage_tracker=shortage_tracker
+            shortage_tracker=shortage_tracker,
+            question_cache=question_cache
         )
         selected.extend(combined_questions)
     
@@ -228,7 +377,8 @@ def select_comprehensive_questions(
     count: int,
     db: Databases,
     exclude_question_ids: set = None,
-    shortage_tracker: dict = None
+    shortage_tracker: dict = None,
+    question_cache: QuestionCache = None
 ) -> List[Dict[str, Any]]:
     """
     选择综合题（mastered 阶段用）
@@ -241,11 +391,14 @@ def select_comprehensive_questions(
         db: 数据库服务
         exclude_question_ids: 需要排除的题目ID集合
         shortage_tracker: 题目不足追踪器（可选）
+        question_cache: 题目缓存（可选）
         
     Returns:
         选中的综合题列表
     """
-    return select_variant_questions(kp_data, count, db, exclude_question_ids, shortage_tracker)
+    return select_variant_questions(
+        kp_data, count, db, exclude_question_ids, shortage_tracker, question_cache
+    )
 
 
 def _select_single_kp_questions(
@@ -254,14 +407,15 @@ def _select_single_kp_questions(
     mistakes: List[Dict[str, Any]],
     db: Databases,
     exclude_ids = None,
-    shortage_tracker: dict = None
+    shortage_tracker: dict = None,
+    question_cache: QuestionCache = None
 ) -> List[Dict[str, Any]]:
     """
     选择单知识点题目（内部函数）
     
     新增逻辑：
-    - 优先选择该知识点为主要知识点的题目
-    - 如果主要知识点题目不足，再选择普通关联题目
+    - 优先选择该知识点为主要知识点的题目（单独查询，依赖 primaryKp_isPublic_idx 索引）
+    - 如果主要知识点题目不足，再查询普通关联题目补足
     - 如果题目不足，记录到 shortage_tracker 以便后续生成
     
     Args:
@@ -271,6 +425,7 @@ def _select_single_kp_questions(
         db: 数据库服务
         exclude_ids: 需要排除的题目ID（可以是list或set）
         shortage_tracker: 题目不足追踪器（可选），用于记录需要生成变式题的源题目
+        question_cache: 题目缓存（可选），查询到的题目会写入缓存
         
     Returns:
         选中的题目列表
@@ -281,53 +436,61 @@ def _select_single_kp_questions(
         exclude_ids = set(exclude_ids)
     
     try:
-        # 使用更大的缓冲以应对题目去重和优先级排序
-        query_limit = max(count * 8, 30)  # 增加缓冲量
+        # 获取用户已做过的题目ID，与已选择的题目合并为一个排除集合
+        mistake_q_ids = {m['questionId'] for m in mistakes if m.get('questionId')}
+        excluded = mistake_q_ids | exclude_ids
         
-        response = db.list_documents(
+        # 1. 先查询以该知识点为主要知识点的题目（常见情况下已足够）
+        primary_response = db.list_documents(
             'main',
             'questions',
             queries=[
-                Query.contains('knowledgePointIds', knowledge_point_id),
-                Query.equal('isPublic', True),
-                Query.limit(query_limit)
+                Query.contains('primaryKnowledgePointIds', knowledge_point_id),
+                _Q_IS_PUBLIC,
+                _Q_ORDER_QUALITY_DESC,
+                Query.limit(count * 2 + len(excluded))
             ]
         )
+        primary_questions = primary_response['documents']
+        if question_cache is not None:
+            question_cache.put_many(primary_questions)
         
-        questions = response['documents']
+        # 过滤：排除已做过的和已选择的
+        filtered = [q for q in primary_questions if q['$id'] not in excluded]
         
-        # 获取用户已做过的题目ID
-        mistake_q_ids = [m.get('questionId') for m in mistakes if m.get('questionId')]
+        # 2. 主要知识点题目不足时，再查询普通关联题目补足
+        if len(filtered) < count:
+            # 服务端按质量分排序，只需覆盖排除集合和已选主要知识点题目的缓冲
+            query_limit = count * 2 + len(excluded) + len(filtered)
+            
+            response = db.list_documents(
+                'main',
+                'questions',
+                queries=[
+                    Query.contains('knowledgePointIds', knowledge_point_id),
+                    _Q_IS_PUBLIC,
+                    _Q_ORDER_QUALITY_DESC,
+                    Query.limit(query_limit)
+                ]
+            )
+            questions = response['documents']
+            if question_cache is not None:
+                question_cache.put_many(questions)
+            
+            seen = excluded | {q['$id'] for q in filtered}
+            filtered.extend(q for q in questions if q['$id'] not in seen)
         
-        # 过滤：排除已做过的和已选择的
-        filtered = [
-            q for q in questions
-            if q['$id'] not in mistake_q_ids and q['$id'] not in exclude_ids
+        # 标记是否为主要知识点题目，按优先级排序（主要知识点题目在前，稳定排序）
+        scored = [
+            (knowledge_point_id in (q.get('primaryKnowledgePointIds') or ()), q)
+            for q in filtered
         ]
+        scored.sort(key=itemgetter(0), reverse=True)
         
-        # 按主要知识点优先级排序
-        def get_priority_score(question):
-            """计算题目优先级分数"""
-            primary_kp_ids = question.get('primaryKnowledgePointIds', [])
-            is_primary = knowledge_point_id in primary_kp_ids if primary_kp_ids else False
-            
-            # 主要知识点题目优先级更高
-            if is_primary:
-                return 100
-            else:
-                return 50
-        
-        # 按优先级排序（主要知识点题目在前）
-        filtered.sort(key=get_priority_score, reverse=True)
-        
-        # 取前 count 个
-        selected = filtered[:count]
-        
-        # 统计主要知识点题目数量
-        primary_count = sum(
-            1 for q in selected 
-            if knowledge_point_id in q.get('primaryKnowledgePointIds', [])
-        )
+        # 取前 count 个，同时统计主要知识点题目数量
+        top = scored[:count]
+        selected = [q for _, q in top]
+        primary_count = sum(1 for is_primary, _ in top if is_primary)
         
         logger.debug(
             f"知识点 {knowledge_point_id} 选择了 {len(selected)} 道题，"
@@ -349,7 +512,8 @@ def _select_single_kp_questions(
                     mistakes=mistakes,
                     shortage=shortage,
                     shortage_tracker=shortage_tracker,
-                    db=db
+                    db=db,
+                    question_cache=question_cache
                 )
         
         return selected
@@ -364,7 +528,8 @@ def _record_variant_generation_need(
     mistakes: List[Dict[str, Any]],
     shortage: int,
     shortage_tracker: dict,
-    db: Databases
+    db: Databases,
+    question_cache: QuestionCache = None
 ):
     """
     记录需要生成变式题的源题目
@@ -379,8 +544,17 @@ def _record_variant_generation_need(
         shortage: 题目缺口数量
         shortage_tracker: 追踪器字典
         db: 数据库服务
+        question_cache: 题目缓存（可选）
     """
+    if question_cache is None:
+        question_cache = QuestionCache(db)
+    
+    tracked_before = len(shortage_tracker)
+    
     try:
+        # 批量获取错题对应的题目
+        questions_by_id = question_cache.get_many(m.get('questionId') for m in mistakes)
+        
         # 从错题中选择候选源题目
         candidate_source_questions = []
         
@@ -389,61 +563,50 @@ def _record_variant_generation_need(
             if not question_id:
                 continue
             
-            try:
-                question = db.get_document('main', 'questions', question_id)
-                
-                # 优先选择该知识点为主要知识点的题目
-                primary_kp_ids = question.get('primaryKnowledgePointIds', [])
-                is_primary = knowledge_point_id in primary_kp_ids if primary_kp_ids else False
-                
-                # 检查题目质量（只选择高质量题目作为源题目）
-                quality_score = question.get('qualityScore', 0)
-                
-                if quality_score >= 4.0:  # 只选择质量分 >= 4.0 的题目
-                    candidate_source_questions.append({
-                        'question_id': question_id,
-                        'is_primary': is_primary,
-                        'quality_score': quality_score,
-                        'created_at': mistake.get('$createdAt', '')
-                    })
-            except Exception as e:
-                logger.warning(f"获取源题目失败: {question_id}, 错误: {e}")
+            question = questions_by_id.get(question_id)
+            if question is None:
+                logger.warning(f"获取源题目失败: {question_id}")
                 continue
+            
+            # 优先选择该知识点为主要知识点的题目
+            primary_kp_ids = question.get('primaryKnowledgePointIds', [])
+            is_primary = knowledge_point_id in primary_kp_ids if primary_kp_ids else False
+            
+            # 检查题目质量（只选择高质量题目作为源题目）
+            quality_score = question.get('qualityScore', 0)
+            
+            if quality_score >= 4.0:  # 只选择质量分 >= 4.0 的题目
+                # 排序键：主要知识点题目优先，然后按质量分和时间
+                sort_key = (is_primary, quality_score, _iso_to_epoch(mistake.get('$createdAt', '')))
+                candidate_source_questions.append((sort_key, question_id))
         
         if not candidate_source_questions:
             logger.warning(f"知识点 {knowledge_point_id} 没有合适的源题目用于生成变式题")
             return
         
-        # 排序：主要知识点题目优先，然后按质量分和时间
-        candidate_source_questions.sort(
-            key=lambda x: (x['is_primary'], x['quality_score'], x['created_at']),
-            reverse=True
-        )
+        candidate_source_questions.sort(key=itemgetter(0), reverse=True)
         
-        # 选择前几个源题目（每个源题目生成 2-3 道变式题）
+        # 按顺序选择源题目（每个源题目最多生成 3 道变式题），直到覆盖缺口
+        # 已被其他知识点记录的源题目跳过，不计入本知识点的缺口
         variants_per_question = 3
-        num_source_questions = min(
-            len(candidate_source_questions),
-            (shortage + variants_per_question - 1) // variants_per_question  # 向上取整
-        )
+        remaining = shortage
         
-        selected_sources = candidate_source_questions[:num_source_questions]
-        
-        # 记录到 shortage_tracker
-        for source in selected_sources:
-            question_id = source['question_id']
-            if question_id not in shortage_tracker:
-                shortage_tracker[question_id] = {
-                    'knowledge_point_id': knowledge_point_id,
-                    'variants_needed': min(variants_per_question, shortage)
-                }
-                shortage -= variants_per_question
-                if shortage <= 0:
-                    break
+        for _, question_id in candidate_source_questions:
+            if remaining <= 0:
+                break
+            if question_id in shortage_tracker:
+                continue
+            
+            take = min(variants_per_question, remaining)
+            shortage_tracker[question_id] = {
+                'knowledge_point_id': knowledge_point_id,
+                'variants_needed': take
+            }
+            remaining -= take
         
         logger.info(
             f"记录变式题生成需求：知识点 {knowledge_point_id}，"
-            f"选择了 {len([s for s in selected_sources if s['question_id'] in shortage_tracker])} 个源题目"
+            f"选择了 {len(shortage_tracker) - tracked_before} 个源题目"
         )
         
     except Exception as e:
@@ -462,15 +625,12 @@ def check_if_all_correct_last_time(mistakes: List[Dict[str, Any]]) -> bool:
     """
     # MVP阶段简化：只要 reviewCount > 0 且 masteryStatus 不是 'notStarted'，
     # 就认为已经复习过
-    for mistake in mistakes:
-        review_count = mistake.get('reviewCount', 0)
-        correct_count = mistake.get('correctCount', 0)
-        
-        # 如果有复习过但正确次数少于复习次数，说明有错误
-        if review_count > 0 and correct_count < review_count:
-            return False
-    
-    return True
+    # 如果有复习过但正确次数少于复习次数，说明有错误
+    return not any(
+        m.get('correctCount', 0) < m.get('reviewCount', 0)
+        for m in mistakes
+        if m.get('reviewCount', 0) > 0
+    )
 
 
 def select_wrong_questions(
@@ -478,7 +638,8 @@ def select_wrong_questions(
     count: int,
     db: Databases,
     exclude_question_ids: set = None,
-    knowledge_point_id: str = None
+    knowledge_point_id: str = None,
+    question_cache: QuestionCache = None
 ) -> List[Dict[str, Any]]:
     """
     选择上次答错的题目
@@ -489,6 +650,7 @@ def select_wrong_questions(
         db: 数据库服务
         exclude_question_ids: 需要排除的题目ID集合
         knowledge_point_id: 当前知识点ID（用于优先级排序）
+        question_cache: 题目缓存（可选）
         
     Returns:
         选中的题目列表
@@ -497,6 +659,7 @@ def select_wrong_questions(
         return []
     
     # 筛选出最近复习过但还没掌握的错题
+    # （需在按题目去重之前筛选，不能复用共享的错题索引：同一道题最近一条记录已掌握时，较早的未掌握记录仍应入选）
     wrong_mistakes = [
         m for m in mistakes
         if m.get('reviewCount', 0) > 0
@@ -506,7 +669,7 @@ def select_wrong_questions(
     # 按最近复习时间排序
     sorted_mistakes = sorted(
         wrong_mistakes,
-        key=lambda m: m.get('lastReviewAt', ''),
+        key=lambda m: _iso_to_epoch(m.get('lastReviewAt', '')),
         reverse=True
     )
     
@@ -515,6 +678,7 @@ def select_wrong_questions(
         count, 
         db, 
         exclude_question_ids,
-        knowledge_point_id
+        knowledge_point_id,
+        question_cache
     )
 
@@ -1,17 +1,28 @@
 """
 任务生成模块 - 核心业务逻辑
 """
-import json
+import heapq
 import uuid
-from datetime import datetime, date, timedelta
-from typing import Dict, Any, List
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
+from operator import itemgetter
+from typing import Dict, Any, Iterable, Iterator, List, Set
+import orjson
 from loguru import logger
 from appwrite.services.databases import Databases
 from appwrite.query import Query
 from appwrite.id import ID
 
-from .priority_calculator import calculate_priority
+from .cache import ACTIVE_USERS_KEY, ACTIVE_USERS_TTL, cache_get, cache_set
+from .priority_calculator import (
+    _fast_parse_iso,
+    calculate_priority,
+    calculate_coarse_priority
+)
 from .question_selector import (
+    QUERY_ID_CHUNK_SIZE,
+    QuestionCache,
     estimate_question_count,
     get_question_limits,
     select_original_questions,
@@ -23,44 +34,368 @@ from .question_selector import (
 from .timezone_utils import (
     get_user_timezone_date,
     get_user_timezone_datetime,
-    get_user_timezone_iso_string
+    get_user_timezone_iso_string,
+    is_same_date_in_user_timezone
 )
 
 
-def get_active_users(db: Databases) -> List[Dict[str, Any]]:
+# 分页查询每页的文档数
+PAGE_SIZE = 100
+
+# 粗排后保留的候选知识点数量 = 题量上限 × 该系数（每个知识点至少 1 道题）
+CANDIDATE_KP_FACTOR = 2
+
+# 逐条删除/创建文档的共享线程数（所有用户共用，限制这类并发 Appwrite 请求的总数）
+DOCUMENT_WORKERS = 8
+
+# 生成前一次性查询的用户最近任务数（用于清理旧任务和检查今日任务）
+RECENT_TASKS_LIMIT = 50
+
+# 题目首次被选中时的来源信息，kp_ids 按选中顺序记录关联该题的所有知识点（去重）
+_QuestionEntry = namedtuple('_QuestionEntry', ['source', 'mistake_id', 'kp_ids'])
+
+# 不含变量的查询条件（Query 构造结果为不可变字符串，模块加载时构建一次后复用）
+_Q_PAGE_LIMIT = Query.limit(PAGE_SIZE)
+_Q_DELETE_FALLBACK_LIMIT = Query.limit(100)
+_Q_IS_ACTIVE = Query.equal('isActive', True)
+_Q_NOT_MASTERED = Query.not_equal('masteryStatus', 'mastered')
+_Q_NOT_COMPLETED = Query.equal('isCompleted', False)
+_Q_ORDER_TASK_DATE_DESC = Query.order_desc('taskDate')
+_Q_ORDER_CREATED_DESC = Query.order_desc('$createdAt')
+_Q_RECENT_TASKS_LIMIT = Query.limit(RECENT_TASKS_LIMIT)
+
+# 只返回后续计算用到的字段，减小响应体积和 JSON 解析开销
+# 错题：优先级计算（$createdAt/isImportant）、按知识点分组、原题选择和复习状态判断
+_Q_SELECT_MISTAKE_FIELDS = Query.select([
+    '$id', '$createdAt', 'questionId', 'knowledgePointIds', 'masteryStatus',
+    'reviewCount', 'correctCount', 'lastReviewAt', 'isImportant'
+])
+# 题目：按知识点分组、主要知识点判断、重要度计算（投影后的文档不完整，只用于知识点排序，不写入 QuestionCache）
+_Q_SELECT_QUESTION_FIELDS = Query.select([
+    '$id', '$createdAt', 'knowledgePointIds', 'primaryKnowledgePointIds',
+    'qualityScore', 'importance'
+])
+# 每日任务：清理旧任务和检查今日任务
+_Q_SELECT_TASK_FIELDS = Query.select(['$id', 'taskDate', 'isCompleted', 'totalQuestions'])
+# 每日任务：批量检查今日任务
+_Q_SELECT_TASK_OWNER_FIELDS = Query.select(['$id', 'userId', 'taskDate'])
+
+# 逐条删除/创建文档的共享线程池（多个用户并发生成任务时共用，线程数不随用户数增加）
+_DOCUMENT_POOL = ThreadPoolExecutor(max_workers=DOCUMENT_WORKERS, thread_name_prefix='daily-task-docs')
+
+
+def list_all_documents(
+    collection_id: str,
+    queries: List[str],
+    db: Databases
+) -> List[Dict[str, Any]]:
+    """
+    使用游标分页获取满足条件的全部文档（避免 Query.limit 静默截断）
+    
+    Args:
+        collection_id: 集合ID
+        queries: 查询条件（不含 limit / cursor）
+        db: 数据库服务
+        
+    Returns:
+        文档列表
+    """
+    documents = []
+    last_id = None
+    
+    while True:
+        page_queries = [*queries, _Q_PAGE_LIMIT]
+        if last_id:
+            page_queries.append(Query.cursor_after(last_id))
+        
+        response = db.list_documents('main', collection_id, queries=page_queries)
+        page = response['documents']
+        documents.extend(page)
+        
+        if len(page) < PAGE_SIZE:
+            break
+        last_id = page[-1]['$id']
+    
+    return documents
+
+
+def delete_daily_tasks(queries: List[str], db: Databases) -> int:
+    """
+    按查询条件删除 daily_tasks 记录
+    
+    优先使用 Appwrite 批量删除接口（一次请求）；
+    SDK 或服务端不支持时，回退为查询后并发逐条删除。
+    
+    Args:
+        queries: 查询条件
+        db: 数据库服务
+        
+    Returns:
+        删除的任务数量
+    """
+    delete_documents = getattr(db, 'delete_documents', None)
+    if delete_documents is not None:
+        try:
+            response = delete_documents('main', 'daily_tasks', queries=queries)
+            return response.get('total', 0)
+        except Exception as e:
+            logger.debug(f"批量删除不可用，回退为逐条删除: {e}")
+    
+    response = db.list_documents(
+        'main',
+        'daily_tasks',
+        queries=[*queries, _Q_DELETE_FALLBACK_LIMIT]
+    )
+    task_ids = [task['$id'] for task in response['documents']]
+    
+    def delete_one(task_id: str) -> str | None:
+        """删除单个任务，失败时返回错误信息而不是抛出，避免中断其他删除"""
+        try:
+            db.delete_document('main', 'daily_tasks', task_id)
+            return None
+        except Exception as e:
+            return f"{task_id}: {e}"
+    
+    errors = [error for error in _DOCUMENT_POOL.map(delete_one, task_ids) if error]
+    
+    if errors:
+        logger.warning(f"删除任务失败 {len(errors)}/{len(task_ids)} 个: {'; '.join(errors)}")
+    
+    return len(task_ids) - len(errors)
+
+
+def iter_active_users(db: Databases) -> Iterator[Dict[str, Any]]:
     """
-    获取活跃用户列表
+    逐页获取活跃用户（游标分页，调用方可边获取边处理）
     活跃定义：最近7天内有活动
     
+    完整遍历后结果会在 Redis 中缓存 ACTIVE_USERS_TTL 秒（如已配置），
+    查询中途失败时不写入缓存
+    
+    Args:
+        db: 数据库服务
+        
+    Yields:
+        活跃用户档案
+    """
+    cached_users = cache_get(ACTIVE_USERS_KEY)
+    if cached_users is not None:
+        yield from cached_users
+        return
+    
+    seven_days_ago = (datetime.now() - timedelta(days=7)).isoformat()
+    
+    users = []
+    last_id = None
+    
+    while True:
+        queries = [Query.greater_than('lastActiveAt', seven_days_ago), _Q_PAGE_LIMIT]
+        if last_id:
+            queries.append(Query.cursor_after(last_id))
+        
+        try:
+            response = db.list_documents('main', 'profiles', queries=queries)
+        except Exception as e:
+            logger.error(f"获取活跃用户失败: {e}")
+            return
+        
+        documents = response['documents']
+        users.extend(documents)
+        yield from documents
+        
+        if len(documents) < PAGE_SIZE:
+            break
+        last_id = documents[-1]['$id']
+    
+    cache_set(ACTIVE_USERS_KEY, users, ACTIVE_USERS_TTL)
+
+
+def get_active_users(db: Databases) -> List[Dict[str, Any]]:
+    """
+    获取活跃用户列表（一次性获取全部，见 iter_active_users）
+    
     Args:
         db: 数据库服务
         
     Returns:
         活跃用户列表
     """
-    seven_days_ago = (datetime.now() - timedelta(days=7)).isoformat()
+    return list(iter_active_users(db))
+
+
+def _is_task_for_today(task: Dict[str, Any], now: datetime, user_timezone: str) -> bool:
+    """
+    判断任务是否为用户时区的今天生成（taskDate 以 UTC 时间存储）
     
+    Args:
+        task: 每日任务文档
+        now: 当前时间（带时区）
+        user_timezone: 用户时区
+        
+    Returns:
+        是否为今天的任务，taskDate 缺失或无法解析时返回 False
+    """
     try:
-        response = db.list_documents(
-            'main',
-            'profiles',
-            queries=[
-                Query.greater_than('lastActiveAt', seven_days_ago),
-                Query.limit(1000)  # 批量处理
-            ]
-        )
+        task_datetime = _fast_parse_iso(task['taskDate'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    
+    return is_same_date_in_user_timezone(task_datetime, now, user_timezone)
+
+
+def get_users_with_today_task(users: Iterable[Dict[str, Any]], db: Databases) -> Set[str]:
+    """
+    批量检查哪些用户今天（按各自时区）已生成任务
+    
+    只查询最近两天的任务（覆盖所有时区的"今天"），在本地按用户时区比较日期
+    
+    Args:
+        users: 用户档案列表
+        db: 数据库服务
         
-        return response['documents']
+    Returns:
+        今天已有任务的用户ID集合，查询失败时返回空集合（由单用户流程再次检查）
+    """
+    timezone_by_user = {
+        user['userId']: user.get('timezone', 'Asia/Shanghai')
+        for user in users
+        if user.get('userId')
+    }
+    if not timezone_by_user:
+        return set()
+    
+    now = datetime.now(timezone.utc)
+    since = (now - timedelta(days=2)).isoformat()
+    user_ids = list(timezone_by_user)
+    users_with_task = set()
+    
+    try:
+        for i in range(0, len(user_ids), QUERY_ID_CHUNK_SIZE):
+            tasks = list_all_documents(
+                'daily_tasks',
+                [
+                    Query.equal('userId', user_ids[i:i + QUERY_ID_CHUNK_SIZE]),
+                    Query.greater_than('taskDate', since),
+                    _Q_SELECT_TASK_OWNER_FIELDS
+                ],
+                db
+            )
+            for task in tasks:
+                user_id = task.get('userId')
+                if user_id in users_with_task or user_id not in timezone_by_user:
+                    continue
+                if _is_task_for_today(task, now, timezone_by_user[user_id]):
+                    users_with_task.add(user_id)
     except Exception as e:
-        logger.error(f"获取活跃用户失败: {e}")
-        return []
+        logger.warning(f"批量检查今日任务失败: {e}")
+        return set()
+    
+    return users_with_task
+
+
+def _list_documents_by_kp(
+    collection_id: str,
+    kp_ids: List[str],
+    per_kp_limit: int,
+    db: Databases,
+    extra_queries: List[str] = None
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    一次查询多个知识点的关联文档，并按知识点分组
+    
+    按创建时间倒序游标分页，直到每个知识点都取满 per_kp_limit 个或没有更多文档，
+    结果与逐个知识点查询最近的 per_kp_limit 个文档一致（某个知识点文档很多时不会挤占其他知识点）。
+    翻页时只查询仍未取满的知识点：每个满页至少取满一个知识点，翻页次数不超过知识点数
+    
+    Args:
+        collection_id: 集合ID（文档需包含 knowledgePointIds 字段）
+        kp_ids: 知识点ID列表
+        per_kp_limit: 每个知识点最多保留的文档数
+        db: 数据库服务
+        extra_queries: 额外的查询条件
+        
+    Returns:
+        {kp_id: [document, ...]}（每个知识点的文档按创建时间倒序）
+    """
+    docs_by_kp = {kp_id: [] for kp_id in kp_ids}
+    
+    for i in range(0, len(kp_ids), QUERY_ID_CHUNK_SIZE):
+        # 文档分布均匀时第一页即可取满所有知识点
+        unfilled = kp_ids[i:i + QUERY_ID_CHUNK_SIZE]
+        chunk_buckets = {kp_id: docs_by_kp[kp_id] for kp_id in unfilled}
+        last_id = None
+        
+        while unfilled:
+            page_limit = per_kp_limit * len(unfilled)
+            queries = [
+                *(extra_queries or []),
+                Query.contains('knowledgePointIds', unfilled),
+                _Q_ORDER_CREATED_DESC,
+                Query.limit(page_limit)
+            ]
+            if last_id:
+                queries.append(Query.cursor_after(last_id))
+            
+            page = db.list_documents('main', collection_id, queries=queries)['documents']
+            for doc in page:
+                for kp_id in doc.get('knowledgePointIds') or []:
+                    bucket = chunk_buckets.get(kp_id)
+                    if bucket is not None and len(bucket) < per_kp_limit:
+                        bucket.append(doc)
+            
+            if len(page) < page_limit:
+                break
+            last_id = page[-1]['$id']
+            unfilled = [kp_id for kp_id in unfilled if len(chunk_buckets[kp_id]) < per_kp_limit]
+    
+    return docs_by_kp
+
+
+def fetch_user_kps_by_ids(
+    kp_ids: List[str],
+    db: Databases
+) -> Dict[str, Dict[str, Any]]:
+    """
+    批量获取用户知识点（避免逐个 get_document 的 N+1 查询）
+    
+    Args:
+        kp_ids: 知识点ID列表
+        db: 数据库服务
+        
+    Returns:
+        {kp_id: user_kp} 字典，查询失败或不存在的知识点不包含在内
+    """
+    unique_ids = list(dict.fromkeys(kp_id for kp_id in kp_ids if kp_id))
+    user_kps_by_id = {}
+    
+    for i in range(0, len(unique_ids), QUERY_ID_CHUNK_SIZE):
+        chunk = unique_ids[i:i + QUERY_ID_CHUNK_SIZE]
+        try:
+            response = db.list_documents(
+                'main',
+                'user_knowledge_points',
+                queries=[
+                    Query.equal('$id', chunk),
+                    Query.limit(len(chunk))
+                ]
+            )
+        except Exception as e:
+            logger.error(f"批量获取知识点失败: {len(chunk)} 个, 错误: {e}")
+            continue
+        
+        for user_kp in response['documents']:
+            user_kps_by_id[user_kp['$id']] = user_kp
+    
+    return user_kps_by_id
 
 
 def select_knowledge_points(
     user_id: str,
     difficulty: str,
     user_timezone: str,
-    db: Databases
+    db: Databases,
+    today_date: date = None,
+    question_limits: tuple[int, int] = None
 ) -> List[Dict[str, Any]]:
     """
     为用户选择今日需要复习的知识点
@@ -70,27 +405,28 @@ def select_knowledge_points(
         difficulty: 难度设置 ('easy' | 'normal' | 'hard')
         user_timezone: 用户时区（如 'Asia/Shanghai'）
         db: 数据库服务
+        today_date: 用户时区的今天（可选），由调用方计算后传入，避免重复时区换算
+        question_limits: (min_questions, max_questions)（可选），未提供时按难度计算
         
     Returns:
         选中的知识点列表（带优先级）
     """
     # 使用用户时区的当前日期
-    today = get_user_timezone_date(user_timezone).isoformat()
+    if today_date is None:
+        today_date = get_user_timezone_date(user_timezone)
+    today = today_date.isoformat()
     
-    # 1. 获取到期的知识点
+    # 1. 获取到期的知识点（分页获取全部，后续通过粗排控制数据量）
     try:
-        response = db.list_documents(
-            'main',
+        review_states = list_all_documents(
             'review_states',
-            queries=[
+            [
                 Query.equal('userId', user_id),
                 Query.less_than_equal('nextReviewDate', today),
-                Query.equal('isActive', True),
-                Query.limit(100)
-            ]
+                _Q_IS_ACTIVE
+            ],
+            db
         )
-        
-        review_states = response['documents']
     except Exception as e:
         logger.error(f"查询复习状态失败: {e}")
         return []
@@ -99,84 +435,97 @@ def select_knowledge_points(
         logger.info(f"用户 {user_id} 没有到期的知识点")
         return []
     
-    # 2. 为每个知识点计算优先级
-    kp_with_priority = []
+    min_questions, max_questions = question_limits or get_question_limits(difficulty)
+    
+    # 2. 批量获取各知识点信息，计算粗略优先级（不需要错题和题目）
+    user_kps_by_id = fetch_user_kps_by_ids(
+        [rs.get('knowledgePointId') for rs in review_states],
+        db
+    )
     
+    bundles = []
     for rs in review_states:
         knowledge_point_id = rs.get('knowledgePointId')
-        if not knowledge_point_id:
-            continue
-        
-        try:
-            # 获取用户知识点信息
-            user_kp = db.get_document('main', 'user_knowledge_points', knowledge_point_id)
-            
-            # 获取相关错题
-            mistakes_response = db.list_documents(
-                'main',
-                'mistake_records',
-                queries=[
-                    Query.equal('userId', user_id),
-                    Query.contains('knowledgePointIds', knowledge_point_id),
-                    Query.not_equal('masteryStatus', 'mastered'),
-                    Query.limit(50)
-                ]
-            )
-            mistakes = mistakes_response['documents']
-            
-            # 获取知识点相关的题目（用于计算重要度）
-            questions_response = db.list_documents(
-                'main',
-                'questions',
-                queries=[
-                    Query.contains('knowledgePointIds', knowledge_point_id),
-                    Query.limit(20)
-                ]
-            )
-            questions = questions_response['documents']
-            
-            # 计算优先级（传入用户时区的今天）
-            today_date = get_user_timezone_date(user_timezone)
-            priority = calculate_priority(rs, user_kp, mistakes, questions, today_date)
-            
-            kp_with_priority.append({
-                'review_state': rs,
-                'user_kp': user_kp,
-                'mistakes': mistakes,
-                'priority': priority
-            })
-            
-        except Exception as e:
-            logger.error(f"处理知识点 {knowledge_point_id} 失败: {e}")
+        user_kp = user_kps_by_id.get(knowledge_point_id)
+        if user_kp is None:
+            logger.debug(f"知识点 {knowledge_point_id} 不存在，跳过")
             continue
+        bundles.append((rs, user_kp))
     
-    if not kp_with_priority:
+    if not bundles:
         return []
     
-    # 3. 按优先级排序
-    kp_with_priority.sort(key=lambda x: x['priority'], reverse=True)
+    # 只为粗排靠前的知识点获取错题和题目，排名靠后的知识点不会被选中
+    # 只需前 K 个，用堆选择代替全量排序（结果与排序后切片一致）
+    candidates = heapq.nlargest(
+        max_questions * CANDIDATE_KP_FACTOR,
+        bundles,
+        key=lambda b: calculate_coarse_priority(b[0], b[1], today_date)
+    )
     
-    # 4. 动态选择知识点（根据题量上限）
-    min_questions, max_questions = get_question_limits(difficulty)
+    # 3. 批量获取候选知识点的相关错题和题目（用于计算重要度）
+    kp_ids = list(dict.fromkeys(rs['knowledgePointId'] for rs, _ in candidates))
+    
+    try:
+        mistakes_by_kp = _list_documents_by_kp(
+            'mistake_records',
+            kp_ids,
+            50,
+            db,
+            extra_queries=[
+                Query.equal('userId', user_id),
+                _Q_NOT_MASTERED,
+                _Q_SELECT_MISTAKE_FIELDS
+            ]
+        )
+        questions_by_kp = _list_documents_by_kp(
+            'questions',
+            kp_ids,
+            20,
+            db,
+            extra_queries=[_Q_SELECT_QUESTION_FIELDS]
+        )
+    except Exception as e:
+        logger.error(f"批量查询知识点错题/题目失败: {e}")
+        return []
+    
+    # 4. 计算完整优先级并排序
+    # 以 (priority, kp_data) 元组排序，比较时无需再查字典
+    kp_with_priority = []
+    
+    for rs, user_kp in candidates:
+        kp_id = rs['knowledgePointId']
+        mistakes = mistakes_by_kp.get(kp_id, [])
+        questions = questions_by_kp.get(kp_id, [])
+        
+        # 计算优先级（传入用户时区的今天）
+        priority = calculate_priority(rs, user_kp, mistakes, questions, today_date)
+        
+        kp_with_priority.append((priority, {
+            'review_state': rs,
+            'user_kp': user_kp,
+            'mistakes': mistakes,
+            'priority': priority
+        }))
+    
+    # 每个知识点至少 1 道题，贪心选择最多选中 max_questions 个知识点
+    kp_with_priority = heapq.nlargest(max_questions, kp_with_priority, key=itemgetter(0))
+    
+    # 5. 动态选择知识点（根据题量上限）
     
     selected = []
     total_questions = 0
     
-    for kp_data in kp_with_priority:
+    for _, kp_data in kp_with_priority:
         status = kp_data['review_state'].get('status', 'newLearning')
         estimated = estimate_question_count(status, difficulty)
         
-        # 如果加上这个知识点还在上限内，就选择它
-        if total_questions + estimated <= max_questions:
-            selected.append(kp_data)
-            total_questions += estimated
-        elif total_questions < min_questions:
-            # 还没达到下限，继续添加
-            selected.append(kp_data)
-            total_questions += estimated
-        else:
-            # 已达到合适题量，停止添加
+        # 超出上限且已达到下限时停止添加；否则（仍在上限内，或还没达到下限）选择它
+        if total_questions + estimated > max_questions and total_questions >= min_questions:
             break
+        
+        selected.append(kp_data)
+        total_questions += estimated
     
     logger.info(
         f"用户 {user_id} 选择了 {len(selected)} 个知识点，"
@@ -190,7 +539,8 @@ def generate_task_items(
     selected_kps: List[Dict[str, Any]],
     difficulty: str,
     db: Databases,
-    user_id: str = None
+    user_id: str = None,
+    question_cache: QuestionCache = None
 ) -> tuple[List[Dict[str, Any]], Dict[str, Any]]:
     """
     为选中的知识点生成任务项
@@ -207,14 +557,20 @@ def generate_task_items(
         difficulty: 难度设置
         db: 数据库服务
         user_id: 用户ID（用于记录变式题生成需求）
+        question_cache: 题目缓存（可选），各知识点选题时共享
         
     Returns:
         (任务项列表, shortage_tracker字典)
         - 任务项列表：每项可能关联多个知识点
         - shortage_tracker：记录需要生成变式题的源题目
     """
-    # 第一步：为每个知识点独立选题
-    kp_question_map = {}  # {kp_id: {'questions': [...], 'kp_data': {...}}}
+    if question_cache is None:
+        question_cache = QuestionCache(db)
+    
+    # 第一步：为每个知识点独立选题，并按题目ID分组
+    # 一道题如果被多个知识点选中，只记录一次来源信息，并累积关联的知识点
+    kp_info_by_id = {}  # {kp_id: {'knowledgePointId', 'knowledgePointName', 'status'}}
+    question_entries = {}  # {question_id: _QuestionEntry}
     shortage_tracker = {}  # 记录需要生成变式题的源题目
     
     for kp_data in selected_kps:
@@ -233,7 +589,8 @@ def generate_task_items(
                 estimate_question_count(status, difficulty),
                 db,
                 exclude_question_ids=None,  # 不排除重复
-                knowledge_point_id=kp_id  # 传入知识点ID用于优先级排序
+                knowledge_point_id=kp_id,  # 传入知识点ID用于优先级排序
+                question_cache=question_cache
             )
             
         elif status == 'reviewing':
@@ -246,7 +603,8 @@ def generate_task_items(
                 original_count,
                 db,
                 exclude_question_ids=None,  # 不排除重复
-                knowledge_point_id=kp_id  # 传入知识点ID用于优先级排序
+                knowledge_point_id=kp_id,  # 传入知识点ID用于优先级排序
+                question_cache=question_cache
             )
             
             variant_questions = select_variant_questions(
@@ -254,7 +612,8 @@ def generate_task_items(
                 estimate_question_count(status, difficulty) - len(original_questions),
                 db,
                 exclude_question_ids=None,  # 不排除重复
-                shortage_tracker=shortage_tracker  # 传入 shortage_tracker
+                shortage_tracker=shortage_tracker,  # 传入 shortage_tracker
+                question_cache=question_cache
             )
             
         elif status == 'mastered':
@@ -264,73 +623,45 @@ def generate_task_items(
                 estimate_question_count(status, difficulty),
                 db,
                 exclude_question_ids=None,  # 不排除重复
-                shortage_tracker=shortage_tracker  # 传入 shortage_tracker
+                shortage_tracker=shortage_tracker,  # 传入 shortage_tracker
+                question_cache=question_cache
             )
         
-        # 保存该知识点的题目
-        kp_question_map[kp_id] = {
-            'original_questions': original_questions,
-            'variant_questions': variant_questions,
-            'kp_data': kp_data
+        # 记录知识点信息，并将选中的题目按题目ID合并
+        kp_info_by_id[kp_id] = {
+            'knowledgePointId': kp_id,
+            'knowledgePointName': kp_data['user_kp'].get('name'),
+            'status': status
         }
+        
+        for source, questions in (('original', original_questions), ('variant', variant_questions)):
+            for q in questions:
+                entry = question_entries.get(q['$id'])
+                if entry is None:
+                    entry = question_entries[q['$id']] = _QuestionEntry(
+                        source=source,
+                        mistake_id=q.get('mistakeId') if source == 'original' else None,
+                        kp_ids={}
+                    )
+                # 用字典作有序集合：同一知识点重复选中同一道题时只关联一次
+                entry.kp_ids[kp_id] = None
     
-    # 第二步：按题目ID分组，找出哪些题目对应多个知识点
-    question_to_kps = {}  # {question_id: [kp_id1, kp_id2, ...]}
-    question_details = {}  # {question_id: {'question': {...}, 'source': 'original'/'variant', 'mistakeId': ...}}
-    
-    for kp_id, data in kp_question_map.items():
-        # 处理原题
-        for q in data['original_questions']:
-            q_id = q['$id']
-            if q_id not in question_to_kps:
-                question_to_kps[q_id] = []
-                question_details[q_id] = {
-                    'question': q,
-                    'source': 'original',
-                    'mistakeId': q.get('mistakeId')
-                }
-            question_to_kps[q_id].append(kp_id)
-        
-        # 处理变式题
-        for q in data['variant_questions']:
-            q_id = q['$id']
-            if q_id not in question_to_kps:
-                question_to_kps[q_id] = []
-                question_details[q_id] = {
-                    'question': q,
-                    'source': 'variant'
-                }
-            question_to_kps[q_id].append(kp_id)
-    
-    # 第三步：为每道题创建任务项，关联所有相关知识点
+    # 第二步：为每道题创建任务项，关联所有相关知识点
     task_items = []
     
-    for q_id, kp_ids in question_to_kps.items():
-        q_detail = question_details[q_id]
-        
-        # 收集所有相关知识点的信息
-        kp_infos = []
-        for kp_id in kp_ids:
-            kp_data = kp_question_map[kp_id]['kp_data']
-            kp_infos.append({
-                'knowledgePointId': kp_id,
-                'knowledgePointName': kp_data['user_kp'].get('name'),
-                'status': kp_data['review_state'].get('status', 'newLearning')
-            })
-        
-        # 构建任务项
+    for q_id, entry in question_entries.items():
         task_item = {
-            'id': str(uuid.uuid4()),
+            'id': uuid.uuid4().hex,
             'questionId': q_id,
-            'source': q_detail['source'],
-            'knowledgePoints': kp_infos,  # 新字段：关联的所有知识点
+            'source': entry.source,
+            'knowledgePoints': [kp_info_by_id[kp_id] for kp_id in entry.kp_ids],  # 新字段：关联的所有知识点
             'isCompleted': False,
             'isCorrect': None
         }
         
         # 如果是原题，添加错题记录ID
-        if q_detail.get('mistakeId'):
-            task_item['mistakeRecordId'] = q_detail['mistakeId']
+        if entry.mistake_id:
+            task_item['mistakeRecordId'] = entry.mistake_id
         
         task_items.append(task_item)
     
@@ -364,7 +695,7 @@ def generate_ai_message(kp_data: Dict[str, Any]) -> str:
 
 
 def trigger_variant_generation(
-    user_id: str,
+    user: Dict[str, Any],
     shortage_tracker: Dict[str, Any],
     db: Databases
 ):
@@ -378,30 +709,18 @@ def trigger_variant_generation(
     - 生成的新题下次任务生成时可用
     
     Args:
-        user_id: 用户ID
+        user: 用户档案数据（get_active_users 已获取，无需重新查询 profiles）
         shortage_tracker: 题目不足追踪器，格式：{question_id: {knowledge_point_id, variants_needed}}
         db: 数据库服务
     """
     if not shortage_tracker:
         return
     
+    user_id = user.get('userId')
+    
     try:
         # 检查用户是否为会员（只有会员才能生成变式题）
-        profiles = db.list_documents(
-            'main',
-            'profiles',
-            queries=[
-                Query.equal('userId', user_id),
-                Query.limit(1)
-            ]
-        )
-        
-        if not profiles['documents']:
-            logger.warning(f"用户 {user_id} 档案不存在，跳过变式题生成")
-            return
-        
-        profile = profiles['documents'][0]
-        subscription_status = profile.get('subscriptionStatus', 'free')
+        subscription_status = user.get('subscriptionStatus', 'free')
         
         # 只有活跃会员才触发生成
         if subscription_status != 'active':
@@ -409,10 +728,9 @@ def trigger_variant_generation(
             return
         
         # 检查会员是否过期
-        expiry_date = profile.get('subscriptionExpiryDate')
+        expiry_date = user.get('subscriptionExpiryDate')
         if expiry_date:
-            from datetime import timezone
-            expiry_datetime = datetime.fromisoformat(expiry_date.replace('Z', '+00:00'))
+            expiry_datetime = _fast_parse_iso(expiry_date)
             if expiry_datetime <= datetime.now(timezone.utc):
                 logger.info(f"用户 {user_id} 会员已过期，跳过变式题生成")
                 return
@@ -420,23 +738,21 @@ def trigger_variant_generation(
         # 批量创建变式题生成任务
         # 策略：将多个源题目合并为一个任务，减少数据库操作
         source_question_ids = list(shortage_tracker.keys())
+        variant_counts = [info['variants_needed'] for info in shortage_tracker.values()]
         
         # 限制每个任务最多处理10个源题目（避免单个任务太大）
         batch_size = 10
+        tasks_data = []
         for i in range(0, len(source_question_ids), batch_size):
             batch_ids = source_question_ids[i:i + batch_size]
             
             # 计算总题目数（每个源题目生成的变式数）
-            total_variants = sum(
-                shortage_tracker[qid]['variants_needed'] 
-                for qid in batch_ids
-            )
+            total_variants = sum(variant_counts[i:i + batch_size])
             
             # 使用统一的 variants_per_question（取平均值）
             avg_variants = max(1, total_variants // len(batch_ids))
             
-            # 创建任务记录
-            task_data = {
+            tasks_data.append({
                 'userId': user_id,
                 'type': 'variant',
                 'status': 'pending',
@@ -445,8 +761,10 @@ def trigger_variant_generation(
                 'totalCount': len(batch_ids) * avg_variants,
                 'completedCount': 0,
                 'generatedQuestionIds': []
-            }
-            
+            })
+        
+        def create_task(task_data: Dict[str, Any]):
+            """创建单个任务记录，失败时记录日志并继续处理其他批次"""
             try:
                 task = db.create_document(
                     'main',
@@ -457,12 +775,14 @@ def trigger_variant_generation(
                 
                 logger.info(
                     f"✓ 为用户 {user_id} 创建变式题生成任务: {task['$id']}, "
-                    f"源题目数: {len(batch_ids)}, 预计生成: {len(batch_ids) * avg_variants} 题"
+                    f"源题目数: {len(task_data['sourceQuestionIds'])}, "
+                    f"预计生成: {task_data['totalCount']} 题"
                 )
             except Exception as e:
                 logger.error(f"创建变式题生成任务失败: {e}")
-                # 继续处理下一批
-                continue
+        
+        # 逐条创建（每条记录的 create 事件会触发 trigger function），并发执行以重叠网络等待
+        list(_DOCUMENT_POOL.map(create_task, tasks_data))
         
         logger.info(
             f"成功为用户 {user_id} 触发变式题生成，"
@@ -495,100 +815,108 @@ def generate_daily_task_for_user(
     user_id = user.get('userId')
     difficulty = user.get('dailyTaskDifficulty', 'normal')
     user_timezone = user.get('timezone', 'Asia/Shanghai')  # 获取用户时区
+    min_questions, max_questions = get_question_limits(difficulty)
     
-    # 使用用户时区的当前日期
-    today = get_user_timezone_date(user_timezone)
-    today_str = today.isoformat()
+    # 使用用户时区的当前时间和日期（整个生成过程共用）
+    now = get_user_timezone_datetime(user_timezone)
+    today = now.date()
+    
+    # 1. 一次查询用户最近的任务，在本地区分过期任务、未完成任务和今日任务
+    seven_days_ago = (today - timedelta(days=7)).isoformat()
     
-    # 1. 清理过期的未完成任务（超过7天）
     try:
-        seven_days_ago = (today - timedelta(days=7)).isoformat()
-        
-        old_tasks_response = db.list_documents(
+        recent_response = db.list_documents(
             'main',
             'daily_tasks',
             queries=[
                 Query.equal('userId', user_id),
-                Query.equal('isCompleted', False),
-                Query.less_than('taskDate', seven_days_ago),
-                Query.limit(50)
+                _Q_ORDER_TASK_DATE_DESC,
+                _Q_RECENT_TASKS_LIMIT,
+                _Q_SELECT_TASK_FIELDS
             ]
         )
-        
-        # 删除过期任务
-        for task in old_tasks_response['documents']:
-            db.delete_document('main', 'daily_tasks', task['$id'])
-            logger.info(f"删除过期任务: {task['$id']} (日期: {task.get('taskDate')})")
-            
+        recent_tasks = recent_response['documents']
     except Exception as e:
-        logger.warning(f"清理过期任务失败: {e}")
+        logger.warning(f"查询用户已有任务失败: {e}")
+        recent_tasks = []
+    
+    # taskDate 以 UTC 时间存储，取日期部分与 seven_days_ago 比较
+    stale_tasks = []
+    uncompleted_tasks = []  # 按日期倒序
+    for task in recent_tasks:
+        if task.get('isCompleted'):
+            continue
+        if (task.get('taskDate') or '')[:10] < seven_days_ago:
+            stale_tasks.append(task)
+        else:
+            uncompleted_tasks.append(task)
+    
+    # 2. 清理过期的未完成任务（超过7天）
+    # 查询结果已满时，更早的过期任务可能不在结果中，同样按条件删除
+    if stale_tasks or len(recent_tasks) >= RECENT_TASKS_LIMIT:
+        try:
+            deleted_count = delete_daily_tasks(
+                [
+                    Query.equal('userId', user_id),
+                    _Q_NOT_COMPLETED,
+                    Query.less_than('taskDate', seven_days_ago)
+                ],
+                db
+            )
+            if deleted_count:
+                logger.info(f"删除过期任务: {deleted_count} 个 (早于 {seven_days_ago})")
+                
+        except Exception as e:
+            logger.warning(f"清理过期任务失败: {e}")
     
-    # 2. 检查未完成任务，但不完全阻止新任务生成
+    # 3. 检查未完成任务，但不完全阻止新任务生成
     # 策略：如果有太多旧的未完成任务，清理掉最旧的，确保用户始终能获得新任务
-    try:
-        uncompleted_response = db.list_documents(
-            'main',
-            'daily_tasks',
-            queries=[
-                Query.equal('userId', user_id),
-                Query.equal('isCompleted', False),
-                Query.order_desc('taskDate'),
-                Query.limit(10)
-            ]
-        )
+    uncompleted_count = len(uncompleted_tasks)
+    
+    # 如果有超过2个未完成任务，删除最旧的几个，只保留最近2个
+    # 这样确保用户始终能获得新任务，而不会因为历史遗留问题被永久阻止
+    if uncompleted_count >= 3:
+        # 按日期排序（最旧的在后面）
+        tasks_to_keep = 2
+        tasks_to_delete = uncompleted_tasks[tasks_to_keep:]
         
-        uncompleted_tasks = uncompleted_response['documents']
-        uncompleted_count = len(uncompleted_tasks)
-        
-        # 如果有超过2个未完成任务，删除最旧的几个，只保留最近2个
-        # 这样确保用户始终能获得新任务，而不会因为历史遗留问题被永久阻止
-        if uncompleted_count >= 3:
-            # 按日期排序（最旧的在后面）
-            tasks_to_keep = 2
-            tasks_to_delete = uncompleted_tasks[tasks_to_keep:]
-            
-            for task in tasks_to_delete:
-                try:
-                    db.delete_document('main', 'daily_tasks', task['$id'])
-                    logger.info(
-                        f"清理旧的未完成任务: {task['$id']} "
-                        f"(日期: {task.get('taskDate')}, 共 {task.get('totalQuestions', 0)} 题)"
-                    )
-                except Exception as del_e:
-                    logger.warning(f"删除旧任务失败: {del_e}")
-            
-            logger.info(
-                f"用户 {user_id} 有 {uncompleted_count} 个未完成任务，"
-                f"已清理 {len(tasks_to_delete)} 个旧任务，保留最近 {tasks_to_keep} 个"
+        try:
+            delete_daily_tasks(
+                [Query.equal('$id', [task['$id'] for task in tasks_to_delete])],
+                db
             )
-            
-    except Exception as e:
-        logger.warning(f"检查未完成任务数量失败: {e}")
-    
-    # 3. 检查今天是否已生成任务
-    try:
-        existing_response = db.list_documents(
-            'main',
-            'daily_tasks',
-            queries=[
-                Query.equal('userId', user_id),
-                Query.equal('taskDate', today_str)
-            ]
-        )
+            for task in tasks_to_delete:
+                logger.info(
+                    f"清理旧的未完成任务: {task['$id']} "
+                    f"(日期: {task.get('taskDate')}, 共 {task.get('totalQuestions', 0)} 题)"
+                )
+        except Exception as del_e:
+            logger.warning(f"删除旧任务失败: {del_e}")
         
-        if existing_response['documents']:
+        logger.info(
+            f"用户 {user_id} 有 {uncompleted_count} 个未完成任务，"
+            f"已清理 {len(tasks_to_delete)} 个旧任务，保留最近 {tasks_to_keep} 个"
+        )
+    
+    # 4. 检查今天是否已生成任务（taskDate 为 UTC 时间，按用户时区比较日期）
+    for task in recent_tasks:
+        if _is_task_for_today(task, now, user_timezone):
             logger.info(f"用户 {user_id} 今天已有任务，跳过生成")
             return {
                 'generated': False,
                 'reason': '今天已生成任务',
                 'total_questions': 0
             }
-            
-    except Exception as e:
-        logger.error(f"检查今日任务失败: {e}")
     
-    # 4. 选择知识点
-    selected_kps = select_knowledge_points(user_id, difficulty, user_timezone, db)
+    # 本次生成内共享的题目缓存
+    question_cache = QuestionCache(db)
+    
+    # 5. 选择知识点
+    selected_kps = select_knowledge_points(
+        user_id, difficulty, user_timezone, db,
+        today_date=today,
+        question_limits=(min_questions, max_questions)
+    )
     
     if not selected_kps:
         return {
@@ -597,8 +925,10 @@ def generate_daily_task_for_user(
             'total_questions': 0
         }
     
-    # 5. 生成任务项
-    task_items, shortage_tracker = generate_task_items(selected_kps, difficulty, db, user_id)
+    # 6. 生成任务项
+    task_items, shortage_tracker = generate_task_items(
+        selected_kps, difficulty, db, user_id, question_cache=question_cache
+    )
     
     if not task_items:
         return {
@@ -607,11 +937,10 @@ def generate_daily_task_for_user(
             'total_questions': 0
         }
     
-    # 6. 统计总题数（现在每个 task_item 就是一道题）
+    # 7. 统计总题数（现在每个 task_item 就是一道题）
     total_questions = len(task_items)
     
     # 检查题目数量是否合理
-    min_questions, max_questions = get_question_limits(difficulty)
     if total_questions < min_questions:
         logger.warning(
             f"用户 {user_id} 题目数量不足: {total_questions}/{min_questions}, "
@@ -620,18 +949,18 @@ def generate_daily_task_for_user(
         # 注意：不阻断任务生成，即使题目少于预期也继续
         # 少量的题目总比没有任务好
     
-    # 7. 构建任务文档
+    # 8. 构建任务文档
     # 使用用户时区的当前时间，并转换为UTC存储
     task_data = {
         'userId': user_id,
         'taskDate': get_user_timezone_iso_string(user_timezone),
-        'items': json.dumps(task_items, ensure_ascii=False),
+        'items': orjson.dumps(task_items).decode('utf-8'),
         'totalQuestions': total_questions,
         'completedCount': 0,
         'isCompleted': False
     }
     
-    # 8. 保存到数据库
+    # 9. 保存到数据库
     try:
         db.create_document(
             'main',
@@ -648,7 +977,7 @@ def generate_daily_task_for_user(
             'total_questions': 0
         }
     
-    # 9. nextReviewDate 由前端在用户完成任务并提交反馈后更新
+    # 10. nextReviewDate 由前端在用户完成任务并提交反馈后更新
     # 任务生成器只负责查询到期的知识点和生成任务
     # 通过以下机制控制任务生成：
     #   - 自动清理多余的未完成任务（保留最近2个）
@@ -658,7 +987,7 @@ def generate_daily_task_for_user(
     # 10. 异步触发变式题生成（如果有需要）
     if shortage_tracker:
         try:
-            trigger_variant_generation(user_id, shortage_tracker, db)
+            trigger_variant_generation(user, shortage_tracker, db)
         except Exception as e:
             # 变式题生成失败不影响主流程
             logger.warning(f"触发变式题生成失败（不影响任务生成）: {e}")
@@ -0,0 +1,144 @@
+"""
+测试变式题缺口记录：_record_variant_generation_need 写入 shortage_tracker 的源题目和数量
+
+不需要网络和数据库（题目预先写入 QuestionCache），直接运行：
+python workers/daily_task_generator/test_shortage_tracker.py
+"""
+import os
+import sys
+
+# 添加 worker 目录以导入 workers 包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from workers.daily_task_generator.question_selector import (
+    QuestionCache,
+    _record_variant_generation_need
+)
+
+
+KP_ID = 'kp_1'
+
+
+def _question(question_id: str, quality_score: float = 4.5, primary: bool = False) -> dict:
+    return {
+        '$id': question_id,
+        'qualityScore': quality_score,
+        'primaryKnowledgePointIds': [KP_ID] if primary else []
+    }
+
+
+def _mistake(question_id: str, created_at: str) -> dict:
+    return {'$id': f'm_{question_id}', 'questionId': question_id, '$createdAt': created_at}
+
+
+def _record(questions, mistakes, shortage: int, shortage_tracker: dict = None) -> dict:
+    """题目全部预先放入缓存，不访问数据库"""
+    if shortage_tracker is None:
+        shortage_tracker = {}
+    question_cache = QuestionCache(db=None)
+    question_cache.put_many(questions)
+    _record_variant_generation_need(KP_ID, mistakes, shortage, shortage_tracker, None, question_cache)
+    return shortage_tracker
+
+
+def _variants(shortage_tracker: dict) -> dict:
+    return {qid: info['variants_needed'] for qid, info in shortage_tracker.items()}
+
+
+def test_shortage_split_across_sources():
+    """缺口按每道源题目最多 3 道变式题分配，最后一道只补剩余部分"""
+    questions = [_question(f'q{i}') for i in range(4)]
+    mistakes = [_mistake(f'q{i}', f'2025-01-0{i + 1}T00:00:00.000+00:00') for i in range(4)]
+
+    tracker = _record(questions, mistakes, shortage=7)
+
+    # 质量分相同时按错题时间从新到旧
+    assert _variants(tracker) == {'q3': 3, 'q2': 3, 'q1': 1}
+    assert all(info['knowledge_point_id'] == KP_ID for info in tracker.values())
+
+
+def test_shortage_exact_multiple():
+    """缺口正好是 3 的倍数时不多选源题目"""
+    questions = [_question(f'q{i}') for i in range(4)]
+    mistakes = [_mistake(f'q{i}', f'2025-01-0{i + 1}T00:00:00.000+00:00') for i in range(4)]
+
+    tracker = _record(questions, mistakes, shortage=6)
+
+    assert _variants(tracker) == {'q3': 3, 'q2': 3}
+
+
+def test_shortage_skips_sources_tracked_by_other_kp():
+    """已被其他知识点记录的源题目跳过、保持原记录，本知识点的缺口由后面的源题目补齐"""
+    questions = [_question(f'q{i}') for i in range(4)]
+    mistakes = [_mistake(f'q{i}', f'2025-01-0{i + 1}T00:00:00.000+00:00') for i in range(4)]
+    existing = {'q3': {'knowledge_point_id': 'kp_other', 'variants_needed': 2}}
+
+    tracker = _record(questions, mistakes, shortage=5, shortage_tracker=existing)
+
+    assert tracker['q3'] == {'knowledge_point_id': 'kp_other', 'variants_needed': 2}
+    assert _variants(tracker) == {'q3': 2, 'q2': 3, 'q1': 2}
+
+
+def test_shortage_not_enough_sources():
+    """源题目不够时尽量记录，不重复记录同一道题"""
+    questions = [_question('q0'), _question('q1')]
+    mistakes = [
+        _mistake('q0', '2025-01-01T00:00:00.000+00:00'),
+        _mistake('q1', '2025-01-02T00:00:00.000+00:00')
+    ]
+
+    tracker = _record(questions, mistakes, shortage=10)
+
+    assert _variants(tracker) == {'q1': 3, 'q0': 3}
+
+
+def test_shortage_prefers_primary_and_quality():
+    """低质量题目（< 4.0）不作为源题目；主要知识点题目优先，其次质量分高的"""
+    questions = [
+        _question('low', quality_score=3.9, primary=True),
+        _question('high', quality_score=5.0),
+        _question('primary', quality_score=4.0, primary=True),
+        _question('normal', quality_score=4.5)
+    ]
+    mistakes = [_mistake(q['$id'], '2025-01-01T00:00:00.000+00:00') for q in questions]
+
+    tracker = _record(questions, mistakes, shortage=7)
+
+    assert list(tracker) == ['primary', 'high', 'normal']
+    assert _variants(tracker) == {'primary': 3, 'high': 3, 'normal': 1}
+
+
+def test_shortage_no_candidates():
+    """没有合适的源题目时不修改 shortage_tracker"""
+    questions = [_question('q0', quality_score=2.0)]
+    mistakes = [_mistake('q0', '2025-01-01T00:00:00.000+00:00'), {'$id': 'm_none'}]
+
+    tracker = _record(questions, mistakes, shortage=3)
+
+    assert tracker == {}
+
+
+def main():
+    """运行全部测试"""
+    tests = [(name, func) for name, func in globals().items() if name.startswith('test_') and callable(func)]
+
+    print("=" * 60)
+    print("测试变式题缺口记录")
+    print("=" * 60)
+
+    failed = 0
+    for name, func in tests:
+        try:
+            func()
+            print(f"✅ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ {name}: {e!r}")
+
+    print("=" * 60)
+    print(f"通过 {len(tests) - failed}/{len(tests)}")
+    return failed == 0
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -1,9 +1,33 @@
 """
 时区处理工具函数
 """
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from typing import Optional
-import pytz
+
+
+# 中国没有夏令时，默认时区 Asia/Shanghai 可以用固定的 UTC+8 偏移表示（不需要查 pytz 的时区转换表）
+_SHANGHAI_TZ = timezone(timedelta(hours=8), 'CST')
+
+
+@lru_cache(maxsize=None)
+def _get_timezone(user_timezone: str):
+    """
+    获取时区对象（带缓存，同一时区只解析一次）
+    
+    Asia/Shanghai 直接返回固定偏移时区；其他时区才延迟导入 pytz（避免冷启动时加载时区数据）
+    
+    Args:
+        user_timezone: 时区字符串，如 'Asia/Shanghai'
+        
+    Returns:
+        时区对象，无效时区抛出 pytz.UnknownTimeZoneError
+    """
+    if user_timezone == 'Asia/Shanghai':
+        return _SHANGHAI_TZ
+    
+    import pytz
+    return pytz.timezone(user_timezone)
 
 
 def get_user_timezone_datetime(user_timezone: Optional[str] = None) -> datetime:
@@ -16,18 +40,17 @@ def get_user_timezone_datetime(user_timezone: Optional[str] = None) -> datetime:
     Returns:
         用户时区的当前时间
     """
-    if not user_timezone:
+    if not user_timezone or user_timezone == 'Asia/Shanghai':
         # 如果没有设置时区，默认使用 Asia/Shanghai (UTC+8)
-        user_timezone = 'Asia/Shanghai'
+        return datetime.now(_SHANGHAI_TZ)
     
     try:
-        tz = pytz.timezone(user_timezone)
+        tz = _get_timezone(user_timezone)
         return datetime.now(tz)
     except Exception as e:
         print(f"⚠️ 无效的时区 '{user_timezone}': {e}")
         # 回退到 Asia/Shanghai
-        tz = pytz.timezone('Asia/Shanghai')
-        return datetime.now(tz)
+        return datetime.now(_SHANGHAI_TZ)
 
 
 def get_user_timezone_date(user_timezone: Optional[str] = None):
@@ -48,16 +71,15 @@ def get_user_timezone_iso_string(user_timezone: Optional[str] = None) -> str:
     """
     获取用户时区的当前时间的 ISO 字符串（用于存储到数据库）
     
+    同一时刻在任何时区转换为 UTC 后都相同，因此直接取 UTC 当前时间，不需要先本地化到用户时区
+    
     Args:
-        user_timezone: 用户时区字符串
+        user_timezone: 用户时区字符串（不影响结果，保留参数以兼容调用方）
         
     Returns:
         ISO 格式的时间字符串（带 Z 后缀表示已转换为 UTC）
     """
-    user_datetime = get_user_timezone_datetime(user_timezone)
-    # 转换为 UTC 时间存储
-    utc_datetime = user_datetime.astimezone(timezone.utc)
-    return utc_datetime.isoformat().replace('+00:00', 'Z')
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
 
 
 def is_same_date_in_user_timezone(date1: datetime, date2: datetime, user_timezone: Optional[str] = None) -> bool:
@@ -76,7 +98,7 @@ def is_same_date_in_user_timezone(date1: datetime, date2: datetime, user_timezon
         user_timezone = 'Asia/Shanghai'
     
     try:
-        tz = pytz.timezone(user_timezone)
+        tz = _get_timezone(user_timezone)
         
         # 转换为用户时区
         if date1.tzinfo is None:
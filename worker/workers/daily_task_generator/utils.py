@@ -6,6 +6,9 @@ from appwrite.client import Client
 from appwrite.services.databases import Databases
 
 
+_databases = None
+
+
 def get_appwrite_client() -> Client:
     """创建 Appwrite 客户端"""
     client = Client()
@@ -16,7 +19,11 @@ def get_appwrite_client() -> Client:
 
 
 def get_databases() -> Databases:
-    """获取数据库服务实例"""
-    client = get_appwrite_client()
-    return Databases(client)
+    """获取数据库服务实例（进程内复用同一个实例）"""
+    global _databases
+    
+    if _databases is None:
+        _databases = Databases(get_appwrite_client())
+    
+    return _databases
 
@@ -1,13 +1,32 @@
 """
 每日任务生成 Worker 实现
 """
+import asyncio
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any
 from datetime import datetime
 from loguru import logger
 
 from workers.base import BaseWorker
 from .utils import get_databases
-from .task_generator import get_active_users, generate_daily_task_for_user
+from .task_generator import (
+    PAGE_SIZE,
+    iter_active_users,
+    get_users_with_today_task,
+    generate_daily_task_for_user
+)
+
+
+# 同时生成任务的用户数上限（生成过程以 Appwrite 网络请求为主，并发可重叠等待时间）
+USER_CONCURRENCY = 20
+
+# 批量检查发现今天已有任务时的结果（与 generate_daily_task_for_user 的跳过结果一致）
+TODAY_TASK_EXISTS_RESULT = {
+    'generated': False,
+    'reason': '今天已生成任务',
+    'total_questions': 0
+}
 
 
 class DailyTaskGeneratorWorker(BaseWorker):
@@ -40,11 +59,65 @@ class DailyTaskGeneratorWorker(BaseWorker):
         # 初始化服务
         self._init_services()
         
-        # 获取所有活跃用户
-        active_users = get_active_users(self.db)
-        logger.info(f"找到 {len(active_users)} 个活跃用户")
+        # 边分页获取活跃用户边生成任务：生产者按页取出用户，批量跳过今天已有任务的用户，
+        # 其余放入有界队列，USER_CONCURRENCY 个消费者并发处理（同时处理的用户数即为消费者数）
+        # 同步 SDK 调用放到专用线程池中执行（默认线程池在低核数机器上只有几个线程）
+        users_iter = iter_active_users(self.db)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=USER_CONCURRENCY * 2)
+        results = []  # [(user, result 或 Exception)]
+        active_user_count = 0
+        loop = asyncio.get_running_loop()
+        
+        with ThreadPoolExecutor(max_workers=USER_CONCURRENCY) as executor:
+            async def produce_users():
+                nonlocal active_user_count
+                try:
+                    while True:
+                        # 翻页时会发起阻塞的网络请求，放到线程中执行
+                        users = await asyncio.to_thread(list, islice(users_iter, PAGE_SIZE))
+                        if not users:
+                            break
+                        
+                        active_user_count += len(users)
+                        logger.info(f"找到 {len(users)} 个活跃用户（累计 {active_user_count} 个）")
+                        
+                        # 一次查询整页用户的今日任务，已有任务的用户无需进入生成流程
+                        # （生成流程内仍会再次检查）
+                        done_user_ids = await asyncio.to_thread(
+                            get_users_with_today_task, users, self.db
+                        )
+                        for user in users:
+                            if user.get('userId') in done_user_ids:
+                                results.append((user, TODAY_TASK_EXISTS_RESULT))
+                            else:
+                                await queue.put(user)
+                finally:
+                    # 通知所有消费者结束
+                    for _ in range(USER_CONCURRENCY):
+                        await queue.put(None)
+            
+            async def consume_users():
+                while True:
+                    user = await queue.get()
+                    if user is None:
+                        return
+                    
+                    try:
+                        result = await loop.run_in_executor(
+                            executor, generate_daily_task_for_user, user, self.db
+                        )
+                    except Exception as e:
+                        result = e
+                    results.append((user, result))
+            
+            await asyncio.gather(
+                produce_users(),
+                *(consume_users() for _ in range(USER_CONCURRENCY))
+            )
+        
+        logger.info(f"共处理 {len(results)}/{active_user_count} 个活跃用户")
         
-        if not active_users:
+        if not active_user_count:
             return {
                 'success': True,
                 'message': '没有活跃用户',
@@ -60,49 +133,46 @@ class DailyTaskGeneratorWorker(BaseWorker):
         error_count = 0
         user_results = []
         
-        # 为每个用户生成任务
-        for user in active_users:
+        for user, result in results:
             user_id = user.get('userId', 'unknown')
             
-            try:
-                result = generate_daily_task_for_user(user, self.db)
-                
-                if result['generated']:
-                    success_count += 1
-                    logger.info(
-                        f"✓ 用户 {user_id}: "
-                        f"生成 {result['total_questions']} 道题"
-                    )
-                    user_results.append({
-                        'user_id': user_id,
-                        'status': 'success',
-                        'questions': result['total_questions']
-                    })
-                else:
-                    skip_count += 1
-                    logger.info(f"○ 用户 {user_id}: {result['reason']}")
-                    user_results.append({
-                        'user_id': user_id,
-                        'status': 'skipped',
-                        'reason': result['reason']
-                    })
-                    
-            except Exception as e:
+            if isinstance(result, Exception):
                 error_count += 1
-                error_msg = str(e)
+                error_msg = str(result)
                 logger.error(f"✗ 用户 {user_id} 生成失败: {error_msg}")
                 user_results.append({
                     'user_id': user_id,
                     'status': 'failed',
                     'error': error_msg
                 })
+                continue
+            
+            if result['generated']:
+                success_count += 1
+                logger.info(
+                    f"✓ 用户 {user_id}: "
+                    f"生成 {result['total_questions']} 道题"
+                )
+                user_results.append({
+                    'user_id': user_id,
+                    'status': 'success',
+                    'questions': result['total_questions']
+                })
+            else:
+                skip_count += 1
+                logger.info(f"○ 用户 {user_id}: {result['reason']}")
+                user_results.append({
+                    'user_id': user_id,
+                    'status': 'skipped',
+                    'reason': result['reason']
+                })
         
         # 返回结果
         summary = {
             'success': True,
             'timestamp': datetime.now().isoformat(),
             'trigger_type': trigger_type,
-            'total_users': len(active_users),
+            'total_users': len(results),
             'success_count': success_count,
             'skip_count': skip_count,
             'error_count': error_count,
@@ -6,6 +6,7 @@ from .worker import MistakeAnalyzerWorker
 # 导出核心功能（向后兼容）
 from .core import (
     analyze_mistake_image,
+    analyze_mistake_images_batch,
     extract_question_content,
     analyze_subject_and_knowledge_points,
     get_llm_provider
@@ -29,6 +30,7 @@ __all__ = [
     'MistakeAnalyzerWorker',
     # 核心功能
     'analyze_mistake_image',
+    'analyze_mistake_images_batch',
     'extract_question_content',
     'analyze_subject_and_knowledge_points',
     'get_llm_provider',
@@ -4,6 +4,7 @@
 """
 from workers.mistake_analyzer.core.image_analyzer import (
     analyze_mistake_image,
+    analyze_mistake_images_batch,
     extract_question_content,
     analyze_subject_and_knowledge_points
 )
@@ -11,6 +12,7 @@ from workers.mistake_analyzer.core.llm_provider import get_llm_provider
 
 __all__ = [
     'analyze_mistake_image',
+    'analyze_mistake_images_batch',
     'extract_question_content',
     'analyze_subject_and_knowledge_points',
     'get_llm_provider'
@@ -8,22 +8,46 @@
 图片已由 Flutter 端上传到 bucket，此模块只负责分析
 """
 import os
+import re
 import asyncio
 import base64
+import hashlib
+import threading
 import cv2
+import httpx
 import numpy as np
-from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 from appwrite.client import Client
 from appwrite.services.databases import Databases
 from appwrite.services.storage import Storage
 from appwrite.id import ID
 from appwrite.input_file import InputFile
+from loguru import logger
 
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, tjMCUWidth, tjMCUHeight
+except ImportError:
+    # 可选依赖：未安装时使用 OpenCV 编解码
+    TurboJPEG = None
+
+try:
+    import pillow_heif
+except ImportError:
+    # 可选依赖：未安装时 HEIC/HEIF 图片交给 OpenCV（通常无法解码）
+    pillow_heif = None
+
+from workers.cache import cache_get, cache_set
 from workers.mistake_analyzer.core.llm_provider import get_llm_provider
-from workers.mistake_analyzer.core.parsers import parse_segmented_response, parse_knowledge_points_response
+from workers.mistake_analyzer.core.parsers import (
+    SegmentedStreamParser,
+    parse_segmented_response,
+    parse_knowledge_points_response
+)
 from workers.mistake_analyzer.helpers.appwrite_helpers import (
     get_existing_modules,
-    get_existing_knowledge_points_by_module
+    fetch_modules_by_ids
 )
 from workers.mistake_analyzer.helpers.utils import get_subject_chinese_name
 from workers.mistake_analyzer.services.knowledge_point_service import get_user_knowledge_points_by_subject
@@ -32,21 +56,75 @@ from workers.mistake_analyzer.core.prompts import (
     get_ocr_user_prompt,
     build_user_feedback_section,
     build_multi_image_hint,
+    build_ocr_retry_prompt,
     get_knowledge_points_system_prompt,
     get_knowledge_points_user_prompt,
     build_modules_hint,
-    build_existing_kp_hint
+    build_existing_kp_hint,
+    build_knowledge_points_retry_prompt
 )
 
 
 # 常量配置
 QUESTION_TYPES = ['choice', 'fillBlank', 'shortAnswer', 'essay']
 
+# 没有上次识别结果时预测的学科（与 OCR 未识别出学科时的默认值一致）
+DEFAULT_SUBJECT_GUESS = 'math'
+
+# 裁剪图片的 JPEG 编码质量（在手机端查看时与 90 肉眼无差别，体积小约 20%）
+CROP_JPEG_QUALITY = 85
+
+# 模块名后的描述（从第一个括号或冒号开始）
+_MODULE_DESC_SUFFIX_RE = re.compile(r'[(（:：]')
+
+# OCR 解析结果缓存（可选 Redis，未配置时不缓存）：同一组图片重复提交时跳过 LLM 调用
+OCR_CACHE_KEY_PREFIX = 'ocr_result:'
+OCR_CACHE_VERSION = 'v1'  # 解析结果格式变化时递增
+OCR_CACHE_TTL = 86400
+
+# 学科下既没有可用模块也没有已有知识点时，跳过第二步 LLM 调用直接归入"未分类"
+# （省掉一次 LLM 往返，但不会生成知识点名称和解题提示，默认关闭）
+SKIP_KP_ANALYSIS_WITHOUT_CONTEXT = os.environ.get('SKIP_KP_ANALYSIS_WITHOUT_CONTEXT', 'false').lower() == 'true'
+
+# OCR 使用流式输出，边接收边识别学科（识别出学科后立即回调，调用方可以提前按实际学科查询模块和知识点）
+OCR_STREAMING = os.environ.get('OCR_STREAMING', 'true').lower() == 'true'
+
+# 批量分析多道错题时最多同时进行的分析数量（同时到达的 LLM 请求可以由服务端合批推理）
+BATCH_ANALYSIS_CONCURRENCY = int(os.environ.get('BATCH_ANALYSIS_CONCURRENCY', '4'))
+
+# 同一道题的裁剪图片最多同时上传的数量
+MAX_CONCURRENT_UPLOADS = 8
+
+# 裁剪图片所在的 bucket（必须确保这个 bucket 存在）及权限
+EXTRACTED_IMAGES_BUCKET_ID = 'extracted_images'
+EXTRACTED_IMAGE_PERMISSIONS = ['read("any")', 'update("users")', 'delete("users")']
+
+# 直接用 REST 接口单次上传的大小上限（与 SDK 分片大小一致，超过时交给 SDK 分片上传）
+DIRECT_UPLOAD_MAX_SIZE = 5 * 1024 * 1024
+
+# 直接上传的请求超时（秒）
+UPLOAD_TIMEOUT = 60
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+# HEIC/HEIF 图片（iOS 拍照默认格式）ftyp box 中的主品牌
+HEIF_BRANDS = (b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1')
+
+# 可以无损裁剪的 JPEG 色彩空间（TJCS_RGB / TJCS_YCbCr / TJCS_GRAY），CMYK 等解码后处理
+LOSSLESS_CROP_COLORSPACES = (0, 1, 2)
+
+_turbojpeg = None
+_turbojpeg_initialized = False
+
+# 图片解码/裁剪/编码的共享线程池（OpenCV 和 libjpeg-turbo 会释放 GIL，多个请求的图片处理可以并行）
+_IMAGE_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='img-crop')
+
 
 # ============= 工具函数 =============
 
+@lru_cache(maxsize=1)
 def get_storage() -> Storage:
-    """Initialize Storage service"""
+    """Initialize Storage service（进程内只创建一次，多次上传复用同一个实例）"""
     client = Client()
     client.set_endpoint(os.environ.get('APPWRITE_ENDPOINT', 'https://cloud.appwrite.io/v1'))
     client.set_project(os.environ['APPWRITE_PROJECT_ID'])
@@ -89,99 +167,393 @@ def create_fallback_result(subject: str, error_msg: str = '') -> Dict:
 
 def _normalize_module_name(module_name: str) -> str:
     """规范化模块名，去除括号和冒号后的描述"""
-    if '(' in module_name or '（' in module_name:
-        module_name = module_name.split('(')[0].split('（')[0].strip()
-    if '：' in module_name or ':' in module_name:
-        module_name = module_name.split('：')[0].split(':')[0].strip()
+    match = _MODULE_DESC_SUFFIX_RE.search(module_name)
+    if match:
+        return module_name[:match.start()].strip()
     return module_name
 
 
-async def crop_and_upload_image(
-    image_base64: str,
-    bbox: List[int],
-    subject: str
-) -> Optional[str]:
+def _get_turbojpeg():
+    """获取 TurboJPEG 实例（延迟初始化），未安装或找不到 libturbojpeg 时返回 None"""
+    global _turbojpeg, _turbojpeg_initialized
+    
+    if not _turbojpeg_initialized:
+        _turbojpeg_initialized = True
+        if TurboJPEG is not None:
+            try:
+                _turbojpeg = TurboJPEG()
+            except Exception as e:
+                logger.warning(f"⚠️ 加载 libturbojpeg 失败，使用 OpenCV 编解码: {str(e)}")
+    
+    return _turbojpeg
+
+
+def _get_jpeg_orientation(image_data: bytes) -> int:
     """
-    根据 bbox 裁剪图片并上传到 storage
+    读取 JPEG 的 EXIF 方向标记
     
     Args:
-        image_base64: 原始图片 base64 (无前缀)
-        bbox: [x1, y1, x2, y2] 归一化坐标 (0-1000)
-        subject: 学科代码
+        image_data: JPEG 字节
         
     Returns:
-        str: 上传后的 file_id, 失败返回 None
+        EXIF Orientation 值，没有 EXIF 方向信息时返回 1（无需旋转），无法解析时返回 0
     """
     try:
-        # 1. 解码图片
-        image_data = base64.b64decode(image_base64)
-        nparr = np.frombuffer(image_data, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if image is None:
-            print("❌ 图片解码失败")
-            return None
-            
-        h, w = image.shape[:2]
+        pos = 2
+        while pos + 4 <= len(image_data):
+            if image_data[pos] != 0xFF:
+                return 0
+            marker = image_data[pos + 1]
+            if marker == 0xDA:
+                # SOS 之后是图像数据，不会再有 EXIF
+                break
+            segment_length = int.from_bytes(image_data[pos + 2:pos + 4], 'big')
+            if marker == 0xE1 and image_data[pos + 4:pos + 10] == b'Exif\x00\x00':
+                tiff = pos + 10
+                byteorder = 'little' if image_data[tiff:tiff + 2] == b'II' else 'big'
+                ifd = tiff + int.from_bytes(image_data[tiff + 4:tiff + 8], byteorder)
+                entry_count = int.from_bytes(image_data[ifd:ifd + 2], byteorder)
+                for i in range(entry_count):
+                    entry = ifd + 2 + i * 12
+                    if int.from_bytes(image_data[entry:entry + 2], byteorder) == 0x0112:
+                        return int.from_bytes(image_data[entry + 8:entry + 10], byteorder)
+                return 1
+            pos += 2 + segment_length
+        return 1
+    except Exception:
+        return 0
+
+
+def _is_heif(image_data: bytes) -> bool:
+    """判断是否为 HEIC/HEIF 图片"""
+    return image_data[4:8] == b'ftyp' and image_data[8:12] in HEIF_BRANDS
+
+
+def _decode_heif(image_data: bytes) -> np.ndarray:
+    """使用 pillow-heif 解码 HEIC/HEIF 图片为 BGR 数组（libheif 会按图片中的旋转信息处理方向）"""
+    heif_file = pillow_heif.open_heif(image_data, convert_hdr_to_8bit=True)
+    image = np.asarray(heif_file)
+    if image.ndim == 3 and image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_RGBA2BGR)
+    return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+
+def _decode_image(image_data: bytes) -> Optional[np.ndarray]:
+    """
+    解码图片为 BGR 数组
+    
+    JPEG 且无需按 EXIF 旋转时使用 libjpeg-turbo（如可用），
+    HEIC/HEIF 使用 pillow-heif（如可用），
+    其他格式和带旋转的 JPEG 使用 OpenCV（会自动按 EXIF 方向旋转）
+    
+    Args:
+        image_data: 图片字节
         
-        # 2. 转换坐标
-        x1, y1, x2, y2 = bbox
+    Returns:
+        BGR 数组，解码失败返回 None
+    """
+    jpeg = _get_turbojpeg()
+    if jpeg is not None and image_data[:3] == JPEG_MAGIC and _get_jpeg_orientation(image_data) == 1:
+        try:
+            return jpeg.decode(image_data, pixel_format=TJPF_BGR)
+        except Exception as e:
+            logger.warning(f"⚠️ libturbojpeg 解码失败，改用 OpenCV: {str(e)}")
+    
+    if pillow_heif is not None and _is_heif(image_data):
+        return _decode_heif(image_data)
+    
+    return cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+
+
+def _encode_jpeg(image: np.ndarray) -> bytes:
+    """将 BGR 数组编码为 JPEG 字节（优先使用 libjpeg-turbo）"""
+    jpeg = _get_turbojpeg()
+    if jpeg is not None:
+        # 裁剪得到的是视图（行不连续），编码前转为连续内存
+        return jpeg.encode(np.ascontiguousarray(image), quality=CROP_JPEG_QUALITY, pixel_format=TJPF_BGR)
+    
+    # 优化 Huffman 表，进一步减小上传体积
+    _, encoded_image = cv2.imencode(
+        '.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, CROP_JPEG_QUALITY, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    )
+    return encoded_image.tobytes()
+
+
+def _bbox_to_pixel_rect(bbox: List[int], width: int, height: int) -> Optional[Tuple[int, int, int, int]]:
+    """
+    将归一化 bbox 转换为像素坐标（四周各扩大 5% 边距）
+    
+    Args:
+        bbox: [x1, y1, x2, y2] 归一化坐标 (0-1000)，调用前已验证范围
+        width: 图片宽度
+        height: 图片高度
         
-        # 验证坐标范围
-        if not (0 <= x1 < x2 <= 1000 and 0 <= y1 < y2 <= 1000):
-            print(f"⚠️ bbox 坐标无效: {bbox}")
+    Returns:
+        (x_min, y_min, x_max, y_max)，区域为空时返回 None
+    """
+    x1, y1, x2, y2 = bbox
+    
+    # 转换为实际像素坐标
+    x_min = int(x1 * width / 1000)
+    y_min = int(y1 * height / 1000)
+    x_max = int(x2 * width / 1000)
+    y_max = int(y2 * height / 1000)
+    
+    # 扩大一些边距 (5%)
+    margin_x = int((x_max - x_min) * 0.05)
+    margin_y = int((y_max - y_min) * 0.05)
+    
+    x_min = max(0, x_min - margin_x)
+    y_min = max(0, y_min - margin_y)
+    x_max = min(width, x_max + margin_x)
+    y_max = min(height, y_max + margin_y)
+    
+    if x_max <= x_min or y_max <= y_min:
+        logger.error("❌ 裁剪结果为空")
+        return None
+    return x_min, y_min, x_max, y_max
+
+
+class SourceImage:
+    """
+    待裁剪的原始图片
+    
+    同一张图片裁剪多个区域时，base64 和像素都只解码一次；
+    可以无损裁剪的 JPEG 完全不需要解码像素
+    多个裁剪任务会在线程池中并发访问同一实例，延迟解码由锁保护
+    """
+    
+    def __init__(self, image_data: bytes):
+        self.data = image_data
+        self._lock = threading.Lock()
+        self._image = None
+        self._decoded = False
+        self._jpeg_info = None
+        self._jpeg_info_loaded = False
+    
+    @classmethod
+    def from_base64(cls, image_base64: str) -> Optional['SourceImage']:
+        """从 base64 创建，解码失败返回 None"""
+        try:
+            return cls(base64.b64decode(image_base64))
+        except Exception as e:
+            logger.error(f"❌ 图片解码失败: {str(e)}")
             return None
-            
-        # 转换为实际像素坐标
-        x_min = int(x1 * w / 1000)
-        y_min = int(y1 * h / 1000)
-        x_max = int(x2 * w / 1000)
-        y_max = int(y2 * h / 1000)
+    
+    def get_image(self) -> Optional[np.ndarray]:
+        """获取解码后的 BGR 数组（只解码一次），解码失败返回 None"""
+        with self._lock:
+            if not self._decoded:
+                self._decoded = True
+                try:
+                    self._image = _decode_image(self.data)
+                except Exception as e:
+                    logger.error(f"❌ 图片解码失败: {str(e)}")
+                if self._image is None:
+                    logger.error("❌ 图片解码失败")
+        return self._image
+    
+    def get_lossless_crop_info(self) -> Optional[Tuple[int, int, int, int]]:
+        """
+        获取无损裁剪所需的 JPEG 信息
         
-        # 扩大一些边距 (5%)
-        margin_x = int((x_max - x_min) * 0.05)
-        margin_y = int((y_max - y_min) * 0.05)
+        只有 libjpeg-turbo 可用、图片是 JPEG、无需按 EXIF 旋转且为常规色彩空间时才能无损裁剪
         
-        x_min = max(0, x_min - margin_x)
-        y_min = max(0, y_min - margin_y)
-        x_max = min(w, x_max + margin_x)
-        y_max = min(h, y_max + margin_y)
+        Returns:
+            (宽, 高, MCU 宽, MCU 高)，不能无损裁剪时返回 None
+        """
+        with self._lock:
+            if not self._jpeg_info_loaded:
+                self._jpeg_info_loaded = True
+                jpeg = _get_turbojpeg()
+                if (
+                    jpeg is not None
+                    and self.data[:3] == JPEG_MAGIC
+                    and _get_jpeg_orientation(self.data) == 1
+                ):
+                    try:
+                        width, height, subsample, colorspace = jpeg.decode_header(self.data)[:4]
+                        if colorspace in LOSSLESS_CROP_COLORSPACES:
+                            self._jpeg_info = (width, height, tjMCUWidth[subsample], tjMCUHeight[subsample])
+                    except Exception as e:
+                        logger.warning(f"⚠️ 读取 JPEG 头失败，改为解码后裁剪: {str(e)}")
+        return self._jpeg_info
+
+
+def _crop_jpeg_lossless(
+    image_data: bytes,
+    rect: Tuple[int, int, int, int],
+    mcu_width: int,
+    mcu_height: int
+) -> bytes:
+    """
+    在 DCT 域无损裁剪 JPEG（不解码像素、不重新编码）
+    
+    裁剪起点必须对齐 MCU，因此向左上扩展到最近的 MCU 边界，不会裁掉 bbox 内容
+    
+    Args:
+        image_data: 原始 JPEG 字节
+        rect: (x_min, y_min, x_max, y_max) 像素坐标
+        mcu_width: MCU 宽度
+        mcu_height: MCU 高度
         
-        # 3. 裁剪
-        cropped_image = image[y_min:y_max, x_min:x_max]
+    Returns:
+        裁剪后的 JPEG 字节（不保留 EXIF 等元数据）
+    """
+    x_min, y_min, x_max, y_max = rect
+    x = x_min // mcu_width * mcu_width
+    y = y_min // mcu_height * mcu_height
+    return _get_turbojpeg().crop(image_data, x, y, x_max - x, y_max - y, copynone=True)
+
+
+def crop_image(source: SourceImage, bbox: List[int]) -> Optional[bytes]:
+    """
+    根据 bbox 裁剪图片，返回 JPEG 字节
+    
+    JPEG 原图优先无损裁剪，其他情况解码后裁剪再编码
+    
+    Args:
+        source: 原始图片
+        bbox: [x1, y1, x2, y2] 归一化坐标 (0-1000)
         
-        if cropped_image.size == 0:
-            print("❌ 裁剪结果为空")
+    Returns:
+        裁剪后的 JPEG 字节，bbox 无效或裁剪结果为空时返回 None
+    """
+    # 验证坐标范围
+    x1, y1, x2, y2 = bbox
+    if not (0 <= x1 < x2 <= 1000 and 0 <= y1 < y2 <= 1000):
+        logger.warning(f"⚠️ bbox 坐标无效: {bbox}")
+        return None
+    
+    # 1. JPEG 快速路径：无损裁剪
+    jpeg_info = source.get_lossless_crop_info()
+    if jpeg_info is not None:
+        width, height, mcu_width, mcu_height = jpeg_info
+        rect = _bbox_to_pixel_rect(bbox, width, height)
+        if rect is None:
             return None
-            
-        # 4. 编码为 JPEG
-        _, encoded_image = cv2.imencode('.jpg', cropped_image, [cv2.IMWRITE_JPEG_QUALITY, 90])
-        cropped_bytes = encoded_image.tobytes()
-        
-        # 5. 上传
-        storage = get_storage()
-        bucket_id = 'extracted_images' # 必须确保这个 bucket 存在
-        file_id = ID.unique()
-        file_name = f"extracted_{subject}_{file_id}.jpg"
+        try:
+            return _crop_jpeg_lossless(source.data, rect, mcu_width, mcu_height)
+        except Exception as e:
+            logger.warning(f"⚠️ JPEG 无损裁剪失败，改为解码后裁剪: {str(e)}")
+    
+    # 2. 解码后裁剪（视图，不复制像素）
+    image = source.get_image()
+    if image is None:
+        return None
+    
+    h, w = image.shape[:2]
+    rect = _bbox_to_pixel_rect(bbox, w, h)
+    if rect is None:
+        return None
+    x_min, y_min, x_max, y_max = rect
+    cropped_image = image[y_min:y_max, x_min:x_max]
+    
+    # 3. 编码为 JPEG
+    return _encode_jpeg(cropped_image)
+
+
+def _create_upload_client() -> httpx.AsyncClient:
+    """
+    创建直接调用 Storage REST 接口的异步 HTTP 客户端
+    
+    同一道题的多个裁剪图片共用一个客户端（复用连接），客户端绑定当前事件循环，用完需关闭
+    """
+    return httpx.AsyncClient(
+        base_url=os.environ.get('APPWRITE_ENDPOINT', 'https://cloud.appwrite.io/v1'),
+        headers={
+            'X-Appwrite-Project': os.environ['APPWRITE_PROJECT_ID'],
+            'X-Appwrite-Key': os.environ['APPWRITE_API_KEY'],
+            'X-Appwrite-Response-Format': '2.0.0',
+            'accept': 'application/json',
+        },
+        timeout=UPLOAD_TIMEOUT,
+        limits=httpx.Limits(max_connections=MAX_CONCURRENT_UPLOADS)
+    )
+
+
+async def upload_cropped_image(
+    cropped_bytes: bytes,
+    subject: str,
+    client: Optional[httpx.AsyncClient] = None
+) -> str:
+    """
+    上传裁剪后的图片到 storage
+    
+    提供 client 时直接在事件循环中发送 multipart 请求（不占用线程，也不经过 InputFile 复制），
+    否则（或图片超过单次上传上限时）使用同步 SDK 在线程中上传
+    
+    Args:
+        cropped_bytes: JPEG 字节
+        subject: 学科代码
+        client: _create_upload_client 创建的客户端（可选）
         
-        print(f"📤 正在上传提取的图片: {file_name}")
+    Returns:
+        str: 上传后的 file_id
+    """
+    file_id = ID.unique()
+    file_name = f"extracted_{subject}_{file_id}.jpg"
+    
+    logger.info(f"📤 正在上传提取的图片: {file_name}")
+    
+    if client is not None and len(cropped_bytes) <= DIRECT_UPLOAD_MAX_SIZE:
+        form = {'fileId': file_id}
+        for i, permission in enumerate(EXTRACTED_IMAGE_PERMISSIONS):
+            form[f'permissions[{i}]'] = permission
         
+        response = await client.post(
+            f'/storage/buckets/{EXTRACTED_IMAGES_BUCKET_ID}/files',
+            data=form,
+            files={'file': (file_name, cropped_bytes, 'image/jpeg')}
+        )
+        response.raise_for_status()
+    else:
         await asyncio.to_thread(
-            storage.create_file,
-            bucket_id=bucket_id,
+            get_storage().create_file,
+            bucket_id=EXTRACTED_IMAGES_BUCKET_ID,
             file_id=file_id,
             file=InputFile.from_bytes(cropped_bytes, filename=file_name),
-            permissions=['read("any")', 'update("users")', 'delete("users")']
+            permissions=EXTRACTED_IMAGE_PERMISSIONS
+        )
+    
+    logger.info(f"✅ 图片提取并上传成功: {file_id}")
+    return file_id
+
+
+async def crop_and_upload_image(
+    source: Optional[SourceImage],
+    bbox: List[int],
+    subject: str,
+    client: Optional[httpx.AsyncClient] = None
+) -> Optional[str]:
+    """
+    根据 bbox 裁剪图片并上传到 storage
+    
+    Args:
+        source: 原始图片（SourceImage.from_base64 的结果，解码失败时为 None）
+        bbox: [x1, y1, x2, y2] 归一化坐标 (0-1000)
+        subject: 学科代码
+        client: 上传用的 HTTP 客户端（可选，见 upload_cropped_image）
+        
+    Returns:
+        str: 上传后的 file_id, 失败返回 None
+    """
+    if source is None:
+        return None
+    
+    try:
+        # 解码/裁剪/编码是 CPU 密集操作，放到共享线程池中执行，避免阻塞事件循环
+        cropped_bytes = await asyncio.get_running_loop().run_in_executor(
+            _IMAGE_POOL, crop_image, source, bbox
         )
+        if cropped_bytes is None:
+            return None
         
-        print(f"✅ 图片提取并上传成功: {file_id}")
-        return file_id
+        return await upload_cropped_image(cropped_bytes, subject, client)
         
     except Exception as e:
-        print(f"❌ 图片裁剪上传失败: {str(e)}")
-        # 打印详细堆栈以便调试
-        import traceback
-        traceback.print_exc()
+        # 记录详细堆栈以便调试
+        logger.exception(f"❌ 图片裁剪上传失败: {str(e)}")
         return None
 
 
@@ -226,6 +598,38 @@ async def analyze_mistake_image(
     )
 
 
+async def analyze_mistake_images_batch(
+    image_base64_list: List[str],
+    user_id: str,
+    databases: Optional[Databases] = None
+) -> List[Dict]:
+    """
+    批量分析多张错题图片（每张图片是一道独立的题目，异步）
+    
+    各题目并发分析，最多同时进行 BATCH_ANALYSIS_CONCURRENCY 个，所有题目共用同一个 databases
+    注意：同一道题跨页的多张图片应该用 extract_question_content 一次识别
+    
+    Args:
+        image_base64_list: 图片 base64 编码列表（纯 base64 或包含 data:image 前缀）
+        user_id: 用户ID（用于获取学段信息）
+        databases: Databases 实例（可选）
+        
+    Returns:
+        分析结果列表（与图片顺序一致），图片无效时对应位置为 create_fallback_result 的结果
+    """
+    semaphore = asyncio.Semaphore(BATCH_ANALYSIS_CONCURRENCY)
+    
+    async def analyze_one(image_base64: str) -> Dict:
+        async with semaphore:
+            try:
+                return await analyze_mistake_image(image_base64, user_id, databases)
+            except ValueError as e:
+                logger.error(f"错题图片无效: {str(e)}")
+                return create_fallback_result('unknown', str(e))
+    
+    return list(await asyncio.gather(*(analyze_one(image) for image in image_base64_list)))
+
+
 async def analyze_with_llm_vision(
     image_base64: str,
     user_id: str,
@@ -246,11 +650,22 @@ async def analyze_with_llm_vision(
         user_feedback: 用户反馈的错误原因（可选）
         previous_result: 上次识别的结果（可选）
     """
+    # 模块/知识点查询只依赖学科，按预测的学科与 OCR 并行执行
+    subject_guess = (previous_result or {}).get('subject') or DEFAULT_SUBJECT_GUESS
+    context_task = start_subject_context_prefetch(subject_guess, user_id, databases)
+    
+    def on_subject(subject: str) -> None:
+        # 流式 OCR 识别出学科后立即按实际学科预取，不等 OCR 全部完成
+        nonlocal subject_guess, context_task
+        context_task = retarget_subject_context_prefetch(context_task, subject_guess, subject, user_id, databases)
+        subject_guess = subject
+    
     try:
         step1 = await extract_question_content(
             image_base64,
             user_feedback=user_feedback,
-            previous_result=previous_result
+            previous_result=previous_result,
+            on_subject=on_subject
         )
         
         step2 = await analyze_subject_and_knowledge_points(
@@ -258,7 +673,8 @@ async def analyze_with_llm_vision(
             question_type=step1['type'],
             subject=step1['subject'],
             user_id=user_id,
-            databases=databases
+            databases=databases,
+            context_task=take_subject_context_prefetch(context_task, subject_guess, step1['subject'])
         )
         
         return {
@@ -272,14 +688,88 @@ async def analyze_with_llm_vision(
         }
         
     except Exception as e:
-        print(f"LLM 分析失败: {str(e)}")
+        context_task.cancel()
+        logger.error(f"LLM 分析失败: {str(e)}")
         return create_fallback_result('unknown', str(e))
 
 
+async def _crop_question_images(result: Dict, image_base64_list: List[str]) -> List[str]:
+    """
+    根据 OCR 结果中的 bbox 裁剪题目图片并上传
+    
+    Args:
+        result: parse_segmented_response 的解析结果
+        image_base64_list: 原始图片 base64 列表
+        
+    Returns:
+        上传成功的图片 file_id 列表（保持 bbox 顺序）
+    """
+    # 处理图片裁剪 (如果有 bboxes)
+    crop_jobs = []  # [(图片索引, bbox)]
+    if 'bboxes' in result and result['bboxes']:
+        logger.info(f"🖼️ 检测到 {len(result['bboxes'])} 个题目图片位置")
+        for item in result['bboxes']:
+            img_idx = item.get('index', 0)
+            bbox = item.get('bbox')
+            
+            if 0 <= img_idx < len(image_base64_list):
+                logger.debug(f"   - 处理第 {img_idx+1} 张图片的 bbox: {bbox}")
+                crop_jobs.append((img_idx, bbox))
+            else:
+                logger.warning(f"⚠️ 图片索引 {img_idx} 超出范围 (共 {len(image_base64_list)} 张)")
+    
+    # 兼容旧代码 (如果 parser 只返回了 bbox)
+    elif 'bbox' in result and result['bbox']:
+        logger.info(f"🖼️ 检测到题目图片 (单图模式)，bbox: {result['bbox']}")
+        # 默认使用第一张图
+        if image_base64_list:
+            crop_jobs.append((0, result['bbox']))
+    
+    image_ids = []
+    if crop_jobs:
+        # 同一张图片上的多个 bbox 共用一次解码结果（base64 解码也在线程池中执行）
+        loop = asyncio.get_running_loop()
+        source_images = {}  # {图片索引: 解码 SourceImage 的 Future}
+        upload_semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+        subject = result.get('subject', 'unknown')
+        
+        async def crop_and_upload(
+            img_idx: int,
+            bbox: List[int],
+            client: httpx.AsyncClient
+        ) -> Optional[str]:
+            async with upload_semaphore:
+                if img_idx not in source_images:
+                    source_images[img_idx] = loop.run_in_executor(
+                        _IMAGE_POOL, SourceImage.from_base64, image_base64_list[img_idx]
+                    )
+                source = await source_images[img_idx]
+                return await crop_and_upload_image(source, bbox, subject, client)
+        
+        # 多个裁剪图片通过同一个客户端并发上传，结果保持 bbox 顺序
+        async with _create_upload_client() as client:
+            uploaded_ids = await asyncio.gather(
+                *(crop_and_upload(img_idx, bbox, client) for img_idx, bbox in crop_jobs)
+            )
+        image_ids = [image_id for image_id in uploaded_ids if image_id]
+    
+    return image_ids
+
+
+def _ocr_cache_key(image_base64_list: List[str], system_prompt: str, user_prompt: str) -> str:
+    """OCR 结果缓存键：图片和 prompt 内容的哈希（prompt 修改后自动失效）"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (OCR_CACHE_VERSION, system_prompt, user_prompt, *image_base64_list):
+        digest.update(part.encode())
+        digest.update(b'\0')
+    return OCR_CACHE_KEY_PREFIX + digest.hexdigest()
+
+
 async def extract_question_content(
     image_base64: [str, List[str]],
     user_feedback: Optional[str] = None,
-    previous_result: Optional[Dict] = None
+    previous_result: Optional[Dict] = None,
+    on_subject: Optional[Callable[[str], None]] = None
 ) -> Dict:
     """
     第一步：OCR 提取题目内容和学科识别（内部函数，异步）
@@ -293,6 +783,8 @@ async def extract_question_content(
                      - 多图：List[str]（按页面顺序）
         user_feedback: 用户反馈的错误原因（可选）
         previous_result: 上次识别的结果（可选），包含 content, type, options, subject
+        on_subject: 流式输出中识别出学科时的回调（可选，在 OCR 完成之前调用，重试时可能再次调用；
+                    命中缓存或未启用流式输出时不调用）
         
     Returns:
         {'content': str, 'type': str, 'options': list, 'subject': str}
@@ -313,6 +805,18 @@ async def extract_question_content(
         user_feedback_section=user_feedback_section
     )
 
+    # 同一组图片的首次识别结果可以复用（用户反馈重新识别时不使用缓存）
+    cache_key = None
+    if not user_feedback and not previous_result:
+        cache_key = await asyncio.to_thread(_ocr_cache_key, image_base64_list, system_prompt, user_prompt)
+        cached = await asyncio.to_thread(cache_get, cache_key)
+        if cached:
+            logger.info(f"✅ 命中 OCR 缓存，题目类型: {cached.get('type', '未知')}, 学科: {cached.get('subject', '未知')}")
+            image_ids = await _crop_question_images(cached, image_base64_list)
+            if image_ids:
+                cached['imageIds'] = image_ids
+            return cached
+    
     # Agent 重试机制
     max_retries = 3
     llm = get_llm_provider()
@@ -321,11 +825,11 @@ async def extract_question_content(
         response = None
         try:
             if attempt == 0:
-                print(f"开始OCR识别，共 {len(image_base64_list)} 张图片")
+                logger.info(f"开始OCR识别，共 {len(image_base64_list)} 张图片")
             else:
-                print(f"🔄 第 {attempt + 1} 次重试...")
+                logger.info(f"🔄 第 {attempt + 1} 次重试...")
             
-            response = await llm.chat_with_vision(
+            request = dict(
                 prompt=user_prompt,
                 image_base64=image_base64_list,
                 system_prompt=system_prompt,
@@ -334,52 +838,24 @@ async def extract_question_content(
                 thinking={"type": "enabled"},
                 reasoning_effort="low"
             )
+            if OCR_STREAMING:
+                stream_parser = SegmentedStreamParser()
+                async for delta in llm.chat_with_vision_stream(**request):
+                    if stream_parser.feed(delta):
+                        logger.info(f"📡 流式识别出学科: {stream_parser.subject}")
+                        if on_subject:
+                            on_subject(stream_parser.subject)
+                response = stream_parser.text
+            else:
+                response = await llm.chat_with_vision(**request)
             
-            print(f"📋 LLM 返回的分段格式（前300字符）: {response[:300]}...")
+            logger.debug(f"📋 LLM 返回的分段格式（前300字符）: {response[:300]}...")
             
             result = parse_segmented_response(response)
             
-            print(f"✅ 分段格式解析成功！题目类型: {result.get('type', '未知')}, 学科: {result.get('subject', '未知')}")
-            
-            # 处理图片裁剪 (如果有 bboxes)
-            image_ids = []
-            if 'bboxes' in result and result['bboxes']:
-                print(f"🖼️ 检测到 {len(result['bboxes'])} 个题目图片位置")
-                for item in result['bboxes']:
-                    img_idx = item.get('index', 0)
-                    bbox = item.get('bbox')
-                    
-                    if 0 <= img_idx < len(image_base64_list):
-                        target_image = image_base64_list[img_idx]
-                        print(f"   - 处理第 {img_idx+1} 张图片的 bbox: {bbox}")
-                        
-                        image_id = await crop_and_upload_image(
-                            target_image, 
-                            bbox,
-                            result.get('subject', 'unknown')
-                        )
-                        if image_id:
-                            image_ids.append(image_id)
-                    else:
-                        print(f"⚠️ 图片索引 {img_idx} 超出范围 (共 {len(image_base64_list)} 张)")
-            
-            # 兼容旧代码 (如果 parser 只返回了 bbox)
-            elif 'bbox' in result and result['bbox']:
-                print(f"🖼️ 检测到题目图片 (单图模式)，bbox: {result['bbox']}")
-                # 默认使用第一张图
-                if image_base64_list:
-                    image_id = await crop_and_upload_image(
-                        image_base64_list[0], 
-                        result['bbox'],
-                        result.get('subject', 'unknown')
-                    )
-                    if image_id:
-                        image_ids.append(image_id)
+            logger.info(f"✅ 分段格式解析成功！题目类型: {result.get('type', '未知')}, 学科: {result.get('subject', '未知')}")
             
-            if image_ids:
-                result['imageIds'] = image_ids
-            
-            # 验证和规范化
+            # 验证和规范化（先于裁剪，格式错误重试时不会留下已上传的图片）
             if 'content' not in result or not result['content']:
                 raise ValueError("缺少题目内容")
             if 'type' not in result or result['type'] not in QUESTION_TYPES:
@@ -389,49 +865,135 @@ async def extract_question_content(
             if 'subject' not in result or not result['subject']:
                 result['subject'] = 'math'
             
+            if cache_key:
+                await asyncio.to_thread(cache_set, cache_key, result, OCR_CACHE_TTL)
+            
+            image_ids = await _crop_question_images(result, image_base64_list)
+            if image_ids:
+                result['imageIds'] = image_ids
+            
             return result
             
         except Exception as e:
             error_msg = str(e)
-            print(f"❌ 题目提取失败（尝试 {attempt + 1}/{max_retries}）: {error_msg}")
+            logger.error(f"❌ 题目提取失败（尝试 {attempt + 1}/{max_retries}）: {error_msg}")
             
             if attempt < max_retries - 1:
                 # 构造格式化的错误反馈
-                error_feedback = f"""⚠️ 你的上一次输出格式有错误，无法解析：
+                error_feedback = build_ocr_retry_prompt(error_msg, response)
+                # 将错误反馈添加到聊天历史
+                user_prompt = error_feedback
+                logger.info(f"📤 发送错误反馈给 LLM，准备重试...")
+            else:
+                # 最后一次尝试也失败了
+                logger.error(f"❌ 已达到最大重试次数，放弃")
+                if response:
+                    logger.error(f"原始响应: {response[:500]}...")
+                raise
 
-【错误信息】
-{error_msg}
 
-【要求的格式】
-##TYPE##
-题目类型（choice/fillBlank/shortAnswer/essay）
+async def fetch_subject_context(
+    subject: str,
+    user_id: str,
+    databases: Optional[Databases] = None
+) -> Tuple:
+    """
+    获取知识点分析所需的数据库数据（异步）
+    
+    模块列表和用户已有知识点互不依赖，并发查询
+    不依赖 OCR 结果（只需要学科），可以在 OCR 期间提前启动
+    
+    Args:
+        subject: 学科代码
+        user_id: 用户ID
+        databases: Databases 实例（可选）
+        
+    Returns:
+        (模块列表, 已有知识点列表)，查询失败的一项为对应的异常对象
+    """
+    async def fetch_existing_knowledge_points() -> List[Dict]:
+        if not databases:
+            logger.warning(f"⚠️ [知识点查询] databases 为空，跳过查询")
+            return []
+        logger.debug(f"🔍 [知识点查询] 开始查询用户知识点 - user_id: {user_id}, subject: {subject}")
+        return await asyncio.to_thread(
+            get_user_knowledge_points_by_subject,
+            databases=databases,
+            user_id=user_id,
+            subject=subject
+        )
+    
+    return tuple(await asyncio.gather(
+        asyncio.to_thread(get_existing_modules, subject, user_id, databases),
+        fetch_existing_knowledge_points(),
+        return_exceptions=True
+    ))
 
-##SUBJECT##
-学科代码（math/physics/chemistry/biology/chinese/english等）
 
-##CONTENT##
-题目内容（Markdown格式，LaTeX公式用 $ 或 $$ 包裹）
+def start_subject_context_prefetch(
+    subject_guess: str,
+    user_id: str,
+    databases: Optional[Databases] = None
+) -> asyncio.Task:
+    """
+    在 OCR 期间按预测的学科提前启动 fetch_subject_context（推测执行）
+    
+    OCR 识别出的学科与预测一致时，把返回的 task 作为 context_task 传给
+    analyze_subject_and_knowledge_points，否则调用 task.cancel() 丢弃
+    
+    Args:
+        subject_guess: 预测的学科（上次识别结果的学科，或默认学科）
+        user_id: 用户ID
+        databases: Databases 实例（可选）
+        
+    Returns:
+        预取 task
+    """
+    logger.info(f"🔮 提前获取学科 {subject_guess} 的模块和知识点")
+    return asyncio.create_task(fetch_subject_context(subject_guess, user_id, databases))
 
-##OPTIONS##（选择题必需，其他题型可省略）
-A. 选项1
-B. 选项2
-...
 
-##END##
+def retarget_subject_context_prefetch(
+    task: asyncio.Task,
+    subject_guess: str,
+    subject: str,
+    user_id: str,
+    databases: Optional[Databases] = None
+) -> asyncio.Task:
+    """
+    OCR 完成前已识别出学科（流式输出）时调整预取：学科与预测一致时保留 task，否则取消并按识别出的学科重新预取
+    
+    Args:
+        task: 当前的预取 task
+        subject_guess: 当前预取使用的学科
+        subject: 流式 OCR 识别出的学科
+        user_id: 用户ID
+        databases: Databases 实例（可选）
+        
+    Returns:
+        之后使用的预取 task（对应学科 subject）
+    """
+    if subject == subject_guess:
+        return task
+    logger.info(f"🔮 流式 OCR 识别出学科 {subject}（预测 {subject_guess}），按实际学科重新预取")
+    task.cancel()
+    return start_subject_context_prefetch(subject, user_id, databases)
 
-【你的输出】
-{response[:500] if response else '无响应'}...
 
-请严格按照上述格式重新输出，确保所有必需标记都存在。"""
-                # 将错误反馈添加到聊天历史
-                user_prompt = error_feedback
-                print(f"📤 发送错误反馈给 LLM，准备重试...")
-            else:
-                # 最后一次尝试也失败了
-                print(f"❌ 已达到最大重试次数，放弃")
-                if response:
-                    print(f"原始响应: {response[:500]}...")
-                raise
+def take_subject_context_prefetch(task: asyncio.Task, subject_guess: str, subject: str) -> Optional[asyncio.Task]:
+    """
+    OCR 完成后取用推测预取的结果：学科一致返回 task，否则取消并返回 None
+    
+    Args:
+        task: start_subject_context_prefetch 返回的 task
+        subject_guess: 预测的学科
+        subject: OCR 识别出的学科
+    """
+    if subject == subject_guess:
+        return task
+    logger.info(f"🔮 学科预测不一致（预测 {subject_guess}，实际 {subject}），丢弃预取结果")
+    task.cancel()
+    return None
 
 
 async def analyze_subject_and_knowledge_points(
@@ -439,7 +1001,8 @@ async def analyze_subject_and_knowledge_points(
     question_type: str,
     subject: str,
     user_id: str,
-    databases: Optional[Databases] = None
+    databases: Optional[Databases] = None,
+    context_task: Optional[Awaitable[Tuple]] = None
 ) -> Dict:
     """
     第二步：基于题目内容和学科识别模块和知识点（异步）
@@ -458,6 +1021,8 @@ async def analyze_subject_and_knowledge_points(
         subject: 学科代码（从第一步识别得到）
         user_id: 用户ID（用于获取学段信息）
         databases: Databases 实例（可选）
+        context_task: 预取的 fetch_subject_context 结果（可选，必须是同一学科），
+                      为空时现场查询
         
     Returns:
         {
@@ -469,8 +1034,44 @@ async def analyze_subject_and_knowledge_points(
             'solvingHint': str
         }
     """
-    # 获取该学科在用户学段的模块列表
-    available_modules = get_existing_modules(subject, user_id, databases)
+    # 获取该学科在用户学段的模块列表，以及用户在该学科下的所有已有知识点（防止重复）
+    if context_task is None:
+        context_task = fetch_subject_context(subject, user_id, databases)
+    available_modules, kp_docs = await context_task
+    
+    if isinstance(available_modules, Exception):
+        logger.warning(f"获取学科模块失败: {str(available_modules)}")
+        available_modules = []
+    
+    existing_knowledge_points = []
+    if isinstance(kp_docs, Exception):
+        logger.opt(exception=kp_docs).warning(f"⚠️ 获取用户已有知识点失败: {str(kp_docs)}")
+    elif databases:
+        existing_knowledge_points = kp_docs
+        logger.opt(lazy=True).debug(
+            "🔍 [知识点查询] 查询结果: 找到 {} 个知识点，前3个示例: {}",
+            lambda: len(existing_knowledge_points),
+            lambda: [{'name': kp.get('name'), 'moduleId': kp.get('moduleId'), 'subject': kp.get('subject')} for kp in existing_knowledge_points[:3]]
+        )
+    
+    if SKIP_KP_ANALYSIS_WITHOUT_CONTEXT and not available_modules and not existing_knowledge_points:
+        # 没有任何可选模块时 LLM 只能归入"未分类"，直接返回
+        logger.info(f"⏭️ 学科 {subject} 没有可用模块和已有知识点，跳过知识点分析")
+        uncategorized_kp = {
+            'name': '未分类',
+            'module': '未分类',
+            'moduleId': None,
+            'category': 'primary',
+            'importance': 'normal'
+        }
+        return {
+            'subject': subject,
+            'modules': ['未分类'],
+            'moduleIds': [],
+            'knowledgePoints': [uncategorized_kp],
+            'primaryKnowledgePoints': [uncategorized_kp],
+            'solvingHint': ''
+        }
     
     # 构建模块列表文本和ID映射
     modules_text = ""
@@ -485,34 +1086,13 @@ async def analyze_subject_and_knowledge_points(
                 modules_list.append(f"  - {mod['name']}")
         modules_text = "\n".join(modules_list)
     
-    # 获取用户在该学科下的所有已有知识点（防止重复）
-    existing_knowledge_points = []
-    if databases:
-        print(f"🔍 [知识点查询] 开始查询用户知识点 - user_id: {user_id}, subject: {subject}")
-        try:
-            kp_docs = await asyncio.to_thread(
-                get_user_knowledge_points_by_subject,
-                databases=databases,
-                user_id=user_id,
-                subject=subject
-            )
-            existing_knowledge_points = kp_docs
-            print(f"🔍 [知识点查询] 查询结果: 找到 {len(existing_knowledge_points)} 个知识点")
-            if existing_knowledge_points:
-                print(f"🔍 [知识点查询] 前3个知识点示例: {[{'name': kp.get('name'), 'moduleId': kp.get('moduleId'), 'subject': kp.get('subject')} for kp in existing_knowledge_points[:3]]}")
-        except Exception as e:
-            print(f"⚠️ 获取用户已有知识点失败: {str(e)}")
-            import traceback
-            traceback.print_exc()
-    else:
-        print(f"⚠️ [知识点查询] databases 为空，跳过查询")
-    
     # 构建已有知识点列表文本（按模块分组）
     knowledge_points_text = ""
+    existing_kp_names_by_module = {}  # {module_id: 知识点名称集合}，用于判断分析出的知识点是否已存在
     if existing_knowledge_points:
-        print(f"🔍 [知识点分组] 开始按模块分组，共 {len(existing_knowledge_points)} 个知识点")
         # 按模块ID分组知识点
         kp_by_module_id = {}
+        skipped_kp_names = []
         for kp in existing_knowledge_points:
             module_id = kp.get('moduleId')
             kp_name = kp.get('name', '未知')
@@ -521,62 +1101,47 @@ async def analyze_subject_and_knowledge_points(
                     kp_by_module_id[module_id] = []
                 kp_by_module_id[module_id].append(kp_name)
             else:
-                print(f"⚠️ [知识点分组] 知识点 '{kp_name}' 没有 moduleId，跳过")
+                skipped_kp_names.append(kp_name)
+        
+        existing_kp_names_by_module = {
+            module_id: set(kp_names) for module_id, kp_names in kp_by_module_id.items()
+        }
         
-        print(f"🔍 [知识点分组] 分组完成，共 {len(kp_by_module_id)} 个模块")
-        for module_id, kp_names in kp_by_module_id.items():
-            print(f"  - 模块 {module_id}: {len(kp_names)} 个知识点 - {kp_names[:3]}{'...' if len(kp_names) > 3 else ''}")
+        if skipped_kp_names:
+            logger.warning(f"⚠️ [知识点分组] {len(skipped_kp_names)} 个知识点没有 moduleId，跳过: {skipped_kp_names[:10]}")
+        logger.debug(f"🔍 [知识点分组] 共 {len(existing_knowledge_points)} 个知识点，分布在 {len(kp_by_module_id)} 个模块")
         
         if kp_by_module_id:
-            # 查询所有涉及的模块信息（获取模块名称）
-            DATABASE_ID = os.environ.get('APPWRITE_DATABASE_ID', 'main')
-            COLLECTION_MODULES = 'knowledge_points_library'
-            
-            module_ids = list(kp_by_module_id.keys())
-            module_name_map = {}  # {module_id: module_name}
+            # 模块名称优先取自已查询的可用模块列表，只查询不在列表中的模块
+            module_name_map = {mod_id: name for name, mod_id in modules_dict.items()}  # {module_id: module_name}
+            module_ids = [module_id for module_id in kp_by_module_id if module_id not in module_name_map]
             
-            print(f"🔍 [模块查询] 开始查询 {len(module_ids)} 个模块的名称")
-            # 批量查询模块信息
-            try:
-                for module_id in module_ids:
-                    try:
-                        module_doc = await asyncio.to_thread(
-                            databases.get_document,
-                            database_id=DATABASE_ID,
-                            collection_id=COLLECTION_MODULES,
-                            document_id=module_id
-                        )
-                        module_name = module_doc.get('name', '未知模块')
-                        module_name_map[module_id] = module_name
-                        print(f"  ✓ 模块 {module_id} -> {module_name}")
-                    except Exception as e:
-                        print(f"⚠️ 获取模块 {module_id} 信息失败: {str(e)}")
-                        module_name_map[module_id] = '未知模块'
-            except Exception as e:
-                print(f"⚠️ 批量查询模块信息失败: {str(e)}")
-                import traceback
-                traceback.print_exc()
+            # 批量查询模块信息（一次请求代替逐个 get_document）
+            if module_ids:
+                try:
+                    module_docs = await asyncio.to_thread(fetch_modules_by_ids, databases, module_ids)
+                    module_name_map.update(
+                        (doc['$id'], doc.get('name', '未知模块'))
+                        for doc in module_docs
+                    )
+                    missing_module_ids = [module_id for module_id in module_ids if module_id not in module_name_map]
+                    if missing_module_ids:
+                        logger.warning(f"⚠️ 获取模块信息失败，模块不存在: {missing_module_ids}")
+                except Exception as e:
+                    logger.exception(f"⚠️ 批量查询模块信息失败: {str(e)}")
             
             # 格式化知识点文本（按模块分组）
-            print(f"🔍 [格式化] 开始格式化知识点文本")
-            kp_text_list = []
-            for module_id, kp_names in kp_by_module_id.items():
-                module_name = module_name_map.get(module_id, '未知模块')
-                kp_text = f"**{module_name}模块**：{', '.join(kp_names)}"
-                kp_text_list.append(kp_text)
-                print(f"  - {kp_text}")
-            
-            if kp_text_list:
-                knowledge_points_text = "\n".join(kp_text_list)
-                print(f"✓ [格式化完成] 已获取 {len(existing_knowledge_points)} 个已有知识点，分布在 {len(kp_by_module_id)} 个模块中")
-                print(f"🔍 [格式化结果] 知识点文本长度: {len(knowledge_points_text)} 字符")
-                print(f"🔍 [格式化结果] 知识点文本预览:\n{knowledge_points_text[:200]}...")
-            else:
-                print(f"⚠️ [格式化] kp_text_list 为空")
-        else:
-            print(f"⚠️ [知识点分组] kp_by_module_id 为空")
+            knowledge_points_text = "\n".join(
+                f"**{module_name_map.get(module_id, '未知模块')}模块**：{', '.join(kp_names)}"
+                for module_id, kp_names in kp_by_module_id.items()
+            )
+            logger.opt(lazy=True).debug(
+                "✓ [格式化完成] 知识点文本长度: {} 字符，预览:\n{}...",
+                lambda: len(knowledge_points_text),
+                lambda: knowledge_points_text[:200]
+            )
     else:
-        print(f"⚠️ [知识点查询] existing_knowledge_points 为空，没有找到知识点")
+        logger.info(f"[知识点查询] 没有找到已有知识点")
     
     # 构建 prompt
     system_prompt = get_knowledge_points_system_prompt()
@@ -599,10 +1164,10 @@ async def analyze_subject_and_knowledge_points(
         response = None
         try:
             if attempt == 0:
-                print(f"🔍 开始知识点分析...")
-                print(f"🔍 用户提示: {user_prompt}")
+                logger.debug(f"🔍 开始知识点分析...")
+                logger.debug(f"🔍 用户提示: {user_prompt}")
             else:
-                print(f"🔄 知识点分析第 {attempt + 1} 次重试...")
+                logger.info(f"🔄 知识点分析第 {attempt + 1} 次重试...")
             
             response = await llm.chat(
                 prompt=user_prompt,
@@ -613,11 +1178,11 @@ async def analyze_subject_and_knowledge_points(
                 reasoning_effort="low"
             )
             
-            print(f"📋 LLM 返回的知识点分析: {response[:200]}...")
+            logger.debug(f"📋 LLM 返回的知识点分析: {response[:200]}...")
             
             result = parse_knowledge_points_response(response)
             
-            print(f"✅ 知识点分析解析成功！")
+            logger.info(f"✅ 知识点分析解析成功！")
             
             # 设置学科
             result['subject'] = subject
@@ -638,17 +1203,17 @@ async def analyze_subject_and_knowledge_points(
                 module_name = _normalize_module_name(module_name)
                 
                 if original_name != module_name:
-                    print(f"⚠ 自动修正模块名: '{original_name}' -> '{module_name}'")
+                    logger.warning(f"⚠ 自动修正模块名: '{original_name}' -> '{module_name}'")
                 
                 if module_name in modules_dict:
                     validated_modules.append(module_name)
                     validated_module_ids[module_name] = modules_dict[module_name]
-                    print(f"✓ 模块匹配: {module_name}")
+                    logger.debug(f"✓ 模块匹配: {module_name}")
                 else:
-                    print(f"⚠ 模块 '{module_name}' 不在列表中，忽略")
+                    logger.warning(f"⚠ 模块 '{module_name}' 不在列表中，忽略")
             
             if not validated_modules:
-                print(f"⚠ 无有效模块，使用'未分类'")
+                logger.warning(f"⚠ 无有效模块，使用'未分类'")
                 validated_modules = ['未分类']
                 if '未分类' in modules_dict:
                     validated_module_ids['未分类'] = modules_dict['未分类']
@@ -665,7 +1230,7 @@ async def analyze_subject_and_knowledge_points(
             
             for kp in knowledge_points:
                 if not isinstance(kp, dict):
-                    print(f"⚠ 知识点格式错误，跳过: {kp}")
+                    logger.warning(f"⚠ 知识点格式错误，跳过: {kp}")
                     continue
                 
                 kp_name = kp.get('name', '')
@@ -678,7 +1243,7 @@ async def analyze_subject_and_knowledge_points(
                     original_module = kp_module
                     kp_module = _normalize_module_name(kp_module)
                     if original_module != kp_module:
-                        print(f"⚠ 自动修正知识点模块名: '{original_module}' -> '{kp_module}'")
+                        logger.warning(f"⚠ 自动修正知识点模块名: '{original_module}' -> '{kp_module}'")
                 
                 # 验证 category 和 importance
                 if kp_category not in ['primary', 'secondary', 'related']:
@@ -691,17 +1256,16 @@ async def analyze_subject_and_knowledge_points(
                 
                 # 确保知识点的模块在验证列表中
                 if kp_module not in validated_modules:
-                    print(f"⚠ 知识点 '{kp_name}' 的模块 '{kp_module}' 无效，改用 '{validated_modules[0]}'")
+                    logger.warning(f"⚠ 知识点 '{kp_name}' 的模块 '{kp_module}' 无效，改用 '{validated_modules[0]}'")
                     kp_module = validated_modules[0]
                 
                 # 获取该模块下已有的知识点进行匹配
                 module_id = validated_module_ids.get(kp_module)
                 if module_id and databases:
-                    existing_kp_names = get_existing_knowledge_points_by_module(module_id, user_id, databases)
-                    if kp_name in existing_kp_names:
-                        print(f"  ✓ 知识点: {kp_name} ({kp_module}) | 题目角色={kp_category} | 重要性={kp_importance}")
+                    if kp_name in existing_kp_names_by_module.get(module_id, ()):
+                        logger.debug(f"  ✓ 知识点: {kp_name} ({kp_module}) | 题目角色={kp_category} | 重要性={kp_importance}")
                     else:
-                        print(f"  + 新知识点: {kp_name} ({kp_module}) | 题目角色={kp_category} | 重要性={kp_importance}")
+                        logger.debug(f"  + 新知识点: {kp_name} ({kp_module}) | 题目角色={kp_category} | 重要性={kp_importance}")
                 
                 # 记录主要考点
                 kp_data = {
@@ -723,10 +1287,10 @@ async def analyze_subject_and_knowledge_points(
                 solving_hint = ''
             solving_hint = solving_hint.strip()
             
-            print(f"📝 解题提示: {solving_hint[:50]}..." if solving_hint else "⚠ 未提供解题提示")
-            print(f"🎯 主要考点（category=primary）: {len(primary_kps)} 个")
+            logger.info(f"📝 解题提示: {solving_hint[:50]}..." if solving_hint else "⚠ 未提供解题提示")
+            logger.info(f"🎯 主要考点（category=primary）: {len(primary_kps)} 个")
             for kp in primary_kps:
-                print(f"   - {kp['name']} (重要性: {kp['importance']})")
+                logger.debug(f"   - {kp['name']} (重要性: {kp['importance']})")
             
             return {
                 'subject': subject,
@@ -739,51 +1303,17 @@ async def analyze_subject_and_knowledge_points(
             
         except Exception as e:
             error_msg = str(e)
-            print(f"❌ 知识点分析失败（尝试 {attempt + 1}/{max_retries}）: {error_msg}")
+            logger.error(f"❌ 知识点分析失败（尝试 {attempt + 1}/{max_retries}）: {error_msg}")
             
             if attempt < max_retries - 1:
                 # 构造格式化的错误反馈
-                error_feedback = f"""⚠️ 你的上一次输出格式有错误，无法解析：
-
-【错误信息】
-{error_msg}
-
-【要求的格式】
-##MODULES##
-模块名1
-模块名2
-...
-
-##KNOWLEDGE_POINTS##
-知识点名|模块名|category|importance
-知识点名|模块名|category|importance
-...
-
-说明：
-- category 必须是：primary（主要考点）/secondary（次要考点）/related（相关知识）
-- importance 必须是：high（高频重点）/basic（基础必会）/normal（常规知识）
-
-##SOLVING_HINT##
-解题提示内容（可以包含 LaTeX 公式）
-
-##END##
-
-【可用的模块列表】
-{modules_text if modules_text else '（无可用模块，请使用"未分类"）'}
-
-【你的输出】
-{response[:500] if response else '无响应'}...
-
-请严格按照上述格式重新输出，确保：
-1. 所有标记都存在
-2. 知识点格式为：知识点名|模块名|category|importance（用 | 分隔）
-3. category 和 importance 的值必须在允许的范围内"""
+                error_feedback = build_knowledge_points_retry_prompt(error_msg, response, modules_text)
                 # 将错误反馈添加到聊天历史
                 user_prompt = error_feedback
-                print(f"📤 发送错误反馈给 LLM，准备重试...")
+                logger.info(f"📤 发送错误反馈给 LLM，准备重试...")
             else:
                 # 最后一次尝试也失败了
-                print(f"❌ 已达到最大重试次数，放弃")
+                logger.error(f"❌ 已达到最大重试次数，放弃")
                 if response:
-                    print(f"原始响应: {response[:500]}...")
+                    logger.info(f"原始响应: {response[:500]}...")
                 raise
@@ -13,6 +13,13 @@
         image_url="https://example.com/image.jpg"
     )
     
+    # 视觉分析（流式，逐段产出增量文本）
+    async for delta in provider.chat_with_vision_stream(
+        prompt="分析这张图片中的数学题",
+        image_base64=image_base64
+    ):
+        print(delta, end="")
+    
     # 启用思考模式（深度分析）
     response = await provider.chat(
         prompt="分析这道题",
@@ -40,7 +47,8 @@ import os
 import json
 import base64
 import asyncio
-from typing import Dict, List, Optional, Any, Union
+import orjson
+from typing import AsyncIterator, Dict, List, Optional, Any, Union
 
 try:
     from volcenginesdkarkruntime import Ark
@@ -338,57 +346,19 @@ class VolcengineLLMProvider:
         """使用火山引擎 SDK 进行视觉对话 - 支持多图"""
         
         async def _make_request():
-            # 构建消息
-            messages = []
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
-            
-            # 构建包含图片的消息内容
-            content = [{"type": "text", "text": prompt}]
-            
-            # 处理图片 URL（支持列表）
-            if image_url:
-                urls = [image_url] if isinstance(image_url, str) else image_url
-                for url in urls:
-                    content.append({
-                        "type": "image_url",
-                        "image_url": {"url": url}
-                    })
-            # 处理 base64 图片（支持列表）
-            elif image_base64:
-                base64_list = [image_base64] if isinstance(image_base64, str) else image_base64
-                for b64 in base64_list:
-                    # 确保有正确的前缀
-                    formatted_image = b64
-                    if not formatted_image.startswith('data:'):
-                        formatted_image = f"data:image/jpeg;base64,{formatted_image}"
-                    content.append({
-                        "type": "image_url",
-                        "image_url": {"url": formatted_image}
-                    })
-            
-            messages.append({"role": "user", "content": content})
-            
-            # 构建参数
-            params = {
-                "model": self.endpoint_id,
-                "messages": messages,
-                "temperature": temperature if temperature is not None else self.default_temperature,
-                "top_p": top_p if top_p is not None else self.default_top_p,
-                "max_tokens": max_tokens if max_tokens is not None else self.default_max_tokens,
-                "stream": stream,
-            }
-            
-            # 添加思考模式参数
-            if thinking is not None:
-                params["thinking"] = thinking
-            
-            if reasoning_effort is not None:
-                params["reasoning_effort"] = reasoning_effort
-            
-            # 添加其他参数
-            params.update(kwargs)
-            params.update(self.extra_params)
+            params = self._build_vision_params(
+                prompt=prompt,
+                image_url=image_url,
+                image_base64=image_base64,
+                system_prompt=system_prompt,
+                temperature=temperature,
+                top_p=top_p,
+                max_tokens=max_tokens,
+                thinking=thinking,
+                reasoning_effort=reasoning_effort,
+                stream=stream,
+                **kwargs
+            )
             
             # 在事件循环中调用同步的 SDK
             loop = asyncio.get_event_loop()
@@ -410,6 +380,149 @@ class VolcengineLLMProvider:
         
         return await self._retry_request(_make_request)
     
+    def _build_vision_params(
+        self,
+        prompt: str,
+        image_url: Optional[Union[str, List[str]]] = None,
+        image_base64: Optional[Union[str, List[str]]] = None,
+        system_prompt: Optional[str] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        thinking: Optional[Dict[str, str]] = None,
+        reasoning_effort: Optional[str] = None,
+        stream: bool = False,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """构建视觉对话的请求参数 - 支持多图"""
+        # 构建消息
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        
+        # 构建包含图片的消息内容
+        content = [{"type": "text", "text": prompt}]
+        
+        # 处理图片 URL（支持列表）
+        if image_url:
+            urls = [image_url] if isinstance(image_url, str) else image_url
+            for url in urls:
+                content.append({
+                    "type": "image_url",
+                    "image_url": {"url": url}
+                })
+        # 处理 base64 图片（支持列表）
+        elif image_base64:
+            base64_list = [image_base64] if isinstance(image_base64, str) else image_base64
+            for b64 in base64_list:
+                # 确保有正确的前缀
+                formatted_image = b64
+                if not formatted_image.startswith('data:'):
+                    formatted_image = f"data:image/jpeg;base64,{formatted_image}"
+                content.append({
+                    "type": "image_url",
+                    "image_url": {"url": formatted_image}
+                })
+        
+        messages.append({"role": "user", "content": content})
+        
+        # 构建参数
+        params = {
+            "model": self.endpoint_id,
+            "messages": messages,
+            "temperature": temperature if temperature is not None else self.default_temperature,
+            "top_p": top_p if top_p is not None else self.default_top_p,
+            "max_tokens": max_tokens if max_tokens is not None else self.default_max_tokens,
+            "stream": stream,
+        }
+        
+        # 添加思考模式参数
+        if thinking is not None:
+            params["thinking"] = thinking
+        
+        if reasoning_effort is not None:
+            params["reasoning_effort"] = reasoning_effort
+        
+        # 添加其他参数
+        params.update(kwargs)
+        params.update(self.extra_params)
+        
+        return params
+    
+    async def chat_with_vision_stream(
+        self,
+        prompt: str,
+        image_url: Optional[Union[str, List[str]]] = None,
+        image_base64: Optional[Union[str, List[str]]] = None,
+        system_prompt: Optional[str] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+        thinking: Optional[Dict[str, str]] = None,
+        reasoning_effort: Optional[str] = None,
+        **kwargs
+    ) -> AsyncIterator[str]:
+        """
+        视觉对话（多模态，流式，异步生成器）- 支持单图和多图
+        
+        逐段产出模型回答的增量文本（不包含思考过程），调用方可以边接收边解析
+        
+        注意：只有建立连接时会重试，开始输出后出错直接抛出（已产出的内容无法撤回）
+        
+        Args:
+            与 chat_with_vision 相同（不需要 stream 参数）
+            
+        Yields:
+            增量文本
+        """
+        
+        if not image_url and not image_base64:
+            raise ValueError("必须提供 image_url 或 image_base64")
+        
+        params = self._build_vision_params(
+            prompt=prompt,
+            image_url=image_url,
+            image_base64=image_base64,
+            system_prompt=system_prompt,
+            temperature=temperature,
+            top_p=top_p,
+            max_tokens=max_tokens,
+            thinking=thinking,
+            reasoning_effort=reasoning_effort,
+            stream=True,
+            **kwargs
+        )
+        
+        if self.client and Ark:
+            deltas = self._stream_with_sdk(params)
+        else:
+            deltas = self._stream_with_http(params)
+        async for delta in deltas:
+            yield delta
+    
+    async def _stream_with_sdk(self, params: Dict[str, Any]) -> AsyncIterator[str]:
+        """使用火山引擎 SDK 进行流式对话"""
+        loop = asyncio.get_running_loop()
+        
+        async def _open_stream():
+            return await loop.run_in_executor(
+                None,
+                lambda: self.client.chat.completions.create(**params)
+            )
+        
+        response = await self._retry_request(_open_stream)
+        with response:
+            chunks = iter(response)
+            while True:
+                # SDK 的流是同步迭代器，在线程池中逐块读取，避免阻塞事件循环
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk.choices:
+                    content = chunk.choices[0].delta.content
+                    if content:
+                        yield content
+    
     # ============ HTTP 降级方案 ============
     
     async def _chat_with_http(
@@ -564,6 +677,35 @@ class VolcengineLLMProvider:
         
         return await self._retry_request(_make_request)
     
+    async def _stream_with_http(self, payload: Dict[str, Any]) -> AsyncIterator[str]:
+        """使用 HTTP 方式进行流式对话（降级方案，解析 SSE 事件）"""
+        import httpx
+        
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            async with client.stream(
+                "POST",
+                f"{self.endpoint}/chat/completions",
+                headers=headers,
+                json=payload
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith('data:'):
+                        continue
+                    data = line[5:].strip()
+                    if data == '[DONE]':
+                        break
+                    choices = orjson.loads(data).get('choices')
+                    if choices:
+                        content = choices[0].get('delta', {}).get('content')
+                        if content:
+                            yield content
+    
     async def _retry_request(self, request_func, *args, **kwargs):
         """带重试机制的异步请求"""
         last_error = None
@@ -4,7 +4,47 @@
 """
 import re
 import json
-from typing import Dict
+import orjson
+from typing import Dict, List, Optional
+from loguru import logger
+
+
+# 分段标记解析用的正则（模块加载时编译一次）
+_TYPE_RE = re.compile(r'##TYPE##\s*\n\s*(\w+)', re.IGNORECASE)
+_SUBJECT_RE = re.compile(r'##SUBJECT##\s*\n\s*(\w+)', re.IGNORECASE)
+_SUBJECT_TAG_RE = re.compile(r'##SUBJECT##', re.IGNORECASE)
+# [index] 可选；[^\S\n] 为不含换行的空白，保证单个 bbox 不跨行
+_BBOX_RE = re.compile(
+    r'(?:\[(\d+)\][^\S\n]*)?<bbox>[^\S\n]*(\d+)[^\S\n]+(\d+)[^\S\n]+(\d+)[^\S\n]+(\d+)[^\S\n]*</bbox>'
+)
+
+# 段落的起始标记和结束标记（段落内容为起始标记之后到第一个结束标记或文本末尾）
+_CONTENT_HEADER_RE = re.compile(r'##CONTENT##\s*\n', re.IGNORECASE)
+_CONTENT_END_RE = re.compile(r'##(?:OPTIONS|PIC|END)##', re.IGNORECASE)
+_OPTIONS_HEADER_RE = re.compile(r'##OPTIONS##\s*\n', re.IGNORECASE)
+_OPTIONS_END_RE = re.compile(r'##(?:PIC|END)##', re.IGNORECASE)
+_PIC_HEADER_RE = re.compile(r'##PIC##\s*\n', re.IGNORECASE)
+_MODULES_HEADER_RE = re.compile(r'##MODULES##\s*\n', re.IGNORECASE)
+_MODULES_END_RE = re.compile(r'##(?:KNOWLEDGE_POINTS|END)##', re.IGNORECASE)
+_KP_HEADER_RE = re.compile(r'##KNOWLEDGE_POINTS##\s*\n', re.IGNORECASE)
+_KP_END_RE = re.compile(r'##(?:SOLVING_HINT|END)##', re.IGNORECASE)
+_SOLVING_HINT_HEADER_RE = re.compile(r'##SOLVING_HINT##\s*\n', re.IGNORECASE)
+_SOLVING_HINT_TAG_RE = re.compile(r'##SOLVING_HINT##', re.IGNORECASE)
+_END_RE = re.compile(r'##END##', re.IGNORECASE)
+
+# 流式解析时 ##SUBJECT## 位于响应开头，超过这个长度仍未识别出学科就不再扫描
+_STREAM_SUBJECT_SCAN_LIMIT = 4096
+
+# 非空行（去除首尾空白，等价于逐行 strip 后过滤空行）
+_NONEMPTY_LINE_RE = re.compile(r'\S(?:[^\n]*\S)?')
+
+# JSON 字符串字面量（允许未闭合）及其中的转义序列（按反斜杠+字符成对匹配，连续的反斜杠不会被拆开）
+_JSON_STRING_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"?', re.DOTALL)
+_JSON_ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
+_JSON_VALID_ESCAPES = frozenset('ntrfb"\\/')
+
+# JSON 对象/数组的起止字符
+_JSON_CLOSING = {'{': '}', '[': ']'}
 
 
 def clean_json_response(response: str) -> str:
@@ -26,16 +66,39 @@ def clean_json_response(response: str) -> str:
 def _clean_code_blocks(response: str) -> str:
     """清理代码块标记的通用函数"""
     response = response.strip()
-    if response.startswith('```'):
-        lines = response.split('\n')
-        if lines[0].startswith('```'):
-            lines = lines[1:]
-        if lines and lines[-1].strip() == '```':
-            lines = lines[:-1]
-        response = '\n'.join(lines)
+    if not response.startswith('```'):
+        return response
+    
+    # 去掉第一行（```json 等）和最后一行的 ```，只切分首尾两行，不拆分整个响应
+    _, _, response = response.partition('\n')
+    body, _, last_line = response.rpartition('\n')
+    if last_line.strip() == '```':
+        response = body
     return response
 
 
+def _find_section(response: str, header_re: re.Pattern, end_re: re.Pattern) -> Optional[str]:
+    """
+    提取分段标记之间的内容
+    
+    先定位起始标记，再从标记之后查找第一个结束标记
+    （等价于 header(.*?)(?=结束标记|$) 的非贪婪匹配，但不需要在每个字符处尝试前瞻）
+    
+    Args:
+        response: LLM 返回的分段标记格式文本
+        header_re: 起始标记正则
+        end_re: 结束标记正则
+        
+    Returns:
+        段落内容（未 strip），没有起始标记返回 None
+    """
+    header_match = header_re.search(response)
+    if not header_match:
+        return None
+    end_match = end_re.search(response, header_match.end())
+    return response[header_match.end():end_match.start() if end_match else len(response)]
+
+
 def parse_segmented_response(response: str) -> Dict:
     """
     解析分段标记格式的 LLM 响应（题目内容提取）
@@ -69,65 +132,41 @@ def parse_segmented_response(response: str) -> Dict:
     sections = {}
     
     # 提取 TYPE
-    type_match = re.search(r'##TYPE##\s*\n\s*(\w+)', response, re.IGNORECASE)
+    type_match = _TYPE_RE.search(response)
     if type_match:
         sections['type'] = type_match.group(1).strip()
     
     # 提取 SUBJECT
-    subject_match = re.search(r'##SUBJECT##\s*\n\s*(\w+)', response, re.IGNORECASE)
+    subject_match = _SUBJECT_RE.search(response)
     if subject_match:
         sections['subject'] = subject_match.group(1).strip()
     
     # 提取 CONTENT（到下一个标记为止，##OPTIONS## 或 ##PIC## 或 ##END## 可选）
-    content_match = re.search(r'##CONTENT##\s*\n(.*?)(?=##OPTIONS##|##PIC##|##END##|$)', response, re.DOTALL | re.IGNORECASE)
-    if content_match:
-        sections['content'] = content_match.group(1).strip()
+    content_text = _find_section(response, _CONTENT_HEADER_RE, _CONTENT_END_RE)
+    if content_text is not None:
+        sections['content'] = content_text.strip()
     
     # 提取 OPTIONS（如果存在，##PIC## 或 ##END## 可选）
-    options_match = re.search(r'##OPTIONS##\s*\n(.*?)(?=##PIC##|##END##|$)', response, re.DOTALL | re.IGNORECASE)
-    if options_match:
-        options_text = options_match.group(1).strip()
-        sections['options'] = [line.strip() for line in options_text.split('\n') if line.strip()] if options_text else []
+    options_text = _find_section(response, _OPTIONS_HEADER_RE, _OPTIONS_END_RE)
+    if options_text is not None:
+        options_text = options_text.strip()
+        sections['options'] = _NONEMPTY_LINE_RE.findall(options_text)
     else:
         sections['options'] = []
 
     # 提取 PIC（如果存在，##END## 可选）
-    pic_match = re.search(r'##PIC##\s*\n(.*?)(?=##END##|$)', response, re.DOTALL | re.IGNORECASE)
-    if pic_match:
-        pic_text = pic_match.group(1).strip()
+    pic_text = _find_section(response, _PIC_HEADER_RE, _END_RE)
+    if pic_text is not None:
+        pic_text = pic_text.strip()
         if pic_text:
-            # 解析 bbox 列表: [index] <bbox>x1 y1 x2 y2</bbox>
-            bboxes = []
-            for line in pic_text.split('\n'):
-                line = line.strip()
-                if not line: continue
-                
-                # 尝试匹配带索引的
-                idx_bbox_match = re.search(r'\[(\d+)\]\s*<bbox>\s*(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s*</bbox>', line)
-                if idx_bbox_match:
-                    bboxes.append({
-                        'index': int(idx_bbox_match.group(1)) - 1, # 转为 0-based
-                        'bbox': [
-                            int(idx_bbox_match.group(2)), 
-                            int(idx_bbox_match.group(3)), 
-                            int(idx_bbox_match.group(4)), 
-                            int(idx_bbox_match.group(5))
-                        ]
-                    })
-                    continue
-                
-                # 尝试匹配不带索引的 (默认第0张图)
-                bbox_match = re.search(r'<bbox>\s*(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s*</bbox>', line)
-                if bbox_match:
-                    bboxes.append({
-                        'index': 0,
-                        'bbox': [
-                            int(bbox_match.group(1)), 
-                            int(bbox_match.group(2)), 
-                            int(bbox_match.group(3)), 
-                            int(bbox_match.group(4))
-                        ]
-                    })
+            # 解析 bbox 列表: [index] <bbox>x1 y1 x2 y2</bbox>，不带索引的默认第0张图
+            bboxes = [
+                {
+                    'index': int(m.group(1)) - 1 if m.group(1) else 0,  # 转为 0-based
+                    'bbox': [int(m.group(2)), int(m.group(3)), int(m.group(4)), int(m.group(5))]
+                }
+                for m in _BBOX_RE.finditer(pic_text)
+            ]
 
             if bboxes:
                 sections['bboxes'] = bboxes
@@ -143,6 +182,70 @@ def parse_segmented_response(response: str) -> Dict:
     return sections
 
 
+class SegmentedStreamParser:
+    """
+    分段标记格式的增量解析器（配合流式输出使用）
+    
+    边接收边查找 ##SUBJECT## 段落，学科一旦完整就可以使用，不需要等待整个响应；
+    完整结果仍然用 parse_segmented_response 解析 text，与非流式结果一致
+    
+    用法：
+        parser = SegmentedStreamParser()
+        async for delta in stream:
+            if parser.feed(delta):
+                on_subject(parser.subject)
+        result = parse_segmented_response(parser.text)
+    """
+    
+    def __init__(self):
+        self._chunks: List[str] = []
+        self._buffer = ''  # 识别出学科之前已接收的文本
+        self._header_pos = -1  # ##SUBJECT## 标记的位置
+        self._scanning = True
+        self.subject: Optional[str] = None
+    
+    def feed(self, chunk: str) -> bool:
+        """
+        接收一段增量文本
+        
+        Args:
+            chunk: 增量文本
+            
+        Returns:
+            是否在这一段中识别出了学科（每个响应最多返回一次 True）
+        """
+        self._chunks.append(chunk)
+        if not self._scanning:
+            return False
+        
+        # 只在新增文本（以及可能跨段的标记前缀）中查找标记，不重复扫描已接收的部分
+        search_from = max(0, len(self._buffer) - len('##SUBJECT##') + 1)
+        self._buffer += chunk
+        if self._header_pos < 0:
+            header_match = _SUBJECT_TAG_RE.search(self._buffer, search_from)
+            if header_match:
+                self._header_pos = header_match.start()
+        
+        if self._header_pos >= 0:
+            subject_match = _SUBJECT_RE.match(self._buffer, self._header_pos)
+            # 学科后面已经有其他字符才算完整，否则下一段可能还会接着这个单词
+            if subject_match and subject_match.end() < len(self._buffer):
+                self.subject = subject_match.group(1).strip()
+                self._scanning = False
+                self._buffer = ''
+                return True
+        
+        if len(self._buffer) > _STREAM_SUBJECT_SCAN_LIMIT:
+            self._scanning = False
+            self._buffer = ''
+        return False
+    
+    @property
+    def text(self) -> str:
+        """已接收的完整文本"""
+        return ''.join(self._chunks)
+
+
 def parse_knowledge_points_response(response: str) -> Dict:
     """
     解析分段标记格式的知识点分析响应
@@ -178,34 +281,24 @@ def parse_knowledge_points_response(response: str) -> Dict:
     sections = {}
     
     # 提取 MODULES
-    modules_match = re.search(r'##MODULES##\s*\n(.*?)(?=##KNOWLEDGE_POINTS##|##END##|$)', response, re.DOTALL | re.IGNORECASE)
-    if modules_match:
-        modules_text = modules_match.group(1).strip()
-        sections['modules'] = [line.strip() for line in modules_text.split('\n') if line.strip()] if modules_text else []
+    modules_text = _find_section(response, _MODULES_HEADER_RE, _MODULES_END_RE)
+    if modules_text is not None:
+        modules_text = modules_text.strip()
+        sections['modules'] = _NONEMPTY_LINE_RE.findall(modules_text)
     else:
         sections['modules'] = []
     
     # 提取 KNOWLEDGE_POINTS
-    kp_match = re.search(r'##KNOWLEDGE_POINTS##\s*\n(.*?)(?=##SOLVING_HINT##|##END##|$)', response, re.DOTALL | re.IGNORECASE)
-    if kp_match:
-        kp_text = kp_match.group(1).strip()
+    kp_text = _find_section(response, _KP_HEADER_RE, _KP_END_RE)
+    if kp_text is not None:
+        kp_text = kp_text.strip()
         if kp_text:
             kp_list = []
-            for line in kp_text.split('\n'):
-                line = line.strip()
-                if not line:
-                    continue
-                # 解析格式：知识点名|模块名|category|importance
-                parts = line.split('|')
-                if len(parts) >= 4:
-                    kp_list.append({
-                        'name': parts[0].strip(),
-                        'module': parts[1].strip(),
-                        'category': parts[2].strip(),
-                        'importance': parts[3].strip()
-                    })
-                elif len(parts) >= 2:
-                    # 容错：如果只有部分字段，使用默认值
+            for line in _NONEMPTY_LINE_RE.findall(kp_text):
+                # 解析格式：知识点名|模块名|category|importance（只需前 4 个字段，多余部分不再切分）
+                parts = line.split('|', 4)
+                if len(parts) >= 2:
+                    # 容错：缺少 category 或 importance 时使用默认值
                     kp_list.append({
                         'name': parts[0].strip(),
                         'module': parts[1].strip(),
@@ -219,16 +312,16 @@ def parse_knowledge_points_response(response: str) -> Dict:
         sections['knowledgePoints'] = []
     
     # 提取 SOLVING_HINT
-    hint_match = re.search(r'##SOLVING_HINT##\s*\n(.*?)(?=##END##|$)', response, re.DOTALL | re.IGNORECASE)
-    if hint_match:
-        sections['solvingHint'] = hint_match.group(1).strip()
-        print(f"✓ 成功提取解题提示，长度: {len(sections['solvingHint'])} 字符")
+    hint_text = _find_section(response, _SOLVING_HINT_HEADER_RE, _END_RE)
+    if hint_text is not None:
+        sections['solvingHint'] = hint_text.strip()
+        logger.debug("✓ 成功提取解题提示，长度: {} 字符", len(sections['solvingHint']))
     else:
         sections['solvingHint'] = ''
-        if '##SOLVING_HINT##' in response.upper():
-            print(f"⚠️ 发现 ##SOLVING_HINT## 标记但无法匹配，响应末尾100字符: ...{response[-100:]}")
+        if _SOLVING_HINT_TAG_RE.search(response):
+            logger.warning(f"⚠️ 发现 ##SOLVING_HINT## 标记但无法匹配，响应末尾100字符: ...{response[-100:]}")
         else:
-            print(f"⚠️ 响应中不包含 ##SOLVING_HINT## 标记")
+            logger.warning("⚠️ 响应中不包含 ##SOLVING_HINT## 标记")
     
     # 验证必需字段，设置默认值
     if not sections.get('modules'):
@@ -244,6 +337,13 @@ def parse_knowledge_points_response(response: str) -> Dict:
     return sections
 
 
+def _fix_escape(escape_match: re.Match) -> str:
+    """合法的 JSON 转义序列保持不变，否则在反斜杠前再加一个反斜杠"""
+    if escape_match.group(1) in _JSON_VALID_ESCAPES:
+        return escape_match.group(0)
+    return '\\' + escape_match.group(0)
+
+
 def fix_json_escaping(json_str: str) -> str:
     """
     修复 JSON 字符串中的转义问题
@@ -257,42 +357,11 @@ def fix_json_escaping(json_str: str) -> str:
     Returns:
         修复后的 JSON 字符串
     """
-    result = []
-    i = 0
-    in_string = False
-    escape_next = False
-    
-    while i < len(json_str):
-        char = json_str[i]
-        
-        if char == '"' and not escape_next:
-            in_string = not in_string
-            result.append(char)
-            i += 1
-            continue
-        
-        if in_string:
-            if escape_next:
-                # 合法的 JSON 转义序列保持不变
-                if char in 'ntrfb"\\/':
-                    result.append(char)
-                else:
-                    # 不是合法的转义序列，在反斜杠前再加一个反斜杠
-                    result.append('\\')
-                    result.append(char)
-                escape_next = False
-            elif char == '\\':
-                result.append(char)
-                escape_next = True
-            else:
-                result.append(char)
-        else:
-            result.append(char)
-            escape_next = False
-        
-        i += 1
-    
-    return ''.join(result)
+    # 逐个 JSON 字符串字面量处理，字符串外的内容保持不变
+    return _JSON_STRING_RE.sub(
+        lambda string_match: _JSON_ESCAPE_RE.sub(_fix_escape, string_match.group(0)),
+        json_str
+    )
 
 
 def safe_json_loads(json_str: str, debug_name: str = "JSON") -> dict:
@@ -309,38 +378,45 @@ def safe_json_loads(json_str: str, debug_name: str = "JSON") -> dict:
     Raises:
         ValueError: 所有解析尝试都失败
     """
-    # 尝试1：直接解析
+    # 内容为空，或以 { / [ 开头却没有对应的结尾（常见于被截断的输出）时，任何修复方式都无法解析，直接失败
+    stripped = json_str.strip()
+    if not stripped or _JSON_CLOSING.get(stripped[0], stripped[-1]) != stripped[-1]:
+        logger.error(f"❌ {debug_name} 内容为空或不完整，跳过解析，末尾100字符: ...{stripped[-100:]}")
+        raise ValueError(f"{debug_name} 解析失败：内容为空或 JSON 不完整")
+    
+    # 尝试1：直接解析（orjson 比标准库快数倍，其 JSONDecodeError 是 json.JSONDecodeError 的子类）
     try:
-        return json.loads(json_str)
-    except json.JSONDecodeError as e1:
-        print(f"⚠️ {debug_name} 解析失败（第1次）: {str(e1)}")
-        print(f"   错误位置附近的内容: ...{json_str[max(0, e1.pos-30):e1.pos+30]}...")
+        return orjson.loads(json_str)
+    except orjson.JSONDecodeError as e1:
+        logger.warning(f"⚠️ {debug_name} 解析失败（第1次）: {str(e1)}")
+        logger.debug(f"   错误位置附近的内容: ...{json_str[max(0, e1.pos-30):e1.pos+30]}...")
     
-    # 尝试2：使用 strict=False
+    # 尝试2：使用标准库 strict=False（同时兼容 orjson 不接受的 NaN、超大整数和字符串中的控制字符）
     try:
         return json.loads(json_str, strict=False)
     except json.JSONDecodeError as e2:
-        print(f"⚠️ {debug_name} 解析失败（第2次，strict=False）: {str(e2)}")
+        logger.warning(f"⚠️ {debug_name} 解析失败（第2次，strict=False）: {str(e2)}")
     
     # 尝试3：修复转义问题
     try:
         fixed_json = fix_json_escaping(json_str)
-        print(f"🔧 尝试修复转义字符...")
+        logger.debug("🔧 尝试修复转义字符...")
         return json.loads(fixed_json)
     except json.JSONDecodeError as e3:
-        print(f"⚠️ {debug_name} 解析失败（第3次，修复转义后）: {str(e3)}")
-        print(f"   修复后的JSON前200字符: {fixed_json[:200]}")
+        logger.warning(f"⚠️ {debug_name} 解析失败（第3次，修复转义后）: {str(e3)}")
+        logger.debug(f"   修复后的JSON前200字符: {fixed_json[:200]}")
     
     # 尝试4：激进的修复
     try:
         aggressive_fix = re.sub(r'(?<!\\)\\(?!\\)', r'\\\\', json_str)
-        print(f"🔧 尝试激进修复（所有单反斜杠加倍）...")
+        logger.debug("🔧 尝试激进修复（所有单反斜杠加倍）...")
         return json.loads(aggressive_fix)
     except json.JSONDecodeError as e4:
-        print(f"⚠️ {debug_name} 解析失败（第4次，激进修复）: {str(e4)}")
+        logger.warning(f"⚠️ {debug_name} 解析失败（第4次，激进修复）: {str(e4)}")
+        last_error = e4
     
     # 所有尝试都失败
-    print(f"❌ {debug_name} 解析彻底失败！")
-    print(f"📄 完整 JSON 内容：\n{json_str}\n")
-    raise ValueError(f"{debug_name} 解析失败：尝试了4种方法都无法解析。最后一次错误：{str(e4)}")
+    logger.error(f"❌ {debug_name} 解析彻底失败！")
+    logger.error(f"📄 完整 JSON 内容：\n{json_str}\n")
+    raise ValueError(f"{debug_name} 解析失败：尝试了4种方法都无法解析。最后一次错误：{str(last_error)}")
 
@@ -239,6 +239,43 @@ D. \( \text{{Fe}}_2\text{{O}}_3 \rightarrow \text{{Fe(OH)}}_3 \)
 {user_feedback_section}"""
 
 
+# 格式错误时的重试提示词模板（模块级常量，只在重试时格式化）
+OCR_RETRY_PROMPT_TEMPLATE = """⚠️ 你的上一次输出格式有错误，无法解析：
+
+【错误信息】
+{error_msg}
+
+【要求的格式】
+##TYPE##
+题目类型（choice/fillBlank/shortAnswer/essay）
+
+##SUBJECT##
+学科代码（math/physics/chemistry/biology/chinese/english等）
+
+##CONTENT##
+题目内容（Markdown格式，LaTeX公式用 $ 或 $$ 包裹）
+
+##OPTIONS##（选择题必需，其他题型可省略）
+A. 选项1
+B. 选项2
+...
+
+##END##
+
+【你的输出】
+{response}...
+
+请严格按照上述格式重新输出，确保所有必需标记都存在。"""
+
+
+def build_ocr_retry_prompt(error_msg: str, response: Optional[str]) -> str:
+    """构建 OCR 输出格式错误时的重试提示词"""
+    return OCR_RETRY_PROMPT_TEMPLATE.format(
+        error_msg=error_msg,
+        response=response[:500] if response else '无响应'
+    )
+
+
 # ============= 知识点分析 Prompt =============
 
 def get_knowledge_points_system_prompt() -> str:
@@ -302,21 +339,9 @@ def build_existing_kp_hint(knowledge_points_text: str) -> str:
     return ""
 
 
-def get_knowledge_points_user_prompt(
-    subject_chinese: str,
-    content: str,
-    available_modules_hint: str,
-    existing_kp_hint: str
-) -> str:
-    """获取知识点分析的用户提示词"""
-    return rf"""分析这道{subject_chinese}题目，提取模块、知识点和解题提示。
-
-**题目：**
-{content}
-{available_modules_hint}
-{existing_kp_hint}
-
-**返回格式（分段标记，不要用代码块）：**
+# 知识点分析的返回格式说明和示例（不含变量）
+# 放在用户提示词开头，每次请求的开头部分完全相同，服务端可以复用前缀缓存；题目等变量放在最后
+KNOWLEDGE_POINTS_FORMAT_GUIDE = r"""**返回格式（分段标记，不要用代码块）：**
 
 ##MODULES##
 模块1
@@ -334,7 +359,7 @@ def get_knowledge_points_user_prompt(
 ##END##
 
 **字段说明：**
-1. **MODULES**：只填模块名（不含括号描述），必须从上面列表中选择
+1. **MODULES**：只填模块名（不含括号描述），必须从下面的可用模块列表中选择
 2. **KNOWLEDGE_POINTS**：每行一个，格式为 `知识点名|模块名|category|importance`
    - **知识点名**：
      * **优先使用已有知识点**：如果用户已有知识点中存在相同或相近的知识点，直接使用已有的名称
@@ -383,8 +408,8 @@ def get_knowledge_points_user_prompt(
 - \( \Delta < 0 \)：无实根
 
 **韦达定理**让我们无需求出具体根值就能处理根的关系式：
-- 两根之和：\( x_1 + x_2 = -\frac{{b}}{{a}} \)
-- 两根之积：\( x_1 x_2 = \frac{{c}}{{a}} \)
+- 两根之和：\( x_1 + x_2 = -\frac{b}{a} \)
+- 两根之积：\( x_1 x_2 = \frac{c}{a} \)
 
 **解题建议**：遇到包含方程根的复杂代数式时，有两个常用技巧：
 1. 利用韦达定理建立根之间的关系
@@ -412,9 +437,9 @@ def get_knowledge_points_user_prompt(
 
 **关键突破口：**
 - **第一步思路**：画受力图，这是理解问题的基础。明确物体受到哪些力，每个力的方向如何
-- **核心桥梁**：加速度是连接"力"和"运动"的关键。用牛顿第二定律 \( F_{{合}} = ma \) 求出加速度
+- **核心桥梁**：加速度是连接"力"和"运动"的关键。用牛顿第二定律 \( F_{合} = ma \) 求出加速度
 - **选择工具**：根据题目给的条件和要求，选择合适的运动学公式：
-  * 如果涉及时间，用 \( v = v_0 + at \) 或 \( s = v_0 t + \frac{{1}}{{2}}at^2 \)
+  * 如果涉及时间，用 \( v = v_0 + at \) 或 \( s = v_0 t + \frac{1}{2}at^2 \)
   * 如果不涉及时间，用 \( v^2 - v_0^2 = 2as \)
 
 **思维方向：**
@@ -536,3 +561,72 @@ def get_knowledge_points_user_prompt(
 
 ##END##"""
 
+
+def get_knowledge_points_user_prompt(
+    subject_chinese: str,
+    content: str,
+    available_modules_hint: str,
+    existing_kp_hint: str
+) -> str:
+    """获取知识点分析的用户提示词"""
+    return f"""{KNOWLEDGE_POINTS_FORMAT_GUIDE}
+
+---
+
+分析这道{subject_chinese}题目，按上面的格式提取模块、知识点和解题提示。
+
+**题目：**
+{content}
+{available_modules_hint}
+{existing_kp_hint}"""
+
+
+# 格式错误时的重试提示词模板（模块级常量，只在重试时格式化）
+KNOWLEDGE_POINTS_RETRY_PROMPT_TEMPLATE = """⚠️ 你的上一次输出格式有错误，无法解析：
+
+【错误信息】
+{error_msg}
+
+【要求的格式】
+##MODULES##
+模块名1
+模块名2
+...
+
+##KNOWLEDGE_POINTS##
+知识点名|模块名|category|importance
+知识点名|模块名|category|importance
+...
+
+说明：
+- category 必须是：primary（主要考点）/secondary（次要考点）/related（相关知识）
+- importance 必须是：high（高频重点）/basic（基础必会）/normal（常规知识）
+
+##SOLVING_HINT##
+解题提示内容（可以包含 LaTeX 公式）
+
+##END##
+
+【可用的模块列表】
+{modules_text}
+
+【你的输出】
+{response}...
+
+请严格按照上述格式重新输出，确保：
+1. 所有标记都存在
+2. 知识点格式为：知识点名|模块名|category|importance（用 | 分隔）
+3. category 和 importance 的值必须在允许的范围内"""
+
+
+def build_knowledge_points_retry_prompt(
+    error_msg: str,
+    response: Optional[str],
+    modules_text: str
+) -> str:
+    """构建知识点分析输出格式错误时的重试提示词"""
+    return KNOWLEDGE_POINTS_RETRY_PROMPT_TEMPLATE.format(
+        error_msg=error_msg,
+        response=response[:500] if response else '无响应',
+        modules_text=modules_text if modules_text else '（无可用模块，请使用"未分类"）'
+    )
@@ -5,6 +5,7 @@
 from workers.mistake_analyzer.helpers.appwrite_helpers import (
     create_appwrite_client,
     get_existing_modules,
+    fetch_modules_by_ids,
     get_existing_knowledge_points_by_module
 )
 from workers.mistake_analyzer.helpers.utils import *
@@ -13,5 +14,6 @@ from workers.mistake_analyzer.helpers.timezone_utils import *
 __all__ = [
     'create_appwrite_client',
     'get_existing_modules',
+    'fetch_modules_by_ids',
     'get_existing_knowledge_points_by_module'
 ]
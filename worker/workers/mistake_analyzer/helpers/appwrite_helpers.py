@@ -3,34 +3,43 @@ Appwrite 辅助函数模块
 负责数据库查询和 Appwrite 客户端创建
 """
 import os
-from typing import Dict, List, Optional
+import time
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 from appwrite.client import Client
 from appwrite.services.databases import Databases
 from appwrite.query import Query
 
-from workers.mistake_analyzer.helpers.utils import get_user_profile, get_education_level_from_grade, get_subject_chinese_name
+from workers.mistake_analyzer.helpers.utils import (
+    SUBJECT_NAMES,
+    get_user_education_level,
+    get_subject_chinese_name
+)
 
 
 # 常量配置
 DATABASE_ID = os.environ.get('APPWRITE_DATABASE_ID', 'main')
 COLLECTION_MODULES = 'knowledge_points_library'
 
-# 学科中文映射
-SUBJECT_NAMES = {
-    'math': '数学',
-    'physics': '物理',
-    'chemistry': '化学',
-    'biology': '生物',
-    'chinese': '语文',
-    'english': '英语',
-    'history': '历史',
-    'geography': '地理',
-    'politics': '政治'
-}
+# Query.equal 单次最多支持 100 个值
+QUERY_ID_CHUNK_SIZE = 100
 
+# 模块文档进程内缓存（模块库很少变化，跨请求复用）
+MODULE_CACHE_TTL = 600  # 秒
+MODULE_CACHE_MAX_SIZE = 4096
 
+_module_cache: Dict[str, Tuple[float, Dict]] = {}  # {module_id: (过期时间, 模块文档)}
+_module_cache_lock = threading.Lock()
+
+# 学科模块列表缓存（与用户无关，按学科和学段共享）
+_module_list_cache: Dict[Tuple[str, str], Tuple[float, List[Dict]]] = {}  # {(学科中文, 学段): (过期时间, 模块列表)}
+_module_list_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
 def create_appwrite_client() -> Client:
-    """创建 Appwrite Client"""
+    """创建 Appwrite Client（进程内只创建一次，未传入 databases 的查询复用同一个实例）"""
     client = Client()
     client.set_endpoint(os.environ.get('APPWRITE_ENDPOINT', 'https://cloud.appwrite.io/v1'))
     client.set_project(os.environ['APPWRITE_PROJECT_ID'])
@@ -58,13 +67,18 @@ def get_existing_modules(
         databases = Databases(create_appwrite_client())
     
     try:
-        user_profile = get_user_profile(databases, user_id)
-        user_grade = user_profile.get('grade') if user_profile else None
-        education_level = get_education_level_from_grade(user_grade)
+        education_level = get_user_education_level(databases, user_id)
         
-        print(f"用户年级: {user_grade}, 学段: {education_level}")
+        print(f"用户学段: {education_level}")
         
         subject_chinese = get_subject_chinese_name(subject)
+        cache_key = (subject_chinese, education_level)
+        
+        now = time.monotonic()
+        with _module_list_cache_lock:
+            cached = _module_list_cache.get(cache_key)
+        if cached and cached[0] > now:
+            return list(cached[1])
         
         queries = [
             Query.equal('subject', subject_chinese),
@@ -90,13 +104,71 @@ def get_existing_modules(
         ]
         
         print(f"找到 {len(modules)} 个{SUBJECT_NAMES.get(subject, subject)}模块（学段: {education_level}，学科中文: {subject_chinese}）")
-        return modules
+        
+        with _module_list_cache_lock:
+            _module_list_cache[cache_key] = (now + MODULE_CACHE_TTL, modules)
+        return list(modules)
         
     except Exception as e:
         print(f"获取学科模块失败: {str(e)}")
         return []
 
 
+def fetch_modules_by_ids(
+    databases: Databases,
+    module_ids: List[str]
+) -> List[Dict]:
+    """
+    按 ID 批量获取模块文档（每 100 个 ID 一次查询，代替逐个 get_document）
+    
+    结果在进程内缓存 MODULE_CACHE_TTL 秒，缓存命中的模块不再查询数据库
+    
+    Args:
+        databases: Databases 实例
+        module_ids: 模块ID列表
+        
+    Returns:
+        模块文档列表（不存在的 ID 不会出现在结果中）
+    """
+    now = time.monotonic()
+    modules = []
+    missing_ids = []
+    with _module_cache_lock:
+        for module_id in module_ids:
+            cached = _module_cache.get(module_id)
+            if cached and cached[0] > now:
+                modules.append(cached[1])
+            else:
+                missing_ids.append(module_id)
+    
+    fetched = []
+    for i in range(0, len(missing_ids), QUERY_ID_CHUNK_SIZE):
+        chunk = missing_ids[i:i + QUERY_ID_CHUNK_SIZE]
+        result = databases.list_documents(
+            database_id=DATABASE_ID,
+            collection_id=COLLECTION_MODULES,
+            queries=[
+                Query.equal('$id', chunk),
+                Query.limit(len(chunk))
+            ]
+        )
+        fetched.extend(result.get('documents', []))
+    
+    if fetched:
+        expires_at = now + MODULE_CACHE_TTL
+        with _module_cache_lock:
+            if len(_module_cache) + len(fetched) > MODULE_CACHE_MAX_SIZE:
+                # 先清理过期项，仍然超出上限时清空
+                for module_id in [k for k, v in _module_cache.items() if v[0] <= now]:
+                    del _module_cache[module_id]
+                if len(_module_cache) + len(fetched) > MODULE_CACHE_MAX_SIZE:
+                    _module_cache.clear()
+            for doc in fetched:
+                _module_cache[doc['$id']] = (expires_at, doc)
+    
+    return modules + fetched
+
+
 def get_existing_knowledge_points_by_module(
     module_id: str,
     user_id: str,
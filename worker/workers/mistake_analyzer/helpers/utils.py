@@ -3,6 +3,10 @@
 """
 import os
 import json
+import time
+import threading
+from functools import lru_cache
+from typing import Dict, Tuple
 from appwrite.client import Client
 from appwrite.services.databases import Databases
 from appwrite.services.storage import Storage
@@ -83,22 +87,26 @@ def validate_mastery_status(status: str) -> bool:
     return status in valid_statuses
 
 
-def get_databases() -> Databases:
-    """Initialize Databases service"""
+@lru_cache(maxsize=1)
+def _get_appwrite_client() -> Client:
+    """创建 Appwrite Client（进程内只创建一次，Databases 和 Storage 共用）"""
     client = Client()
     client.set_endpoint(os.environ.get('APPWRITE_ENDPOINT', 'https://cloud.appwrite.io/v1'))
     client.set_project(os.environ['APPWRITE_PROJECT_ID'])
     client.set_key(os.environ['APPWRITE_API_KEY'])
-    return Databases(client)
+    return client
+
+
+@lru_cache(maxsize=1)
+def get_databases() -> Databases:
+    """Initialize Databases service（进程内只创建一次，多次调用复用同一个实例）"""
+    return Databases(_get_appwrite_client())
 
 
+@lru_cache(maxsize=1)
 def get_storage() -> Storage:
-    """Initialize Storage service"""
-    client = Client()
-    client.set_endpoint(os.environ.get('APPWRITE_ENDPOINT', 'https://cloud.appwrite.io/v1'))
-    client.set_project(os.environ['APPWRITE_PROJECT_ID'])
-    client.set_key(os.environ['APPWRITE_API_KEY'])
-    return Storage(client)
+    """Initialize Storage service（进程内只创建一次，多次调用复用同一个实例）"""
+    return Storage(_get_appwrite_client())
 
 
 def get_user_profile(databases: Databases, user_id: str) -> dict:
@@ -125,6 +133,15 @@ def get_user_profile(databases: Databases, user_id: str) -> dict:
         return None
 
 
+# 年级 (1-12) 对应的教育阶段，下标为年级（下标 0 不使用）
+GRADE_EDUCATION_LEVELS = (
+    '初中',
+    '小学', '小学', '小学', '小学', '小学', '小学',
+    '初中', '初中', '初中',
+    '高中', '高中', '高中',
+)
+
+
 def get_education_level_from_grade(grade: int) -> str:
     """
     根据年级确定教育阶段（返回中文，与数据库一致）
@@ -135,17 +152,68 @@ def get_education_level_from_grade(grade: int) -> str:
     Returns:
         educationLevel: '小学' (1-6), '初中' (7-9), '高中' (10-12)
     """
-    if grade is None or grade < 1:
+    if grade is None or not 1 <= grade <= 12:
         return '初中'  # 默认初中
     
-    if 1 <= grade <= 6:
-        return '小学'
-    elif 7 <= grade <= 9:
-        return '初中'
-    elif 10 <= grade <= 12:
-        return '高中'
-    else:
-        return '初中'  # 默认初中
+    return GRADE_EDUCATION_LEVELS[int(grade)]
+
+
+# 用户学段进程内缓存（一次分析中获取模块列表和匹配每个模块都需要学段，只查询一次档案；
+# 过期时间较短，用户修改年级后很快生效）
+EDUCATION_LEVEL_CACHE_TTL = 60  # 秒
+EDUCATION_LEVEL_CACHE_MAX_SIZE = 10000
+
+_education_level_cache: Dict[str, Tuple[float, str]] = {}  # {user_id: (过期时间, 学段)}
+_education_level_cache_lock = threading.Lock()
+
+
+def get_user_education_level(databases: Databases, user_id: str) -> str:
+    """
+    根据用户档案中的年级获取学段（结果缓存 EDUCATION_LEVEL_CACHE_TTL 秒）
+    
+    Args:
+        databases: Databases 实例
+        user_id: 用户ID
+        
+    Returns:
+        educationLevel: '小学' / '初中' / '高中'（没有档案或年级无效时为默认的 '初中'）
+    """
+    now = time.monotonic()
+    with _education_level_cache_lock:
+        cached = _education_level_cache.get(user_id)
+    if cached and cached[0] > now:
+        return cached[1]
+    
+    user_profile = get_user_profile(databases, user_id)
+    user_grade = user_profile.get('grade') if user_profile else None
+    education_level = get_education_level_from_grade(user_grade)
+    
+    # 查询失败或档案尚未创建时不缓存，下次重新查询
+    if user_profile:
+        with _education_level_cache_lock:
+            if len(_education_level_cache) >= EDUCATION_LEVEL_CACHE_MAX_SIZE:
+                # 先清理过期项，仍然超出上限时清空
+                for key in [k for k, v in _education_level_cache.items() if v[0] <= now]:
+                    del _education_level_cache[key]
+                if len(_education_level_cache) >= EDUCATION_LEVEL_CACHE_MAX_SIZE:
+                    _education_level_cache.clear()
+            _education_level_cache[user_id] = (now + EDUCATION_LEVEL_CACHE_TTL, education_level)
+    
+    return education_level
+
+
+# 学科英文代码到中文名称的映射（与数据库中的学科名称一致）
+SUBJECT_NAMES = {
+    'math': '数学',
+    'physics': '物理',
+    'chemistry': '化学',
+    'biology': '生物',
+    'chinese': '语文',
+    'english': '英语',
+    'history': '历史',
+    'geography': '地理',
+    'politics': '政治',
+}
 
 
 def get_subject_chinese_name(subject_code: str) -> str:
@@ -158,16 +226,4 @@ def get_subject_chinese_name(subject_code: str) -> str:
     Returns:
         中文名称如 '数学', '物理'
     """
-    subject_mapping = {
-        'math': '数学',
-        'physics': '物理',
-        'chemistry': '化学',
-        'biology': '生物',
-        'chinese': '语文',
-        'english': '英语',
-        'history': '历史',
-        'geography': '地理',
-        'politics': '政治',
-    }
-    return subject_mapping.get(subject_code, subject_code)
-
+    return SUBJECT_NAMES.get(subject_code, subject_code)
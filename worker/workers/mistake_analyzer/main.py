@@ -24,7 +24,14 @@ from appwrite.services.databases import Databases
 from appwrite.services.storage import Storage
 from appwrite.exception import AppwriteException
 
-from workers.mistake_analyzer.core.image_analyzer import extract_question_content, analyze_subject_and_knowledge_points
+from workers.mistake_analyzer.core.image_analyzer import (
+    DEFAULT_SUBJECT_GUESS,
+    extract_question_content,
+    analyze_subject_and_knowledge_points,
+    start_subject_context_prefetch,
+    retarget_subject_context_prefetch,
+    take_subject_context_prefetch
+)
 from workers.mistake_analyzer.services.question_service import create_question, get_question
 from workers.mistake_analyzer.services.knowledge_point_service import ensure_knowledge_point, ensure_module, add_question_to_knowledge_point
 from workers.mistake_analyzer.services.profile_stats_service import update_profile_stats_on_mistake_created
@@ -121,11 +128,22 @@ async def process_mistake_analysis(record_data: dict, databases: Databases, stor
             print(f"⚠️ 读取上次识别结果失败: {str(e)}，将不使用历史结果")
             previous_result = None
     
-    # 1. 更新状态为 processing
-    await update_record_status(databases, record_id, 'processing')
-    print(f"✓ 状态更新为 processing")
+    def on_subject(subject: str) -> None:
+        # 流式 OCR 识别出学科后立即按实际学科预取，不等 OCR 全部完成
+        nonlocal subject_guess, context_task
+        context_task = retarget_subject_context_prefetch(context_task, subject_guess, subject, user_id, databases)
+        subject_guess = subject
+    
+    # 模块/知识点查询只依赖学科，按预测的学科提前执行（与状态更新和 OCR 并行；
+    # 图片下载是同步调用，下载期间预取不会推进）
+    subject_guess = (previous_result or {}).get('subject') or DEFAULT_SUBJECT_GUESS
+    context_task = start_subject_context_prefetch(subject_guess, user_id, databases)
     
     try:
+        # 1. 更新状态为 processing
+        await update_record_status(databases, record_id, 'processing')
+        print(f"✓ 状态更新为 processing")
+        
         # 2. 下载所有图片并转换为 base64
         import base64
         image_base64_list = []
@@ -142,7 +160,8 @@ async def process_mistake_analysis(record_data: dict, databases: Databases, stor
         step1_result = await extract_question_content(
             image_base64_list, 
             user_feedback=wrong_reason,
-            previous_result=previous_result
+            previous_result=previous_result,
+            on_subject=on_subject
         )
         print(f"✓ OCR完成，题目类型: {step1_result.get('type', '未知')}，学科: {step1_result.get('subject', '未知')}")
         
@@ -215,7 +234,8 @@ async def process_mistake_analysis(record_data: dict, databases: Databases, stor
             question_type=step1_result['type'],
             subject=step1_result['subject'],  # 从第一步获取学科
             user_id=user_id,
-            databases=databases
+            databases=databases,
+            context_task=take_subject_context_prefetch(context_task, subject_guess, step1_result['subject'])
         )
         
         # 合并两步的结果
@@ -385,6 +405,9 @@ async def process_mistake_analysis(record_data: dict, databases: Databases, stor
             error=error_message
         )
         raise
+    finally:
+        # 丢弃未使用或未完成的预取（正常完成时预取结果已被使用，cancel 不产生影响）
+        context_task.cancel()
 
 
 def main(context):
@@ -185,11 +185,9 @@ def ensure_module(
         找到的模块文档，如果找不到则返回"未分类"模块
     """
     # 获取用户学段信息
-    from workers.mistake_analyzer.helpers.utils import get_user_profile, get_education_level_from_grade
+    from workers.mistake_analyzer.helpers.utils import get_user_education_level
     
-    user_profile = get_user_profile(databases, user_id)
-    user_grade = user_profile.get('grade') if user_profile else None
-    education_level = get_education_level_from_grade(user_grade)
+    education_level = get_user_education_level(databases, user_id)
     
     # 1. 先查找用户学段对应的精确匹配模块
     existing = find_module(
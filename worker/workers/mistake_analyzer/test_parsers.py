@@ -0,0 +1,219 @@
+"""
+测试解析器：safe_json_loads 的快速失败 / 容错路径，以及流式响应中的学科增量识别
+
+不需要网络和数据库，直接运行：python workers/mistake_analyzer/test_parsers.py
+"""
+import os
+import sys
+import asyncio
+
+# 添加 worker 目录以导入 workers 包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import httpx
+import orjson
+
+from workers.mistake_analyzer.core.llm_provider import VolcengineLLMProvider
+from workers.mistake_analyzer.core.parsers import (
+    SegmentedStreamParser,
+    parse_segmented_response,
+    safe_json_loads
+)
+
+
+SEGMENTED_RESPONSE = """##TYPE##
+choice
+
+##SUBJECT##
+math
+
+##CONTENT##
+已知 $x^2 = 4$，求 $x$ 的值。
+
+##OPTIONS##
+A. 2
+B. -2
+C. ±2
+
+##END##
+"""
+
+
+def _feed_all(parser: SegmentedStreamParser, deltas) -> list:
+    """逐段喂入，返回每段 feed 的结果"""
+    return [parser.feed(delta) for delta in deltas]
+
+
+def _expect_value_error(json_str: str):
+    try:
+        safe_json_loads(json_str, debug_name="测试JSON")
+    except ValueError:
+        return
+    raise AssertionError(f"应当解析失败: {json_str!r}")
+
+
+# ==================== safe_json_loads ====================
+
+def test_safe_json_loads_valid():
+    """合法 JSON 直接解析（对象和数组）"""
+    assert safe_json_loads('{"a": 1, "b": [1, 2]}') == {'a': 1, 'b': [1, 2]}
+    assert safe_json_loads('  [{"name": "勾股定理"}]\n') == [{'name': '勾股定理'}]
+
+
+def test_safe_json_loads_empty():
+    """空内容直接失败"""
+    _expect_value_error('')
+    _expect_value_error('   \n ')
+
+
+def test_safe_json_loads_truncated():
+    """被截断的对象 / 数组（缺少结尾括号）直接失败，不进入各种修复尝试"""
+    _expect_value_error('{"knowledgePoints": [{"name": "勾股定理"}')
+    _expect_value_error('[{"name": "勾股定理"}, {"name": "一元二次')
+    _expect_value_error('{"a": 1, "b": [1, 2]')
+    # 结尾括号类型不匹配也视为不完整
+    _expect_value_error('{"a": [1, 2]]')
+
+
+def test_safe_json_loads_latex_escape():
+    """LaTeX 中未转义的反斜杠（非法的 JSON 转义）由修复步骤处理"""
+    result = safe_json_loads(r'{"hint": "利用 \sqrt{2} 和 \alpha \cdot \pi"}')
+    assert result == {'hint': r'利用 \sqrt{2} 和 \alpha \cdot \pi'}
+
+
+def test_safe_json_loads_control_characters():
+    """字符串中的原始换行符（orjson 不接受）由 strict=False 兼容"""
+    result = safe_json_loads('{"content": "第一行\n第二行"}')
+    assert result == {'content': '第一行\n第二行'}
+
+
+# ==================== SegmentedStreamParser ====================
+
+def test_stream_parser_subject_tag_split_across_deltas():
+    """##SUBJECT## 标记被拆到多个增量中"""
+    parser = SegmentedStreamParser()
+    results = _feed_all(parser, [
+        '##TYPE##\nchoice\n\n##SUB',
+        'JE',
+        'CT##\nmath',
+        '\n\n##CONTENT##\n已知',
+        ' $x^2 = 4$，求 $x$ 的值。\n##END##\n'
+    ])
+
+    # 学科单词后面出现换行才算完整，所以在第 4 段识别
+    assert results == [False, False, False, True, False]
+    assert parser.subject == 'math'
+
+
+def test_stream_parser_subject_word_split():
+    """学科单词本身被拆开时不能提前识别为前半部分"""
+    parser = SegmentedStreamParser()
+    results = _feed_all(parser, ['##SUBJECT##\nphy', 'si', 'cs\n##CONTENT##\n...'])
+
+    assert results == [False, False, True]
+    assert parser.subject == 'physics'
+
+
+def test_stream_parser_char_by_char():
+    """逐字符喂入：只返回一次 True，完整文本与非流式解析结果一致"""
+    parser = SegmentedStreamParser()
+    results = _feed_all(parser, list(SEGMENTED_RESPONSE))
+
+    assert results.count(True) == 1
+    assert parser.subject == 'math'
+    assert parser.text == SEGMENTED_RESPONSE
+    assert parse_segmented_response(parser.text) == parse_segmented_response(SEGMENTED_RESPONSE)
+
+
+def test_stream_parser_without_subject():
+    """没有 ##SUBJECT## 段落时不会识别出学科，超过扫描上限后停止扫描"""
+    parser = SegmentedStreamParser()
+    results = _feed_all(parser, ['##TYPE##\nchoice\n'] + ['题目内容' * 100] * 20)
+
+    assert not any(results)
+    assert parser.subject is None
+    # 停止扫描后仍然保留完整文本
+    assert parser.text.startswith('##TYPE##\nchoice\n')
+    assert len(parser.text) == len('##TYPE##\nchoice\n') + 400 * 20
+
+
+def _sse_body(text: str, piece_size: int) -> bytes:
+    """把文本拆成多个 delta，编码为 SSE 事件流"""
+    events = []
+    for i in range(0, len(text), piece_size):
+        chunk = {'choices': [{'delta': {'content': text[i:i + piece_size]}}]}
+        events.append(b'data: ' + orjson.dumps(chunk) + b'\n\n')
+    events.append(b'data: [DONE]\n\n')
+    return b''.join(events)
+
+
+async def _stream_through_http(
+    provider: VolcengineLLMProvider,
+    body: bytes,
+    network_chunk_size: int
+) -> list:
+    """通过 _stream_with_http 读取分块到达的 SSE 响应，返回解析出的 delta 列表"""
+    async def body_chunks():
+        # 网络分块与 SSE 事件边界、UTF-8 字符边界都不对齐
+        for i in range(0, len(body), network_chunk_size):
+            yield body[i:i + network_chunk_size]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=body_chunks())
+
+    original_client = httpx.AsyncClient
+
+    class MockAsyncClient(original_client):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, transport=httpx.MockTransport(handler), **kwargs)
+
+    httpx.AsyncClient = MockAsyncClient
+    try:
+        return [delta async for delta in provider._stream_with_http({'stream': True})]
+    finally:
+        httpx.AsyncClient = original_client
+
+
+def test_stream_parser_with_chunked_sse():
+    """SSE 事件分块到达、##SUBJECT## 跨多个 delta 时，学科识别和完整文本都正确"""
+    provider = VolcengineLLMProvider(api_key='test-key', endpoint_id='test-endpoint')
+    for piece_size in (1, 3, 7):
+        for network_chunk_size in (5, 13, 64):
+            body = _sse_body(SEGMENTED_RESPONSE, piece_size)
+            deltas = asyncio.run(_stream_through_http(provider, body, network_chunk_size))
+
+            parser = SegmentedStreamParser()
+            results = _feed_all(parser, deltas)
+
+            assert results.count(True) == 1, (piece_size, network_chunk_size)
+            assert parser.subject == 'math'
+            assert parser.text == SEGMENTED_RESPONSE
+            # 学科在 ##CONTENT## 到达之前就已识别
+            subject_index = results.index(True)
+            assert '##CONTENT##' not in ''.join(deltas[:subject_index])
+
+
+def main():
+    """运行全部测试"""
+    tests = [(name, func) for name, func in globals().items() if name.startswith('test_') and callable(func)]
+
+    print("=" * 60)
+    print("测试解析器")
+    print("=" * 60)
+
+    failed = 0
+    for name, func in tests:
+        try:
+            func()
+            print(f"✅ {name}")
+        except Exception as e:
+            failed += 1
+            print(f"❌ {name}: {e!r}")
+
+    print("=" * 60)
+    print(f"通过 {len(tests) - failed}/{len(tests)}")
+    return failed == 0
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)